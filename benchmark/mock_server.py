@@ -0,0 +1,290 @@
+"""
+本地模拟的Tinify api服务器，供性能测试使用，不消耗真实密钥的压缩次数
+
+    python mock_server.py --port 8000 --latency 200 --bandwidth 2048 --error-rate 0.01 --rate-429 0.01
+
+启动后通过TinyImg.set_api_endpoint('http://127.0.0.1:8000')即可让压缩请求发往本服务器
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockConfig:
+    latency: float = 0.0  # 上传完成到返回响应的延迟(s)，模拟云端压缩耗时
+    rtt: float = 0.0  # 每个请求的网络往返延迟(s)，包括密钥验证与下载
+    jitter: float = 0.0  # 延迟随机波动比例
+    bandwidth: int = 0  # 每个连接的带宽(B/s)，0为不限制
+    error_rate: float = 0.0  # 返回500错误的概率
+    download_error_rate: float = 0.0  # 下载时返回500错误的概率
+    output_ttl: float = 0.0  # 压缩后图片的有效期(s)，过期后下载返回404，0为不过期
+    rate_429: float = 0.0  # 返回临时限流429（带Retry-After，不代表次数用完）的概率
+    ratio: float = 0.5  # 压缩后大小与原大小之比
+    quota: int = 500  # 每个密钥的压缩次数上限
+
+
+class MockState:
+    """
+    服务器内部状态与统计信息
+    """
+    lock = threading.Lock()
+    outputs = {}  # 图片id -> (压缩后内容, 上传开始时间)，与真实服务器一样在有效期内可多次请求
+    counts = {}  # 密钥 -> 已用压缩次数
+    stats = {'uploads': 0, 'downloads': 0, 'variants': 0, 'validations': 0, 'unauthorized': 0, 'errors': 0,
+             'too_many_requests': 0, 'quota_exceeded': 0, 'download_errors': 0, 'expired': 0, 'bytes_in': 0,
+             'bytes_out': 0}
+    latencies = []  # 每个文件从开始上传到下载完成的耗时(s)
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.outputs.clear()
+            cls.counts.clear()
+            cls.latencies.clear()
+            for k in cls.stats:
+                cls.stats[k] = 0
+
+    @classmethod
+    def add(cls, name, value=1):
+        with cls.lock:
+            cls.stats[name] += value
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 保持连接，与真实服务器一致
+
+    def log_message(self, *args):
+        pass
+
+    def _key(self) -> str:
+        auth = self.headers.get('authorization', '')
+        if not auth.startswith('Basic '):
+            return ''
+        return base64.b64decode(auth[6:]).decode(errors='ignore').split(':', 1)[-1]
+
+    @staticmethod
+    def _initial_count(key) -> int:
+        """
+        密钥以-used-N结尾时初始已用次数为N，用于测试按次数重新排列密钥
+        """
+        _, sep, used = key.rpartition('-used-')
+        return int(used) if sep and used.isdigit() else 0
+
+    def _throttle(self, size, start):
+        """
+        按带宽限制补足传输耗时
+        """
+        if MockConfig.bandwidth:
+            wait = size / MockConfig.bandwidth - (time.time() - start)
+            if wait > 0:
+                time.sleep(wait)
+
+    def _read_body(self) -> bytes:
+        start = time.time()
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            length = int(self.headers.get('content-length') or 0)
+            body = self.rfile.read(length) if length else b''
+        self._throttle(len(body), start)
+        return body
+
+    def _send(self, status, body=b'', headers=None):
+        start = time.time()
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, str(v))
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        view, chunk = memoryview(body), 64 * 1024
+        for i in range(0, len(body), chunk):
+            self.wfile.write(view[i:i + chunk])
+            self._throttle(min(i + chunk, len(body)), start)
+
+    def _send_error(self, status, error, message, count=None, headers=None):
+        headers = {'content-type': 'application/json', **(headers or {})}
+        if count is not None:
+            headers['compression-count'] = count
+        self._send(status, json.dumps({'error': error, 'message': message}).encode(), headers)
+
+    def _limit(self, count) -> bool:
+        """
+        密钥次数已用完或随机限流时返回429，已响应则返回True
+        """
+        if count >= MockConfig.quota:
+            MockState.add('quota_exceeded')
+            self._send_error(429, 'TooManyRequests', 'Your monthly limit has been exceeded', count)
+            return True
+        if random.random() < MockConfig.rate_429:  # 临时限流，客户端退避后重试，不应切换密钥
+            MockState.add('too_many_requests')
+            self._send_error(429, 'TooManyRequests', 'Too many requests, retry later', count, {'retry-after': 1})
+            return True
+        return False
+
+    def _output(self):
+        """
+        请求路径对应的压缩结果，不存在或已过期时返回None
+        """
+        with MockState.lock:
+            output = MockState.outputs.get(self.path.rsplit('/', 1)[-1])
+        if output is not None and MockConfig.output_ttl and time.time() - output[1] > MockConfig.output_ttl:
+            MockState.add('expired')
+            return None
+        return output
+
+    def _variant(self, key, body):
+        """
+        对压缩结果调整尺寸或转换格式，与上传一样消耗一次压缩次数
+        """
+        try:
+            options = json.loads(body or b'{}')
+        except ValueError:
+            return self._send_error(400, 'BadRequest', 'Invalid json')
+        with MockState.lock:
+            count = MockState.counts.setdefault(key, self._initial_count(key))
+        if self._limit(count):
+            return
+        if random.random() < MockConfig.download_error_rate:
+            MockState.add('download_errors')
+            return self._send_error(500, 'InternalServerError', 'Oops!')
+        output = self._output()
+        if output is None:
+            return self._send_error(404, 'NotFound', 'Output expired')
+        time.sleep(max(MockConfig.latency, 0))
+        data = output[0]
+        if 'resize' in options:  # 只模拟输出变小
+            data = data[:max(1, len(data) // 2)]
+        with MockState.lock:
+            MockState.counts[key] = count = MockState.counts.get(key, 0) + 1
+            MockState.stats['variants'] += 1
+            MockState.stats['bytes_out'] += len(data)
+        content_type = options.get('convert', {}).get('type', 'image/png')
+        self._send(200, data, {'content-type': content_type, 'compression-count': count})
+
+    def do_POST(self):
+        start = time.time()
+        time.sleep(MockConfig.rtt)
+        body = self._read_body()
+        if self.path.startswith('/output/'):
+            key = self._key()
+            if key.startswith('invalid') or not key:
+                MockState.add('unauthorized')
+                return self._send_error(401, 'Unauthorized', 'Credentials are invalid')
+            return self._variant(key, body)
+        if self.path.rstrip('/') != '/shrink':
+            return self._send_error(404, 'NotFound', 'Unknown path')
+        key = self._key()
+        if key.startswith('invalid'):  # 模拟无效密钥
+            MockState.add('unauthorized')
+            return self._send_error(401, 'Unauthorized', 'Credentials are invalid')
+        with MockState.lock:
+            count = MockState.counts.setdefault(key, self._initial_count(key))
+        if not body:  # 密钥验证
+            MockState.add('validations')
+            return self._send_error(400, 'InputMissing', 'Input is missing', count)
+        if self._limit(count):
+            return
+        if random.random() < MockConfig.error_rate:
+            MockState.add('errors')
+            return self._send_error(500, 'InternalServerError', 'Oops!')
+
+        latency = MockConfig.latency * (1 + random.uniform(-MockConfig.jitter, MockConfig.jitter))
+        time.sleep(max(latency, 0))
+        output_id = uuid.uuid4().hex
+        with MockState.lock:
+            MockState.counts[key] = count = MockState.counts.get(key, 0) + 1
+            MockState.outputs[output_id] = (body[:max(1, int(len(body) * MockConfig.ratio))], start)
+            MockState.stats['uploads'] += 1
+            MockState.stats['bytes_in'] += len(body)
+        self._send(201, headers={'compression-count': count,
+                                 'location': f'http://{self.headers["host"]}/output/{output_id}'})
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with MockState.lock:
+                body = json.dumps({**MockState.stats, 'latencies': MockState.latencies}).encode()
+            return self._send(200, body, {'content-type': 'application/json'})
+        if self.path == '/reset':
+            MockState.reset()
+            return self._send(200)
+        if not self.path.startswith('/output/'):
+            return self._send_error(404, 'NotFound', 'Unknown path')
+        time.sleep(MockConfig.rtt)
+        if random.random() < MockConfig.download_error_rate:  # 图片仍保留，可再次下载
+            MockState.add('download_errors')
+            return self._send_error(500, 'InternalServerError', 'Oops!')
+        output = self._output()
+        if output is None:
+            return self._send_error(404, 'NotFound', 'Output expired')
+        data, upload_start = output
+        self._send(200, data, {'content-type': 'image/png'})
+        with MockState.lock:
+            MockState.stats['downloads'] += 1
+            MockState.stats['bytes_out'] += len(data)
+            MockState.latencies.append(time.time() - upload_start)
+
+
+def start(host='127.0.0.1', port=0) -> tuple:
+    """
+    在后台线程启动服务器
+    :return: (服务器, api地址)
+    """
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Tinify API server for benchmarks.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='0 to pick a free port.')
+    parser.add_argument('--latency', type=float, default=0, help='Compression latency in ms.')
+    parser.add_argument('--jitter', type=float, default=0, help='Relative latency jitter, e.g. 0.2.')
+    parser.add_argument('--rtt', type=float, default=0, help='Network round trip added to every request in ms.')
+    parser.add_argument('--bandwidth', type=float, default=0, help='Per-connection bandwidth in KB/s, 0 for unlimited.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Probability of a 500 response.')
+    parser.add_argument('--rate-429', type=float, default=0,
+                        help='Probability of a transient 429 response (with Retry-After, not quota exhaustion).')
+    parser.add_argument('--download-error-rate', type=float, default=0,
+                        help='Probability of a 500 response to a download.')
+    parser.add_argument('--output-ttl', type=float, default=0,
+                        help='Seconds after which a compressed output expires, 0 to keep it.')
+    parser.add_argument('--ratio', type=float, default=0.5, help='Output size / input size.')
+    parser.add_argument('--quota', type=int, default=500, help='Compression count limit per key.')
+    args = parser.parse_args()
+
+    MockConfig.latency = args.latency / 1000
+    MockConfig.jitter = args.jitter
+    MockConfig.rtt = args.rtt / 1000
+    MockConfig.bandwidth = int(args.bandwidth * 1024)
+    MockConfig.error_rate = args.error_rate
+    MockConfig.rate_429 = args.rate_429
+    MockConfig.download_error_rate = args.download_error_rate
+    MockConfig.output_ttl = args.output_ttl
+    MockConfig.ratio = args.ratio
+    MockConfig.quota = args.quota
+    server, url = start(args.host, args.port)
+    print(url, flush=True)  # 首行输出api地址，供启动方读取
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
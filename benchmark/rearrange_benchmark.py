@@ -0,0 +1,133 @@
+"""
+重新排列密钥的耗时测试：在本地模拟api服务器上生成若干密钥（包括次数已用完与无效的密钥），
+分别记录逐条请求、并发请求与有效期内再次排列（使用记录的次数）的耗时，
+并按密钥名中的已用次数检查排列结果与每次排列的请求数，检查不通过时以非0状态退出
+
+    python rearrange_benchmark.py --keys 300 --rtt 150 -o rearrange.json
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from shutil import rmtree
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import tinypng_unlimited  # noqa: E402
+from tinypng_unlimited import KeyManager, TinyClient  # noqa: E402
+
+
+def make_keys(n) -> list:
+    """
+    生成密钥：约1/10次数已用完，约1/20无效，其余已用次数随机
+    """
+    keys = []
+    for i in range(n):
+        r = random.random()
+        if r < 0.05:
+            keys.append(f'invalid-{i}')
+        elif r < 0.15:
+            keys.append(f'bench-{i}-used-{TinyClient.LIMIT}')
+        else:
+            keys.append(f'bench-{i}-used-{random.randrange(TinyClient.LIMIT)}')
+    return keys
+
+
+def used(key):
+    """
+    密钥名中的已用次数，无效的密钥为None
+    """
+    return None if key.startswith('invalid') else int(key.rpartition('-used-')[2])
+
+
+def check(keys) -> list:
+    """
+    可用密钥按已用次数从多到少排列；次数已用完的密钥在前、无效的密钥在后，均不可用
+    :return: 不通过的检查项
+    """
+    available, unavailable = KeyManager.Keys.available, KeyManager.Keys.unavailable
+    # 已用次数相同的密钥先后不限，只比较次数序列
+    expected_available = sorted((used(k) for k in keys if used(k) is not None and used(k) < TinyClient.LIMIT),
+                                reverse=True)
+    expected_unavailable = sorted((used(k) for k in keys if used(k) is None or used(k) >= TinyClient.LIMIT),
+                                  key=lambda u: -1 if u is None else u, reverse=True)
+    errors = []
+    if sorted(available + unavailable) != sorted(keys):
+        errors.append('密钥有增减')
+    if [used(k) for k in available] != expected_available:
+        errors.append('可用密钥未按已用次数从多到少排列')
+    if [used(k) for k in unavailable] != expected_unavailable:
+        errors.append('不可用密钥应为次数已用完的在前、无效的在后')
+    return errors
+
+
+def probes(api) -> int:
+    """
+    模拟服务器至今收到的获取压缩次数请求数（不带图片上传，包括无效密钥）
+    """
+    with urllib.request.urlopen(f'{api}/stats') as res:
+        stats = json.load(res)
+    return stats['validations'] + stats['unauthorized']
+
+
+def run(api, keys, workers, force, expected_probes) -> dict:
+    KeyManager.probe_workers = workers
+    before = probes(api)
+    start = time.perf_counter()
+    KeyManager.rearrange_keys(force)
+    seconds = time.perf_counter() - start
+    errors = check(keys)
+    count = probes(api) - before
+    if count != expected_probes:
+        errors.append(f'请求{count}次，应为{expected_probes}次')
+    return {'seconds': round(seconds, 3), 'probes': count, 'errors': errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the time of rearranging keys.')
+    parser.add_argument('--keys', type=int, default=300, help='The number of stored keys.')
+    parser.add_argument('--rtt', type=float, default=150, help='Network round trip of the mock server in ms.')
+    parser.add_argument('--workers', type=int, default=16, help='The number of keys probed concurrently.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', type=str, help='Write the result json to this file.')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    tinypng_unlimited.logger.remove()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen([sys.executable, os.path.join(here, 'mock_server.py'), '--rtt', str(args.rtt)],
+                              stdout=subprocess.PIPE, text=True)
+    api = KeyManager.API_ENDPOINT = server.stdout.readline().strip()
+    working_dir = tempfile.mkdtemp(prefix='tiny-rearrange-')
+    try:
+        keys = make_keys(args.keys)
+        with open(os.path.join(working_dir, 'keys.json'), 'w', encoding='utf-8') as f:
+            json.dump({'available': keys, 'unavailable': []}, f)
+        KeyManager.working_dir = working_dir
+        KeyManager.load_keys()
+
+        result = {'keys': args.keys, 'rtt_ms': args.rtt, 'workers': args.workers}
+        result['serial'] = run(api, keys, 1, True, len(keys))
+        result['concurrent'] = run(api, keys, args.workers, True, len(keys))
+        result['cached'] = run(api, keys, args.workers, False, 0)  # 有效期内全部使用记录的次数
+    finally:
+        server.terminate()
+        rmtree(working_dir, ignore_errors=True)
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    failed = [f'{name}: {e}' for name in ('serial', 'concurrent', 'cached') for e in result[name]['errors']]
+    if failed:
+        sys.exit('检查不通过:\n' + '\n'.join(failed))
+
+
+if __name__ == '__main__':
+    main()
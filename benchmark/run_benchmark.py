@@ -0,0 +1,226 @@
+"""
+压缩吞吐量性能测试：启动本地模拟api服务器，在生成的图片集上运行批量压缩，
+以json输出文件数/s、MB/s、单文件耗时p50/p95与内存峰值，便于对比不同版本；
+同时按模拟服务器的压缩比例检查输出文件，检查不通过时以非0状态退出
+
+    python run_benchmark.py --files 500 --dist mixed --latency 300 --bandwidth 1024 -o result.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from shutil import rmtree
+
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from loguru import logger
+
+from tinypng_unlimited import TinyImg, KeyManager, Timing, Variant
+
+# 各分布的文件大小生成函数(B)
+DISTRIBUTIONS = {
+    'small': lambda r: r.randint(5 * 1024, 50 * 1024),
+    'medium': lambda r: r.randint(100 * 1024, 500 * 1024),
+    'large': lambda r: r.randint(1024 * 1024, 5 * 1024 * 1024),
+    'mixed': lambda r: DISTRIBUTIONS['small' if (x := r.random()) < 0.8 else 'medium' if x < 0.95 else 'large'](r),
+    'lognormal': lambda r: min(int(r.lognormvariate(11.5, 1)), 20 * 1024 * 1024),  # 中位数约100KB
+}
+
+
+def make_corpus(dir_path, files, dist, seed=0) -> list:
+    """
+    生成测试图片（随机内容，仅扩展名为png）
+    :return: 文件路径列表
+    """
+    rand = random.Random(seed)
+    os.makedirs(dir_path, exist_ok=True)
+    file_list = []
+    for i in range(files):
+        path = os.path.join(dir_path, f'{i:06d}.png')
+        with open(path, 'wb') as f:
+            f.write(rand.randbytes(max(DISTRIBUTIONS[dist](rand), 16)))
+        file_list.append(path)
+    return file_list
+
+
+def start_server(args) -> tuple:
+    """
+    在子进程中启动模拟服务器，避免其内存计入测试进程
+    :return: (子进程, api地址)
+    """
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_server.py'),
+           '--latency', str(args.latency), '--jitter', str(args.jitter), '--bandwidth', str(args.bandwidth),
+           '--ratio', str(args.ratio),
+           '--error-rate', str(args.error_rate), '--rate-429', str(args.rate_429),
+           '--download-error-rate', str(args.download_error_rate), '--output-ttl', str(args.output_ttl)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    return proc, proc.stdout.readline().strip()
+
+
+def peak_rss() -> float:
+    """
+    当前进程的内存峰值(MB)，不支持的平台返回None
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / 1024 / (1024 if sys.platform == 'darwin' else 1), 2)  # macOS单位为B，Linux为KB
+
+
+def percentile(values, p) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def check_outputs(args, file_list, out_dir, report) -> list:
+    """
+    检查输出文件：大小应为模拟服务器按压缩比例截取的内容加4字节压缩标记（调整尺寸的衍生图片再减半），
+    不注入错误时全部文件与衍生图片均应成功
+    :return: 不通过的检查项
+    """
+    errors = []
+    basic = report['basic']
+    if not (args.error_rate or args.rate_429 or args.download_error_rate or args.output_ttl):
+        if basic['success_count'] != len(file_list) or basic['error_count']:
+            errors.append(f'成功{basic["success_count"]}个，失败{basic["error_count"]}个，应全部成功')
+        if (basic.get('variant_count') or 0) != len(file_list) * len(args.variants):
+            errors.append(f'衍生图片{basic.get("variant_count")}个，应为{len(file_list) * len(args.variants)}个')
+    variants = [Variant.parse(spec) for spec in args.variants]
+    wrong = missing = 0
+    for path in file_list:
+        new_path = os.path.join(out_dir, os.path.basename(path))
+        if not os.path.exists(new_path):
+            missing += 1
+            continue
+        size = max(1, int(os.path.getsize(path) * args.ratio))
+        expected = {new_path: size + 4}
+        expected.update((v.path(new_path), (max(1, size // 2) if v.method else size) + 4) for v in variants)
+        wrong += sum(os.path.exists(p) and os.path.getsize(p) != n for p, n in expected.items())
+    if missing > basic['error_count']:  # 衍生图片失败时压缩后的图片仍可能已写入
+        errors.append(f'缺少输出文件{missing}个，但只有{basic["error_count"]}个失败')
+    if wrong:
+        errors.append(f'大小与压缩比例不符的输出文件{wrong}个')
+    return errors
+
+
+def run_once(args, api, file_list, corpus_dir, out_dir, corpus_bytes) -> dict:
+    requests.get(f'{api}/reset')
+    rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    start = time.time()
+    with contextlib.redirect_stdout(sys.stderr):  # 进度条输出到stderr，stdout只输出结果
+        if args.mode == 'dir':
+            report = TinyImg.compress_from_dir(corpus_dir, out_dir, engine=args.engine)
+        else:
+            report = TinyImg.compress_from_file_list(file_list, out_dir, engine=args.engine)
+    elapsed = time.time() - start
+    errors = check_outputs(args, file_list, out_dir, report)
+    stats = requests.get(f'{api}/stats').json()
+    latencies = stats.pop('latencies')
+    stages = {stage: round(h['mean'] * 1000, 1) for stage, h in report.get('histograms', {}).items()}
+    return {
+        'elapsed': round(elapsed, 3),
+        'files_per_s': round(len(file_list) / elapsed, 2),
+        'mb_per_s': round(corpus_bytes / 1024 / 1024 / elapsed, 2),
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+        'latency_p95_ms': round(percentile(latencies, 95) * 1000, 1) if latencies else None,
+        'success_count': report['basic']['success_count'],
+        'error_count': report['basic']['error_count'],
+        'retry_count': report['basic'].get('retry_count'),
+        'reuploads_avoided': report['basic'].get('reuploads_avoided'),
+        'variant_count': report['basic'].get('variant_count'),
+        'stage_mean_ms': stages,  # 客户端各阶段平均耗时
+        'server': stats,
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TinyPNG-Unlimited against a local mock Tinify server.')
+    parser.add_argument('--files', type=int, default=200, help='The number of images in the corpus.')
+    parser.add_argument('--dist', choices=DISTRIBUTIONS.keys(), default='mixed', help='Image size distribution.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the corpus.')
+    parser.add_argument('--mode', choices=('list', 'dir'), default='list',
+                        help='Drive compress_from_file_list or compress_from_dir.')
+    parser.add_argument('-e', '--engine', choices=('thread', 'async'), default='thread')
+    parser.add_argument('--min-workers', type=int, default=2)
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--order', choices=TinyImg.ORDERS, default='largest', help='Submission order of the images.')
+    parser.add_argument('--repeat', type=int, default=1, help='Run the benchmark several times.')
+    parser.add_argument('--latency', type=float, default=100, help='Mock compression latency in ms.')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Relative latency jitter.')
+    parser.add_argument('--bandwidth', type=float, default=0, help='Mock per-connection bandwidth in KB/s.')
+    parser.add_argument('--ratio', type=float, default=0.5, help='Mock output size / input size.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Probability of a 500 response.')
+    parser.add_argument('--rate-429', type=float, default=0,
+                        help='Probability of a transient 429 response, not treated as quota exhaustion.')
+    parser.add_argument('--download-error-rate', type=float, default=0,
+                        help='Probability of a 500 response to a download.')
+    parser.add_argument('--output-ttl', type=float, default=0, help='Seconds after which a mock output expires.')
+    parser.add_argument('--variants', type=str, nargs='*', default=[],
+                        help='Variants produced from each upload, e.g. 800x 400x:webp.')
+    parser.add_argument('-o', '--output', type=str, help='Also write the json result to this file.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Keep the compression log.')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level='ERROR')
+
+    work_dir = tempfile.mkdtemp(prefix='tinypng-bench-')
+    proc, api = start_server(args)
+    try:
+        corpus_dir, out_dir = os.path.join(work_dir, 'corpus'), os.path.join(work_dir, 'out')
+        file_list = make_corpus(corpus_dir, args.files, args.dist, args.seed)
+        corpus_bytes = sum(os.path.getsize(path) for path in file_list)
+
+        # 假密钥，每条500次，数量足够避免触发申请新密钥，每个衍生图片另外消耗一次
+        key_num = args.files * args.repeat * (1 + len(args.variants)) // 400 + 5
+        with open(os.path.join(work_dir, 'keys.json'), 'w', encoding='utf-8') as f:
+            json.dump({'available': [f'bench-{i}' for i in range(key_num)],
+                       'unavailable': []}, f)
+        KeyManager.working_dir = work_dir
+        KeyManager.load_keys()
+        TinyImg.set_api_endpoint(api)
+        TinyImg.set_concurrency(args.min_workers, args.max_workers, args.download_workers)
+        TinyImg.set_order(args.order)
+        TinyImg.set_variants(args.variants)
+        TinyImg.set_key(KeyManager.Keys.available[0])
+        Timing.enable(histograms=True, files=False)
+
+        runs = [run_once(args, api, file_list, corpus_dir, out_dir, corpus_bytes) for _ in range(args.repeat)]
+    finally:
+        proc.terminate()
+        rmtree(work_dir, ignore_errors=True)
+
+    result = {
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'verbose')},
+        'corpus_mb': round(corpus_bytes / 1024 / 1024, 2),
+        'runs': runs,
+        'best_files_per_s': max(r['files_per_s'] for r in runs),
+        'peak_rss_mb': peak_rss(),
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    failed = [f'run {i + 1}: {e}' for i, r in enumerate(runs) for e in r['errors']]
+    if failed:
+        sys.exit('检查不通过:\n' + '\n'.join(failed))
+
+
+if __name__ == '__main__':
+    main()
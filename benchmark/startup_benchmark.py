@@ -0,0 +1,137 @@
+"""
+启动耗时测试：在新进程中导入包、初始化（载入并验证密钥、清理临时文件夹）并压缩单个文件，
+分别记录各阶段耗时，模拟构建工具每批资源调用一次命令行的场景，以json输出各项的中位数
+
+    python startup_benchmark.py --repeat 10 --rtt 150 -o startup.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from shutil import rmtree
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def child(args):
+    """
+    子进程：依次导入、初始化与压缩，输出各阶段距进程开始导入的耗时
+    """
+    start = time.perf_counter()
+    import tinypng_unlimited
+    from tinypng_unlimited import TinyImg, KeyManager, ResultCache, Manifest, Journal
+    imported = time.perf_counter()
+    tinypng_unlimited.logger.remove()  # stdout只输出结果
+
+    KeyManager.working_dir = args.working_dir
+    KeyManager.load_keys()
+    ResultCache.init(args.working_dir, 0)
+    Manifest.init(args.working_dir)
+    Journal.init(args.working_dir)
+    TinyImg.set_api_endpoint(args.api)
+    TinyImg.set_key(KeyManager.Keys.available[0])
+    if hasattr(TinyImg, 'clean_tmp'):  # 与main.py相同，在后台清理
+        threading.Thread(target=TinyImg.clean_tmp, daemon=True).start()
+    else:  # 旧版本启动时清空临时文件夹
+        rmtree(os.path.join(args.working_dir, 'tmp'), ignore_errors=True)
+    ready = time.perf_counter()
+
+    out_dir = os.path.join(args.working_dir, 'out')
+    with contextlib.redirect_stdout(sys.stderr):  # 进度条输出到stderr，stdout只输出结果
+        report = TinyImg.compress_from_file_list([args.file], out_dir)
+    done = time.perf_counter()
+    print(json.dumps({
+        'import_ms': (imported - start) * 1000, 'ready_ms': (ready - start) * 1000,
+        'first_file_ms': (done - start) * 1000, 'success': report['basic']['success_count'] == 1,
+    }))
+
+
+def prepare(working_dir, orphans, warm):
+    """
+    每次运行前重置工作目录：遗留的临时文件与密钥的压缩次数记录
+    """
+    tmp_dir = os.path.join(working_dir, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    old = time.time() - 24 * 3600
+    for i in range(orphans):
+        path = os.path.join(tmp_dir, f'orphan-{i}.tmp')
+        with open(path, 'wb') as f:
+            f.write(b'0' * 1024)
+        os.utime(path, (old, old))
+    keys_path = os.path.join(working_dir, 'keys.json')
+    with open(keys_path, encoding='utf-8') as f:
+        keys = json.load(f)
+    if not warm:
+        keys.pop('counts', None)
+    with open(keys_path, 'w', encoding='utf-8') as f:
+        json.dump(keys, f)
+    rmtree(os.path.join(working_dir, 'out'), ignore_errors=True)
+
+
+def measure(cmd) -> tuple:
+    start = time.perf_counter()
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return (time.perf_counter() - start) * 1000, res.stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time of a one-file run.')
+    parser.add_argument('--repeat', type=int, default=10, help='The number of runs of each scenario.')
+    parser.add_argument('--rtt', type=float, default=150, help='Network round trip of the mock server in ms.')
+    parser.add_argument('--latency', type=float, default=100, help='Compression latency of the mock server in ms.')
+    parser.add_argument('--orphans', type=int, default=2000, help='The number of orphaned files in the tmp dir.')
+    parser.add_argument('-o', '--output', type=str, help='Write the result json to this file.')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--api', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--working-dir', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--file', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen([sys.executable, os.path.join(here, 'mock_server.py'), '--rtt', str(args.rtt),
+                               '--latency', str(args.latency)], stdout=subprocess.PIPE, text=True)
+    api = server.stdout.readline().strip()
+    working_dir = tempfile.mkdtemp(prefix='tiny-startup-')
+    try:
+        with open(os.path.join(working_dir, 'keys.json'), 'w', encoding='utf-8') as f:
+            json.dump({'available': ['startup-1', 'startup-2', 'startup-3'], 'unavailable': []}, f)
+        file = os.path.join(working_dir, 'image.png')
+        with open(file, 'wb') as f:
+            f.write(os.urandom(64 * 1024))
+
+        result = {'rtt_ms': args.rtt, 'latency_ms': args.latency, 'orphans': args.orphans, 'repeat': args.repeat}
+        help_ms = [measure([sys.executable, os.path.join(here, '..', 'bin', 'main.py'), '--help'])[0]
+                   for _ in range(args.repeat)]
+        result['cli_help_ms'] = round(statistics.median(help_ms), 1)
+        child_cmd = [sys.executable, os.path.abspath(__file__), '--child', '--api', api,
+                     '--working-dir', working_dir, '--file', file]
+        for scenario, warm in (('cold', False), ('warm', True)):
+            runs = []
+            for _ in range(args.repeat):
+                prepare(working_dir, args.orphans, warm)
+                wall, out = measure(child_cmd)
+                runs.append({**json.loads(out.strip().splitlines()[-1]), 'process_ms': wall})
+            result[scenario] = {k: round(statistics.median(r[k] for r in runs), 1)
+                                for k in ('import_ms', 'ready_ms', 'first_file_ms', 'process_ms')}
+            result[scenario]['success'] = all(r['success'] for r in runs)
+    finally:
+        server.terminate()
+        rmtree(working_dir, ignore_errors=True)
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
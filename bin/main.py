@@ -3,55 +3,99 @@ import json
 import os
 import sys
 import time
-from shutil import rmtree
+from threading import Thread
 
 from loguru import logger
-from tqdm import tqdm
 
 # 添加包路径进入环境变量
 cur_file_path = sys.argv[0]
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(cur_file_path), '..')))
-os.system('title=TinyPng无限制压缩图片')
+if os.name == 'nt':
+    os.system('title=TinyPng无限制压缩图片')
 
-from tinypng_unlimited import KeyManager, TinyImg
+# 各命令只导入用到的模块，--help、client等命令不载入requests、tqdm等依赖
+ORDERS = ('largest', 'smallest', 'fifo')  # 即TinyImg.ORDERS，解析参数时不导入TinyImg
 
 
-def init(proxy=None):
+def init(proxy=None, cache_size=512, workers=None, resume=False, preserve_stat=False, timing=False, order=None,
+         worker=False, journal=False, variants=None):
+    from tinypng_unlimited import KeyManager, TinyImg, ResultCache, Manifest, Journal, Timing
+
     logger.info('TinyPng正在初始化')
     KeyManager.init(os.path.dirname(cur_file_path))
-
-    tmp_dir = os.path.join(os.path.dirname(cur_file_path), 'tmp')
-    if os.path.exists(tmp_dir):
-        rmtree(tmp_dir)  # 清空之前的临时下载文件夹
+    if worker:
+        # 多个worker进程共用工作目录，缓存、索引与任务日志不支持多进程写入，由共享任务队列记录文件状态
+        ResultCache.init(os.path.dirname(cur_file_path), 0)
+        logger.info('配置: worker模式，不使用压缩结果缓存、已压缩文件索引与任务日志')
+    else:
+        ResultCache.init(os.path.dirname(cur_file_path), cache_size * 1024 * 1024)
+        Manifest.init(os.path.dirname(cur_file_path))
+        if journal:
+            Journal.init(os.path.dirname(cur_file_path), resume)
+        if resume:
+            logger.info('配置: 从任务日志中断处继续压缩')
 
     if not len(KeyManager.Keys.available):
         logger.error('无可用密钥，请稍后重试')
         exit()
 
-    TinyImg.set_key(KeyManager.Keys.available[0])
-
     if proxy is not None:
         TinyImg.set_proxy(proxy)
 
+    if workers is not None:
+        TinyImg.set_concurrency(*workers)
+
+    TinyImg.set_key(KeyManager.current_key())  # 密钥在后台验证，不阻塞之后的扫描
+    Thread(target=TinyImg.clean_tmp, daemon=True).start()  # 只清理之前异常退出时遗留的临时文件
+
+    if preserve_stat:
+        TinyImg.set_preserve_stat(True)
+        logger.info('配置: 压缩后的文件保留原文件的权限与修改时间')
+
+    if order is not None:
+        TinyImg.set_order(order)
+
+    if variants:
+        TinyImg.set_variants(variants)
+        logger.info('配置: 每个图片由同一次上传生成衍生图片: {}', ', '.join(v.name for v in TinyImg.variants))
+
+    if timing:
+        Timing.enable(histograms=True)
+        logger.info('配置: 记录各文件分阶段耗时')
+
     logger.success('TinyPng初始化成功')
 
 
-def compress_error_files(file_list):
+def compress_error_files(file_list, engine='thread', permanent=()):
+    """
+    重新压缩失败的图片，每轮之间按重试策略退避，错误不可重试的图片不再压缩
+    :param permanent: 错误不可重试的图片
+    """
+    from tqdm import tqdm
+    from tinypng_unlimited import TinyImg, RetryPolicy
+
+    policy = RetryPolicy(retries=5, base_delay=2, max_delay=60)
     times = 0
-    logger.warning('存在压缩失败图片({}):\n{}', len(file_list), file_list)
-    while times < 5:
+    while True:
+        permanent = set(permanent)
+        if permanent:
+            logger.error('以下图片的错误不可重试，不再压缩({}):\n{}', len(permanent), sorted(permanent))
+            file_list = [path for path in file_list if path not in permanent]
+        if not file_list:
+            return
+        logger.warning('存在压缩失败图片({}):\n{}', len(file_list), file_list)
+        if times >= policy.retries:
+            break
         times += 1
-        logger.info('1s后对上述文件列表内文件进行压缩(第{}次)', times)
-        time.sleep(1)
-        res = TinyImg.compress_from_file_list(file_list)
+        # api熔断时等到冷却结束
+        delay = max(policy.backoff(times), RetryPolicy.breaker(f'{TinyImg.API_ENDPOINT}/shrink').remaining())
+        logger.info('{:.1f}s后对上述文件列表内文件进行压缩(第{}次)', delay, times)
+        time.sleep(delay)
+        res = TinyImg.compress_from_file_list(file_list, engine=engine)
         tqdm.write('')
         logger.debug('压缩报告基本信息:\n{}', json.dumps(res['basic'], ensure_ascii=False, indent=2))
         # 压缩失败文件不考虑输出日志到文件
-        if res['basic']['error_count'] > 0:  # 仍然存在压缩失败的文件
-            file_list = res['error_files']
-            logger.warning('存在压缩失败图片({}):\n{}', len(file_list), file_list)
-        else:
-            return
+        file_list, permanent = res['error_files'], res.get('permanent_error_files', [])
 
     file_path = os.path.abspath(os.path.join(os.path.dirname(cur_file_path), 'error_files.json'))
     try:
@@ -64,8 +108,45 @@ def compress_error_files(file_list):
     logger.error('超过压缩失败重试次数{}, 压缩失败图片路径已保存', times)
 
 
+def compress_cover_groups(groups, log: bool = False, engine: str = 'thread'):
+    """
+    流式压缩多个分组（文件夹或文件列表）内图片（覆盖），所有分组共用同一个任务队列
+    :param groups: 分组的可迭代对象，元素为(文件夹路径或None，文件路径列表，跳过数量)
+    :param log: 是否输出日志到各个文件夹
+    :param engine: 压缩引擎
+    """
+    from tqdm import tqdm
+    from tinypng_unlimited import TinyImg
+
+    error_files, permanent, group_count = [], [], 0
+    try:
+        for input_dir, res in TinyImg.compress_stream(groups, engine=engine):
+            group_count += 1
+            tqdm.write('')
+            logger.debug('压缩报告基本信息{}:\n{}', f'({input_dir})' if input_dir else '',
+                         json.dumps(res['basic'], ensure_ascii=False, indent=2))
+
+            # 仅文件夹才输出日志
+            if input_dir is not None and log:
+                log_path = os.path.abspath(os.path.join(input_dir, 'log.json'))
+                with open(log_path, 'w', encoding='utf-8') as f:
+                    json.dump(res, f, ensure_ascii=False, indent=2)
+                logger.success('压缩日志已输出: {}', log_path)
+            error_files += res['error_files']
+            permanent += res.get('permanent_error_files', [])
+    except Exception as e:
+        logger.error(e)
+
+    if not group_count:
+        logger.warning('无任何匹配的图片文件')
+    if len(error_files):  # 存在压缩失败的文件
+        compress_error_files(error_files, engine, permanent)
+
+
 def compress_cover(input_type: str, file_list: list = None, dir_path: str = None,
-                   proxy: str = None, log: bool = False):
+                   proxy: str = None, log: bool = False, engine: str = 'thread', recur: bool = False):
+    from tinypng_unlimited import TinyImg
+
     if input_type == 'dir':
         if not len(dir_path):
             return False
@@ -79,56 +160,65 @@ def compress_cover(input_type: str, file_list: list = None, dir_path: str = None
         logger.info('配置: 使用代理上传图片: {}', proxy)
     if log:
         logger.info('配置: 压缩完成后输出压缩日志文件')
+    if engine != 'thread':
+        logger.info('配置: 使用压缩引擎: {}', engine)
 
-    try:
-        if input_type == 'dir':
-            logger.info('1s后开始对文件夹内图片进行压缩: {}', dir_path)
-            time.sleep(1)
-            res = TinyImg.compress_from_dir(dir_path)
-        else:
-            logger.info('1s后开始对图片列表进行压缩: {}', file_list)
-            time.sleep(1)
-            res = TinyImg.compress_from_file_list(file_list)
-        tqdm.write('')
-        logger.debug('压缩报告基本信息:\n{}', json.dumps(res['basic'], ensure_ascii=False, indent=2))
-
-        # 仅文件夹才输出日志
-        if input_type == 'dir' and log:
-            log_path = os.path.abspath(os.path.join(dir_path, 'log.json'))
-            with open(log_path, 'w', encoding='utf-8') as f:
-                json.dump(res, f, ensure_ascii=False, indent=2)
-            logger.success('压缩日志已输出: {}', log_path)
-
-        if res['basic']['error_count'] > 0:  # 存在压缩失败的文件
-            compress_error_files(res['error_files'])
-
-    except Exception as e:
-        logger.error(e)
+    if input_type == 'dir':
+        if not os.path.isdir(dir_path):
+            logger.error('源文件夹不存在: {}', dir_path)
+            return True
+        logger.info('开始对文件夹内图片进行压缩{}: {}', '(递归子文件夹)' if recur else '', dir_path)
+        groups = TinyImg.walk_dir(dir_path, recur)
+    else:
+        logger.info('开始对图片列表进行压缩: {}', file_list)
+        groups = [(None, file_list, 0)]
+    compress_cover_groups(groups, log, engine)
     return True
 
 
-def compress_cover_dir(dir_path: str, proxy: str = None, log: bool = False):
+def compress_cover_dir(dir_path: str, proxy: str = None, log: bool = False, engine: str = 'thread',
+                       recur: bool = False):
     """
     压缩文件夹内图片（覆盖）
     :param dir_path: 文件夹路径
     :param proxy: 代理地址
     :param log: 是否输出日志到该文件夹
+    :param engine: 压缩引擎
+    :param recur: 是否递归子文件夹
     :return: bool 是否进行了压缩
     """
-    return compress_cover(input_type='dir', dir_path=dir_path, proxy=proxy, log=log)
+    return compress_cover(input_type='dir', dir_path=dir_path, proxy=proxy, log=log, engine=engine, recur=recur)
 
 
-def compress_cover_file_list(file_list: list, proxy: str = None):
+def compress_cover_file_list(file_list: list, proxy: str = None, engine: str = 'thread'):
     """
     压缩文件列表内图片（覆盖）
     :param file_list: 文件路径列表
     :param proxy: 代理地址
+    :param engine: 压缩引擎
     :return: bool 是否进行了压缩
     """
-    return compress_cover(input_type='file_list', file_list=file_list, proxy=proxy)
+    return compress_cover(input_type='file_list', file_list=file_list, proxy=proxy, engine=engine)
+
+
+def iter_task_groups(tasks: dict, recur: bool = False):
+    """
+    将tasks.json内的全部任务展开为compress_stream的分组，文件夹边扫描边产出
+    """
+    from tinypng_unlimited import TinyImg
+
+    if len(tasks.get('file_tasks', [])):
+        yield None, tasks['file_tasks'], 0
+    for dir_task in tasks.get('dir_tasks', []):
+        if not os.path.isdir(dir_task):
+            logger.error('源文件夹不存在: {}', dir_task)
+            continue
+        yield from TinyImg.walk_dir(dir_task, recur)
 
 
 def character_drawing():
+    from tqdm import tqdm
+
     tqdm.write(r'''
   _______             ____  _   ________   __  __      ___           _ __           __
  /_  __(_)___  __  __/ __ \/ | / / ____/  / / / /___  / (_)___ ___  (_) /____  ____/ /
@@ -139,7 +229,9 @@ def character_drawing():
     ''')
 
 
-def check_error_files(proxy=None):
+def check_error_files(proxy=None, engine='thread'):
+    from tinypng_unlimited import TinyImg
+
     path = os.path.abspath(os.path.join(os.path.dirname(cur_file_path), 'error_files.json'))
     old_path = os.path.join(os.path.dirname(path), 'old_error_files.json')
     try:
@@ -149,9 +241,12 @@ def check_error_files(proxy=None):
         return
 
     if isinstance(file_list, list) and len(file_list) > 0:
+        if TinyImg.headless:
+            logger.warning('检测到压缩失败图片路径列表，无界面模式下不做处理: {}', path)
+            return
         if len(input('检测到压缩失败图片路径列表，是否对该列表进行压缩？(输入任意内容则压缩)')):
             os.rename(path, old_path)
-            compress_cover_file_list(file_list, proxy)
+            compress_cover_file_list(file_list, proxy, engine)
             logger.success('文件列表压缩完成')
             character_drawing()
             os.remove(old_path)
@@ -159,38 +254,44 @@ def check_error_files(proxy=None):
 
 
 def command_dir(args):
+    from tqdm import tqdm
+    from tinypng_unlimited import TinyImg
+
     if args.dir is None:
+        if TinyImg.headless:
+            logger.error('无界面模式下请通过-d指定图片文件夹')
+            return
         args.dir = input('输入图片文件夹路径(为空则结束程序):').strip('"')
 
     character_drawing()
-    init(proxy=args.proxy)
-    check_error_files(args.proxy)
+    init(proxy=args.proxy, cache_size=args.cache_size,
+         workers=(args.min_workers, args.max_workers, args.download_workers), resume=args.resume,
+         preserve_stat=args.preserve, timing=args.timing, order=args.order, variants=args.variant,
+         journal=True)  # 只有支持--resume的批量任务才打开（清空）任务日志
+    check_error_files(args.proxy, args.engine)
 
-    while compress_cover_dir(args.dir, args.proxy, args.log):
+    while compress_cover_dir(args.dir, args.proxy, args.log, args.engine, args.recur):
         tqdm.write('=' * 60)
-        if args.recur:
-            # 递归子文件夹
-            for root, dirs, files in os.walk(args.dir):
-                for dir_path in dirs:
-                    dir_path = os.path.join(root, dir_path)
-                    logger.info('正在递归子文件夹: {}', dir_path)
-                    compress_cover_dir(dir_path, args.proxy, args.log)
-                    tqdm.write('=' * 60)
         character_drawing()
+        if TinyImg.headless:  # 无界面模式只压缩指定的文件夹
+            break
         os.system('echo \7')  # 输出到终端时可以发出蜂鸣作为一种提醒
         args.dir = input('输入下一个图片文件夹路径(为空则结束程序):').strip('"')
 
 
 def command_file(args):
     character_drawing()
-    init(proxy=args.proxy)
-    check_error_files(args.proxy)
+    init(proxy=args.proxy, cache_size=args.cache_size, preserve_stat=args.preserve, variants=args.variant)
+    check_error_files(args.proxy, args.engine)
 
-    compress_cover_file_list([args.file], args.proxy)
+    compress_cover_file_list([args.file], args.proxy, args.engine)
     logger.success('文件压缩完成')
 
 
 def command_tasks(args):
+    from tqdm import tqdm
+    from tinypng_unlimited import TinyImg
+
     if os.path.exists(args.path):
         with open(args.path, encoding='utf-8') as f:
             tasks = json.load(f)
@@ -199,46 +300,148 @@ def command_tasks(args):
         return
 
     character_drawing()
-    init(proxy=args.proxy)
-    check_error_files(args.proxy)
-
-    length = 1 if 'file_tasks' in tasks else 0
-    length += len(tasks['dir_tasks']) if 'dir_tasks' in tasks else 0
-    with tqdm(desc='[总体进度]', unit='任务', total=length, file=sys.stdout, ascii=' ▇',
-              colour='magenta', leave=False, ncols=120, position=5) as bar:
-        if 'file_tasks' in tasks:
-            compress_cover_file_list(tasks['file_tasks'], args.proxy)
-            logger.success('文件列表压缩完成')
-            bar.update()
-            character_drawing()
-            os.system('echo \7')  # 输出到终端时可以发出蜂鸣作为一种提醒
-        if 'dir_tasks' in tasks:
-            for dir_task in tasks['dir_tasks']:
-                compress_cover_dir(dir_task, args.proxy, args.log)
-                if args.recur:
-                    # 递归子文件夹
-                    for root, dirs, files in os.walk(dir_task):
-                        for dir_path in dirs:
-                            dir_path = os.path.join(root, dir_path)
-                            logger.info('正在递归子文件夹: {}', dir_path)
-                            compress_cover_dir(dir_path, args.proxy, args.log)
-                logger.success('文件夹列表压缩完成')
-                tqdm.write('=' * 60)
-                bar.update()
-            character_drawing()
+    init(proxy=args.proxy, cache_size=args.cache_size,
+         workers=(args.min_workers, args.max_workers, args.download_workers), resume=args.resume,
+         preserve_stat=args.preserve, timing=args.timing, order=args.order, variants=args.variant,
+         journal=True)  # 只有支持--resume的批量任务才打开（清空）任务日志
+    check_error_files(args.proxy, args.engine)
+
+    if args.proxy:
+        logger.info('配置: 使用代理上传图片: {}', args.proxy)
+    # 文件列表与全部文件夹（含递归子文件夹）共用同一个任务队列
+    compress_cover_groups(iter_task_groups(tasks, args.recur), args.log, args.engine)
+    logger.success('全部任务压缩完成')
+    tqdm.write('=' * 60)
+    character_drawing()
+    if not TinyImg.headless:
         os.system('echo \7')  # 输出到终端时可以发出蜂鸣作为一种提醒
     tqdm.write('')
 
 
+def command_watch(args):
+    from tqdm import tqdm
+    from tinypng_unlimited import TinyImg, DirWatcher
+
+    if not os.path.isdir(args.dir):
+        logger.error('源文件夹不存在: {}', args.dir)
+        return
+
+    character_drawing()
+    init(proxy=args.proxy, cache_size=args.cache_size,
+         workers=(args.min_workers, args.max_workers, args.download_workers),
+         preserve_stat=args.preserve, order=args.order)
+
+    with DirWatcher(args.dir, args.recur, debounce=args.debounce, poll_interval=args.poll_interval,
+                    polling=args.poll) as watcher:
+        logger.info('开始监听文件夹{}: {}', '(递归子文件夹)' if args.recur else '', args.dir)
+        try:
+            for file_list in watcher.batches(args.existing):
+                res = TinyImg.compress_from_file_list(file_list, engine=args.engine)
+                tqdm.write('')
+                logger.debug('压缩报告基本信息:\n{}', json.dumps(res['basic'], ensure_ascii=False, indent=2))
+                if len(res['error_files']):
+                    logger.warning('存在压缩失败图片({})，文件再次修改后重新压缩:\n{}',
+                                   len(res['error_files']), res['error_files'])
+                logger.info('继续监听文件夹: {}', args.dir)
+        except KeyboardInterrupt:
+            logger.info('已停止监听')
+
+
+def command_work(args):
+    from tqdm import tqdm
+    from tinypng_unlimited import TinyImg, WorkQueue
+
+    character_drawing()
+    init(proxy=args.proxy, workers=(args.min_workers, args.max_workers, args.download_workers),
+         preserve_stat=args.preserve, worker=True)
+
+    with WorkQueue(args.queue, args.lease) as queue:
+        logger.info('worker已启动: {}, 任务队列: {}', queue.worker_id, queue.path)
+        for path in args.add:
+            if os.path.isdir(path):
+                added = sum(queue.add(file_list) for _, file_list, _ in TinyImg.walk_dir(path, args.recur))
+            else:
+                added = queue.add([path])
+            logger.info('已加入任务队列: {}个文件 ({})', added, path)
+        if args.retry_failed:
+            logger.info('失败文件已重新加入任务队列: {}', queue.retry_failed())
+
+        error_count = 0
+        try:
+            for res in TinyImg.compress_from_queue(queue, batch_size=args.batch, engine=args.engine):
+                tqdm.write('')
+                logger.debug('压缩报告基本信息:\n{}', json.dumps(res['basic'], ensure_ascii=False, indent=2))
+                error_count += res['basic']['error_count']
+        except Exception as e:
+            logger.error(e)
+
+        logger.info('任务队列状态: {}', queue.counts())
+        if error_count:
+            logger.warning('本worker压缩失败图片数量: {}，可使用--retry-failed重新压缩', error_count)
+    logger.success('任务队列已无可领取的文件，worker退出')
+
+
+def command_serve(args):
+    from tinypng_unlimited import CompressService
+
+    character_drawing()
+    init(proxy=args.proxy, cache_size=args.cache_size,
+         workers=(args.min_workers, args.max_workers, args.download_workers),
+         preserve_stat=args.preserve, journal=False)  # 常驻服务不需要从中断处继续
+    service = CompressService(args.host, args.port, args.engine, os.path.dirname(cur_file_path))
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def command_client(args):
+    from tinypng_unlimited import ServiceClient
+    from tinypng_unlimited.errors import CompressException
+
+    try:
+        client = ServiceClient(args.server, token=args.token, working_dir=os.path.dirname(cur_file_path))
+    except CompressException as e:
+        logger.error('{}: {}', e.msg, e.detail)
+        sys.exit(1)
+    if args.shutdown:
+        client.shutdown()
+        logger.success('已通知压缩服务停止: {}', args.server)
+        return
+    if not args.paths:
+        logger.info('压缩服务状态: {}', json.dumps(client.status(), ensure_ascii=False))
+        return
+
+    job_id = client.submit(args.paths, args.output, args.recur)
+    logger.info('压缩任务已提交: {}', job_id)
+    summary = {}
+    for event in client.events(job_id):
+        if event['event'] == 'done':
+            summary = event
+        elif event['success']:
+            logger.success('图片压缩完成: {}', event['path'])
+        else:
+            logger.error('压缩图片失败: {} {}', event['path'], event['error'])
+    logger.info('压缩任务结束: 成功{}，失败{}', summary.get('success_count', 0), summary.get('error_count', 0))
+    if summary.get('state') != 'done' or summary.get('error_count'):
+        sys.exit(1)
+
+
 def command_apply(args):
+    from tinypng_unlimited import KeyManager
+
     KeyManager.working_dir = os.path.dirname(cur_file_path)
     KeyManager.load_keys()
     KeyManager.apply_store_key(args.num)
 
 
 def command_rearrange(args):
+    from tinypng_unlimited import KeyManager
+
     KeyManager.working_dir = os.path.dirname(cur_file_path)
-    KeyManager.rearrange_keys()
+    KeyManager.load_keys()
+    KeyManager.probe_workers = args.workers
+    KeyManager.rearrange_keys(args.force)
 
 
 def main():
@@ -264,6 +467,93 @@ def main():
         p.add_argument('-p', '--proxy', type=str, help='The proxy used on uploading images.')
         p.add_argument('-r', '--recur', action='store_true', help='Whether to recurse the dir.')
         p.add_argument('-l', '--log', action='store_true', help='Whether to output compression log in images dir.')
+        p.add_argument('--min-workers', type=int, default=2, help='The min number of concurrent uploads.')
+        p.add_argument('--max-workers', type=int, default=8, help='The max number of concurrent uploads.')
+        p.add_argument('--download-workers', type=int, default=4, help='The number of download threads.')
+        p.add_argument('--resume', action='store_true',
+                       help='Continue from where the last run stopped according to journal.jsonl.')
+        p.add_argument('--order', choices=ORDERS, default='largest',
+                       help='Submission order of the images in each dir, "largest" minimizes the total time.')
+        p.add_argument('--timing', action='store_true',
+                       help='Record per-file stage timing and histograms in the compression log.')
+
+    # watch
+    watch_parser = subparsers.add_parser('watch', help='Watch a dir and compress new or modified images.')
+    watch_parser.add_argument('dir', type=str, help='The dir to watch.')
+    watch_parser.add_argument('-p', '--proxy', type=str, help='The proxy used on uploading images.')
+    watch_parser.add_argument('-r', '--recur', action='store_true', help='Whether to watch the sub dirs.')
+    watch_parser.add_argument('--existing', action='store_true',
+                              help='Compress the uncompressed images already in the dir first.')
+    watch_parser.add_argument('--debounce', type=float, default=2.0,
+                              help='Seconds an image must stay unchanged before it is compressed.')
+    watch_parser.add_argument('--poll', action='store_true',
+                              help='Scan the dir periodically instead of using inotify (e.g. on network filesystems).')
+    watch_parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds between scans when polling.')
+    watch_parser.add_argument('--min-workers', type=int, default=2, help='The min number of concurrent uploads.')
+    watch_parser.add_argument('--max-workers', type=int, default=8, help='The max number of concurrent uploads.')
+    watch_parser.add_argument('--download-workers', type=int, default=4, help='The number of download threads.')
+    watch_parser.add_argument('--order', choices=ORDERS, default='largest',
+                              help='Submission order of the images in each batch.')
+    watch_parser.set_defaults(func=command_watch)
+
+    # serve
+    serve_parser = subparsers.add_parser('serve', help='Run a local compression service that keeps keys and '
+                                                       'connections warm between jobs.')
+    serve_parser.add_argument('--host', type=str, default='127.0.0.1', help='The address to listen on.')
+    serve_parser.add_argument('--port', type=int, default=8565, help='The port to listen on.')
+    serve_parser.add_argument('-p', '--proxy', type=str, help='The proxy used on uploading images.')
+    serve_parser.add_argument('--min-workers', type=int, default=2, help='The min number of concurrent uploads.')
+    serve_parser.add_argument('--max-workers', type=int, default=8, help='The max number of concurrent uploads.')
+    serve_parser.add_argument('--download-workers', type=int, default=4, help='The number of download threads.')
+    serve_parser.set_defaults(func=command_serve, no_prompt=True)
+    # client
+    client_parser = subparsers.add_parser('client', help='Compress images through a running local service.')
+    client_parser.add_argument('paths', type=str, nargs='*',
+                               help='Images or dirs to compress, show the service status if empty.')
+    client_parser.add_argument('--server', type=str, default='http://127.0.0.1:8565', help='The service url.')
+    client_parser.add_argument('-r', '--recur', action='store_true', help='Whether to recurse the dirs.')
+    client_parser.add_argument('-o', '--output', type=str, help='The output dir, cover the images if not set.')
+    client_parser.add_argument('--shutdown', action='store_true', help='Stop the service.')
+    client_parser.add_argument('--token', type=str,
+                               help='The service token, read from the service-<port>.token file by default.')
+    client_parser.set_defaults(func=command_client, no_prompt=True)
+
+    # work
+    work_parser = subparsers.add_parser('work', help='Run as a worker claiming images from a shared queue, '
+                                                     'start several workers on one or more hosts.')
+    work_parser.add_argument('queue', type=str,
+                             help='The path of the shared SQLite queue, on a shared filesystem for multiple hosts.')
+    work_parser.add_argument('-a', '--add', type=str, nargs='*', default=[],
+                             help='Dirs or images to add to the queue before working, already queued ones are ignored.')
+    work_parser.add_argument('-p', '--proxy', type=str, help='The proxy used on uploading images.')
+    work_parser.add_argument('-r', '--recur', action='store_true', help='Whether to recurse the dirs to add.')
+    work_parser.add_argument('--min-workers', type=int, default=2, help='The min number of concurrent uploads.')
+    work_parser.add_argument('--max-workers', type=int, default=8, help='The max number of concurrent uploads.')
+    work_parser.add_argument('--download-workers', type=int, default=4, help='The number of download threads.')
+    work_parser.add_argument('--batch', type=int, default=16, help='The number of images claimed at a time.')
+    work_parser.add_argument('--lease', type=float, default=300,
+                             help='Seconds before images claimed by a crashed worker can be claimed again.')
+    work_parser.add_argument('--retry-failed', action='store_true', help='Put the failed images back into the queue.')
+    work_parser.set_defaults(func=command_work)
+
+    for p in dir_parser, file_parser, tasks_parser, watch_parser, serve_parser:
+        p.add_argument('-c', '--cache-size', type=int, default=512,
+                       help='The max size (MB) of the compression result cache, 0 to disable it.')
+
+    for p in dir_parser, file_parser, tasks_parser:
+        p.add_argument('--variant', type=str, action='append', metavar='SPEC',
+                       help='Also produce a resized or converted copy from the same upload, repeatable, '
+                            'e.g. "800x", "800x600:cover", "400x:webp", "webp".')
+
+    for p in dir_parser, file_parser, tasks_parser, watch_parser, work_parser, serve_parser:
+        p.add_argument('-e', '--engine', choices=('thread', 'async'), default='thread',
+                       help='The compression engine, "async" requires aiohttp.')
+        p.add_argument('--preserve', action='store_true',
+                       help='Preserve the mode and mtime of the original images.')
+        p.add_argument('--headless', action='store_true',
+                       help='No progress bars or prompts, print aggregated progress periodically (for CI/cron).')
+        p.add_argument('--progress-interval', type=float, default=5.0,
+                       help='Seconds between aggregated progress lines in headless mode.')
 
     # apply
     apply_parser = subparsers.add_parser('apply', help='Apply TinyPNG API key.')
@@ -274,13 +564,26 @@ def main():
     # rearrange
     apply_parser = subparsers.add_parser('rearrange',
                                          help='Rearrange API keys in keys.json by compression count.')
+    apply_parser.add_argument('-f', '--force', action='store_true',
+                              help='Probe every key, ignoring compression counts recorded in the last 10 minutes.')
+    apply_parser.add_argument('-w', '--workers', type=int, default=16,
+                              help='The number of keys probed concurrently.')
     apply_parser.set_defaults(func=command_rearrange)
 
     args = parser.parse_args()
     if 'func' not in args:
         parser.print_help()
         return
+    headless = getattr(args, 'headless', False)
+    if headless:
+        from tinypng_unlimited import TinyImg
+        TinyImg.set_headless(True, args.progress_interval)
     args.func(args)
+    if headless:
+        logger.complete()  # 等待后台线程写完日志
+        return
+    if getattr(args, 'no_prompt', False):  # 服务与客户端由其他程序调用，不等待输入
+        return
     input('回车退出')
 
 
@@ -1,12 +1,48 @@
-__all__ = ['TinyImg', 'KeyManager']
+__all__ = ['TinyImg', 'KeyManager', 'ResultCache', 'Manifest', 'TinyClient', 'Journal', 'ProgressReporter', 'Timing',
+           'WorkQueue', 'DirWatcher', 'CompressService', 'ServiceClient', 'RetryPolicy', 'Variant']
+
+import importlib
 
 from loguru import logger
-from tqdm import tqdm
 
 # 避免冲突
+LOG_FORMAT = '<level>{time:YYYY-MM-DD HH:mm:ss}\t| {level:9}| {message}</level>'
+
+
+def _tqdm_sink(msg):
+    from tqdm import tqdm  # 首次输出日志时才导入
+    tqdm.write(msg, end='')
+
+
 logger.remove()
-logger.add(lambda msg: tqdm.write(msg, end=''), colorize=True,
-           format='<level>{time:YYYY-MM-DD HH:mm:ss}\t| {level:9}| {message}</level>')
+logger.add(_tqdm_sink, colorize=True, format=LOG_FORMAT)
+
+# 导出名称 -> 子模块，首次访问时才导入，import本包时不载入requests、tinify等依赖
+_MODULES = {
+    'TinyImg': 'tiny_img',
+    'KeyManager': 'key_manager',
+    'ResultCache': 'result_cache',
+    'Manifest': 'manifest',
+    'TinyClient': 'tiny_client',
+    'Journal': 'journal',
+    'ProgressReporter': 'progress',
+    'Timing': 'timing',
+    'WorkQueue': 'work_queue',
+    'DirWatcher': 'watcher',
+    'CompressService': 'service',
+    'ServiceClient': 'service',
+    'RetryPolicy': 'retry',
+    'Variant': 'variant',
+}
+
+
+def __getattr__(name):
+    if name not in _MODULES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'{__name__}.{_MODULES[name]}'), name)
+    globals()[name] = value
+    return value
+
 
-from tinypng_unlimited.tiny_img import TinyImg
-from tinypng_unlimited.key_manager import KeyManager
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,391 @@
+import asyncio
+import os
+import sys
+from collections import Counter
+
+import aiohttp
+from loguru import logger
+
+from tinypng_unlimited.errors import CompressException
+from tinypng_unlimited.journal import Journal
+from tinypng_unlimited.manifest import Manifest
+from tinypng_unlimited.report import Report
+from tinypng_unlimited.result_cache import ResultCache
+from tinypng_unlimited.tiny_client import TinyClient
+from tinypng_unlimited.timing import Timing, FileTiming
+from tinypng_unlimited.tiny_img import TinyImg
+from tinypng_unlimited.variant import Variant
+
+
+class AsyncTinyImg:
+    """
+    基于asyncio的压缩引擎，单线程内同时维持大量上传下载，
+    密钥、压缩次数、临时文件夹等状态与TinyImg共享
+    """
+
+    @classmethod
+    async def upload(cls, session: aiohttp.ClientSession, data: bytes, timeout=60, client: TinyClient = None) -> str:
+        """
+        上传图片，返回云端压缩后图片链接
+        :param session: aiohttp会话
+        :param data: 图片内容
+        :param timeout: 服务器响应超时时间
+        :param client: 已预留压缩次数的客户端，压缩次数只更新到该客户端，默认为当前客户端
+        """
+        client = client or TinyImg.get_client()
+        auth = aiohttp.BasicAuth('api', client.key)
+        async with session.post(f'{client.api_endpoint}/shrink', data=data, auth=auth, proxy=TinyImg.proxy,
+                                timeout=aiohttp.ClientTimeout(sock_read=timeout)) as res:
+            client.update_count(res.headers.get('compression-count'))
+            if res.status == 429:
+                client.too_many_requests(res.headers)
+            if res.status != 201:
+                raise CompressException('云端压缩失败', {'status': res.status, 'text': await res.text()})
+            return res.headers.get('location')
+
+    @classmethod
+    async def to_file_save(cls, session: aiohttp.ClientSession, path, url, timeout=30, src=None,
+                           timing: FileTiming = None, options: dict = None, client: TinyClient = None):
+        """
+        下载压缩后的图片，写入文件交由线程执行以免阻塞事件循环
+        :param session: aiohttp会话
+        :param path: 路径
+        :param url: 图片下载链接
+        :param timeout: 下载超时
+        :param src: 源文件路径，开启preserve_stat时从该文件复制权限与修改时间
+        :param timing: 分阶段计时，记录download与write阶段
+        :param options: 调整尺寸、转换格式的参数，不为None时以client的密钥请求衍生图片
+        :param client: 请求衍生图片的客户端，压缩次数只更新到该客户端
+        """
+        timeout = aiohttp.ClientTimeout(sock_read=timeout)
+        if options is None:
+            request = session.get(url, proxy=TinyImg.proxy, timeout=timeout)
+        else:
+            request = session.post(url, json=options, auth=aiohttp.BasicAuth('api', client.key),
+                                   proxy=TinyImg.proxy, timeout=timeout)
+        async with request as res:
+            if options is not None:
+                client.update_count(res.headers.get('compression-count'))
+                if res.status == 429:
+                    client.too_many_requests(res.headers)
+            res.raise_for_status()
+            data = await res.read()
+        if timing is not None:
+            timing.lap('download', len(data))
+        await asyncio.to_thread(cls._write_file, path, data, src)
+        if timing is not None:
+            timing.lap('write')
+
+    @staticmethod
+    def _write_file(path, data: bytes, src=None):
+        tmp_path = TinyImg._tmp_path(path)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.write(b'tiny')
+            TinyImg._finish_file(tmp_path, path, src)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def _read_file(path) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    @classmethod
+    async def download_variant(cls, session: aiohttp.ClientSession, variant: Variant, new_path, url, timeout=30,
+                               client: TinyClient = None, src=None) -> int:
+        """
+        对云端压缩后的图片请求一个衍生图片并保存
+        :param client: 请求使用的客户端，应与上传时相同
+        :return: 衍生图片大小
+        """
+        path = variant.path(new_path)
+        client = client or TinyImg.get_client()
+        if not await asyncio.to_thread(client.reserve):  # 次数未知时需要联网验证
+            raise CompressException('指定密钥的压缩次数已用完', {'path': src, 'key': client.key})
+        try:
+            await cls.to_file_save(session, path, url, timeout, src, options=variant.options(), client=client)
+        finally:
+            client.release()
+        Manifest.record(path)
+        logger.success('衍生图片已生成[{}]: {}', variant.name, os.path.basename(path))
+        return os.path.getsize(path)
+
+    @classmethod
+    async def download_variants(cls, session: aiohttp.ClientSession, variants, new_path, url, timeout=30,
+                                client: TinyClient = None, src=None) -> list:
+        """
+        由同一个图片链接并发请求多个衍生图片，各自按TinyImg.retry_policy重试
+        :return: 各衍生图片大小
+        """
+        policy = TinyImg.retry_policy
+
+        async def fetch(variant: Variant) -> int:
+            retry = waits = 0
+            while True:
+                try:
+                    policy.before(url, retry == waits == 0)
+                    size = await cls.download_variant(session, variant, new_path, url, timeout, client, src)
+                    policy.success(url)
+                    return size
+                except Exception as e:
+                    if policy.counts(e):
+                        retry += 1
+                    else:
+                        waits += 1
+                    delay = policy.next_delay(e, retry, url, waits)
+                    if delay is None:
+                        raise TinyImg.variant_error(src or new_path, variant, e)
+                    await asyncio.sleep(delay)
+                    if not policy.counts(e):
+                        continue
+                    logger.warning('重试衍生图片[{}](第{}次，已等待{:.1f}s): {}, 错误信息: {}',
+                                   variant.name, retry, delay, os.path.basename(new_path), e)
+
+        res = await asyncio.gather(*map(fetch, variants), return_exceptions=True)
+        for r in res:
+            if isinstance(r, BaseException):
+                raise r
+        return res
+
+    @classmethod
+    async def compress_from_file(cls, session: aiohttp.ClientSession, path, new_path, check_compressed=True,
+                                 upload_timeout=None, download_timeout=None, timing: FileTiming = None,
+                                 on_retry=None, variants=()) -> tuple:
+        """
+        压缩图片文件
+        :param session: aiohttp会话
+        :param path: 文件路径
+        :param new_path: 新文件路径
+        :param check_compressed: 是否检查压缩标记
+        :param upload_timeout: 上传响应超时时间，默认60s
+        :param download_timeout: 下载响应超时时间，默认30s
+        :param timing: 分阶段计时，上传阶段包含云端压缩耗时
+        :param on_retry: 每次重试时的回调on_retry(第几次重试，上次的错误，等待的时间，重试的阶段: upload/download)
+        :param variants: 需要生成的衍生图片，压缩后的图片下载完成后由同一个图片链接并发请求
+        :return: (文件名，旧大小，新大小，压缩到原来的百分比，结果来源: marked/cache/upload)
+        """
+        upload_timeout = 60 if upload_timeout is None else upload_timeout
+        download_timeout = 30 if download_timeout is None else download_timeout
+        old_size, compressed = await asyncio.to_thread(TinyImg.check_file, path, check_compressed)
+        file_name = os.path.basename(path)
+        if compressed:
+            logger.info('图片已带有压缩标记，不做压缩处理: {}', file_name)
+            Manifest.record(path)
+            return file_name, old_size, old_size, '100.0%', 'marked'
+
+        try:
+            data = await asyncio.to_thread(cls._read_file, path)
+            digest = await asyncio.to_thread(ResultCache.file_digest, path) if ResultCache.enabled else None
+        except OSError as e:
+            raise TinyImg.read_error(path, e)
+        if digest is not None:
+            fresh = all(os.path.exists(v.path(new_path)) for v in variants)  # 有衍生图片尚未生成时必须上传
+            if fresh and await asyncio.to_thread(ResultCache.get, digest, new_path, TinyImg._tmp_path(new_path)):
+                logger.info('命中压缩结果缓存，跳过上传: {}', file_name)
+                Manifest.record(new_path)
+                new_size = os.path.getsize(new_path)
+                return file_name, old_size, new_size, f'{round(100 * new_size / old_size, 2)}%', 'cache'
+        if timing is not None:
+            timing.lap('prepare')
+
+        url = Journal.uploaded_url(path, old_size)  # 上次中断前已上传则直接下载
+        client = TinyImg.get_client()
+        policy = TinyImg.retry_policy
+        retry = waits = 0
+        reuploaded = False
+        while True:
+            endpoint = f'{TinyImg.API_ENDPOINT}/shrink' if url is None else url  # 上传与下载分别使用各自的熔断器
+            try:
+                policy.before(endpoint, retry == waits == 0)
+                if url is None:
+                    # 预留压缩次数，次数不足时需要切换密钥并联网验证，交由线程执行
+                    client = await asyncio.to_thread(TinyImg.reserve_client)
+                    if timing is not None:
+                        timing.lap('wait')
+                    logger.info('正在上传图片至云端压缩[{}]: {}', TinyImg._byte_converter(old_size), file_name)
+                    try:
+                        url = await cls.upload(session, data, upload_timeout, client)
+                    finally:
+                        client.release()
+                    if timing is not None:
+                        timing.lap('upload', old_size)
+                    Journal.record(path, Journal.UPLOADED, url=url, size=old_size)
+                    logger.success('云端压缩成功，正在下载: {}', file_name)
+                # 下载失败时保留图片链接，重试时只重新下载
+                await cls.to_file_save(session, new_path, url, download_timeout, path, timing)
+                if digest is not None:
+                    await asyncio.to_thread(ResultCache.put, digest, new_path)
+                Manifest.record(new_path)
+                if timing is not None:
+                    timing.lap('finalize')
+                policy.success(endpoint)
+                new_size = os.path.getsize(new_path)
+                break
+            except Exception as e:
+                if url is not None and not reuploaded and TinyImg.is_expired(e):
+                    logger.warning('云端图片已过期，重新上传: {}', file_name)
+                    policy.success(endpoint)  # 服务器正常响应
+                    url, reuploaded = None, True
+                    continue
+                if policy.counts(e):
+                    retry += 1
+                else:
+                    waits += 1
+                delay = policy.next_delay(e, retry, endpoint, waits)
+                if delay is None:
+                    raise TinyImg.retry_error(path, e, retry - 1 if policy.counts(e) else retry)
+                await asyncio.sleep(delay)
+                if not policy.counts(e):
+                    continue
+                stage = 'upload' if url is None else 'download'
+                if timing is not None:
+                    timing.lap('retry')
+                logger.warning('重试{}图片(第{}次，已等待{:.1f}s): {}, 错误信息: {}',
+                               '上传' if stage == 'upload' else '下载', retry, delay, file_name, e)
+                if on_retry is not None:
+                    on_retry(retry, e, delay, stage)
+        await cls.download_variants(session, variants, new_path, url, download_timeout, client, path)
+        return file_name, old_size, new_size, f'{round(100 * new_size / old_size, 2)}%', 'upload'
+
+    @classmethod
+    async def compress_coalesced(cls, session: aiohttp.ClientSession, path, new_path, flights: dict, hashed: bool,
+                                 upload_timeout=None, download_timeout=None, timing: FileTiming = None,
+                                 on_retry=None, variants=()) -> tuple:
+        """
+        压缩图片文件，批次内相同内容的文件只上传一次
+        :param flights: 批次内共享，哈希 -> 相同内容首个任务的输出文件路径，该任务失败或没有输出时为None
+        :param hashed: 批次内是否有相同大小的文件，有才计算哈希参与合并
+        :return: (文件名，旧大小，新大小，压缩到原来的百分比，结果来源: marked/cache/upload/dedup)
+        """
+        digest = flight = None
+        if hashed:
+            # 哈希只在该文件自己的任务中计算，任何任务写入输出之前完成
+            try:
+                digest = await asyncio.to_thread(ResultCache.file_digest, path)
+            except OSError as e:
+                raise TinyImg.read_error(path, e)
+        while digest is not None and digest in flights:
+            output = await flights[digest]
+            if output is None:  # 相同内容的任务失败，第一个发现的任务代替其上传
+                continue
+            try:
+                old_size = os.path.getsize(path)
+                new_size = await asyncio.to_thread(TinyImg.reuse_output, output, new_path, path, variants)
+            except Exception as e:
+                raise CompressException('复用压缩结果失败', {'path': path, 'err': e})
+            if timing is not None:
+                timing.lap('coalesce')
+            logger.info('复用批次内相同内容图片的压缩结果，节省一次上传: {}', os.path.basename(path))
+            return os.path.basename(path), old_size, new_size, f'{round(100 * new_size / old_size, 2)}%', 'dedup'
+        if digest is not None:
+            flight = flights[digest] = asyncio.get_running_loop().create_future()
+        info = None
+        try:
+            info = await cls.compress_from_file(session, path, new_path, True, upload_timeout, download_timeout,
+                                                timing, on_retry, variants)
+            return info
+        finally:
+            if flight is not None:
+                output = None if info is None or info[4] == 'marked' else new_path
+                if output is None:  # 没有可复用的输出，等待的任务各自压缩
+                    del flights[digest]
+                flight.set_result(output)
+
+    @classmethod
+    async def compress_from_file_list_async(cls, file_list, new_dir=None, upload_timeout=None,
+                                            download_timeout=None, concurrency=64, variants=()) -> dict:
+        """
+        批量压缩多个文件
+        :param file_list: 文件路径列表
+        :param new_dir: 输出文件夹
+        :param upload_timeout: 上传响应超时时间，默认60s
+        :param download_timeout: 下载响应超时时间，默认30s
+        :param concurrency: 同时进行的压缩任务数
+        :param variants: 每个文件需要生成的衍生图片
+        :return: 压缩情况报告
+        """
+        if new_dir and not os.path.exists(new_dir):
+            os.makedirs(new_dir)
+
+        file_num = len(file_list)
+        report = Report(file_num, new_dir)
+        logger.info('待压缩图片数量: {}, 并发数: {}', file_num, concurrency)
+
+        semaphore = asyncio.Semaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        # 全部文件预先已知，出现相同大小的文件才计算哈希合并相同内容
+        sizes = {}
+        for path in file_list:
+            try:
+                sizes[path] = os.path.getsize(path)
+            except OSError:  # 交由压缩时报错
+                pass
+        size_counts = Counter(sizes.values())
+        flights = {}
+
+        async def worker(old_path):
+            # 默认下覆盖原文件
+            new_path = os.path.abspath(os.path.join(new_dir, os.path.basename(old_path))) if new_dir else old_path
+            timing = Timing.new(old_path)
+            retries = avoided = 0
+
+            def on_retry(n, e, delay, stage):
+                nonlocal retries, avoided
+                retries = n
+                if stage == 'download':
+                    avoided += 1
+
+            async with semaphore:
+                if timing is not None:
+                    timing.lap('queue')
+                Journal.record(old_path, Journal.PENDING)
+                try:
+                    hashed = size_counts[sizes.get(old_path)] > 1
+                    info = await cls.compress_coalesced(session, old_path, new_path, flights, hashed,
+                                                        upload_timeout, download_timeout, timing, on_retry,
+                                                        variants)
+                    Journal.record(old_path, Journal.WRITTEN)
+                except Exception as e:
+                    Journal.record(old_path, Journal.FAILED, err=str(e))
+                    info = e
+                if timing is not None:
+                    report.add_timing(timing, not isinstance(info, Exception))
+                report.add_retries(old_path, retries, avoided)
+                return old_path, info
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            with TinyImg.task_bar(desc='[任务进度]', unit='份', total=file_num, file=sys.stdout, ascii=' ▇',
+                                  colour='yellow', leave=False, ncols=120) as bar:
+                for task in asyncio.as_completed([worker(path) for path in file_list]):
+                    path, info = await task
+                    if isinstance(info, CompressException):
+                        report.add_error(info.detail['path'], info.detail.get('permanent', False))
+                        logger.error('压缩图片失败: {} {}', os.path.basename(info.detail['path']), info)
+                    elif isinstance(info, Exception):
+                        report.add_error(path)
+                        logger.error('压缩图片未知错误: {} {}', os.path.basename(path), info)
+                    else:
+                        report.add_success(info)
+                        if info[4] == 'upload':
+                            report.variant_count += len(variants)
+                        logger.success('图片压缩完成: {}', info[0])
+                    bar.update()
+
+        ResultCache.flush()
+        Manifest.flush()
+        Journal.flush()
+        report.extra['retry'] = TinyImg.retry_policy.stats()
+        return report.to_dict()
+
+    @classmethod
+    def compress_from_file_list(cls, file_list, new_dir=None, upload_timeout=None, download_timeout=None,
+                                concurrency=64, variants=()) -> dict:
+        """
+        compress_from_file_list_async的同步入口，参数与返回值相同
+        """
+        return asyncio.run(cls.compress_from_file_list_async(file_list, new_dir, upload_timeout,
+                                                             download_timeout, concurrency, variants))
@@ -0,0 +1,139 @@
+from threading import Lock
+
+
+class Coalescer:
+    """
+    批次内相同内容的文件只上传一次：先按文件大小筛选，出现过相同大小才计算哈希，
+    相同内容正在上传时等待其结果，已完成则直接复用其输出文件；
+    哈希只由持有该文件的任务线程计算。某大小的首个任务可能在出现相同大小之前已不计算哈希开始上传，
+    此时相同大小的任务先等待，由首个任务的线程在上传完成后、写入输出之前补算哈希，
+    首个任务已完成且未覆盖源文件时才由相同大小的任务补算
+    """
+    LEADER = 'leader'  # 由该任务上传
+    FOLLOWER = 'follower'  # 相同内容正在上传，等待其完成
+    DONE = 'done'  # 相同内容已完成，可直接复用
+    WAITING = 'waiting'  # 相同大小的首个任务未计算哈希且正在上传，等待其补算哈希
+    CHECK = 'check'  # 相同大小的首个任务未计算哈希且已完成，源文件未被覆盖，需补算其哈希
+
+    def __init__(self):
+        self._lock = Lock()
+        self._sizes = {}  # 文件大小 -> 该大小的首个任务
+        self._flights = {}  # 哈希 -> 等待中的任务列表
+        self._done = {}  # 哈希 -> 已完成的输出文件路径
+        self._unhashed = {}  # 未计算哈希即开始上传的任务 -> 等待其补算哈希的相同大小任务
+        self._finished = {}  # 未计算哈希即已成功完成、源文件未被覆盖的任务 -> 输出文件路径
+
+    def check_size(self, size, job):
+        """
+        记录文件大小，出现相同大小时标记该大小的首个任务与当前任务需要计算哈希
+        """
+        with self._lock:
+            first = self._sizes.setdefault(size, job)
+            if first is not job:
+                first.same_size = job.same_size = True
+
+    def first(self, size):
+        """
+        该大小的首个任务
+        """
+        with self._lock:
+            return self._sizes.get(size)
+
+    def dispatch(self, job) -> bool:
+        """
+        大小唯一的任务开始上传前调用
+        :return: 是否可以不计算哈希直接上传，已出现相同大小时为False
+        """
+        with self._lock:
+            if job.same_size:
+                return False
+            self._unhashed[job] = []
+            return True
+
+    def collided(self, job) -> bool:
+        """
+        未计算哈希即开始上传的任务上传期间是否出现了相同大小的文件
+        """
+        with self._lock:
+            return job in self._unhashed and job.same_size
+
+    def adopt(self, digest, job) -> list:
+        """
+        补记未计算哈希即开始上传的任务：正在上传则成为该哈希的上传代表，已成功完成则记录其输出文件
+        :param digest: 已完成的任务无法补算哈希时为None，不再参与合并
+        :return: 等待其补算哈希但需要重新提交的任务（内容不同，或相同内容已完成可直接复用）
+        """
+        with self._lock:
+            if job in self._finished:
+                new_path = self._finished.pop(job)
+                if digest is not None:
+                    self._done.setdefault(digest, new_path)
+                return []
+            waiters = self._unhashed.pop(job, [])
+            if digest in self._done:
+                return waiters
+            if digest not in self._flights:
+                job.fingerprint, job.leader = digest, True
+                self._flights[digest] = []
+            self._flights[digest] += [w for w in waiters if w.fingerprint == digest]
+            return [w for w in waiters if w.fingerprint != digest]
+
+    def settle(self, job, new_path=None) -> tuple:
+        """
+        任务完成时调用
+        :param new_path: 成功且未覆盖源文件时的输出文件路径，否则为None
+        :return: (是否为上传代表, 等待其补算哈希的任务)
+        """
+        with self._lock:
+            if job not in self._unhashed:
+                return job.leader, []
+            waiters = self._unhashed.pop(job)
+            if new_path is not None:
+                self._finished[job] = new_path
+            return job.leader, waiters
+
+    def join(self, digest, job) -> str:
+        """
+        以内容哈希加入批次
+        :return: LEADER、FOLLOWER、DONE、WAITING或CHECK
+        """
+        with self._lock:
+            if digest in self._done:
+                return self.DONE
+            followers = self._flights.get(digest)
+            if followers is not None:
+                followers.append(job)
+                return self.FOLLOWER
+            first = self._sizes.get(job.old_size)
+            if first is not None and first is not job:
+                if first in self._unhashed:
+                    self._unhashed[first].append(job)
+                    return self.WAITING
+                if first in self._finished:
+                    return self.CHECK
+            self._flights[digest] = []
+            return self.LEADER
+
+    def result(self, digest) -> str:
+        """
+        已完成内容的输出文件路径
+        """
+        with self._lock:
+            return self._done.get(digest)
+
+    def finish(self, digest, new_path) -> list:
+        """
+        上传任务成功，记录输出文件
+        :return: 等待该结果的任务
+        """
+        with self._lock:
+            self._done[digest] = new_path
+            return self._flights.pop(digest, [])
+
+    def fail(self, digest) -> list:
+        """
+        上传任务失败，等待的任务需要重新上传
+        :return: 等待该结果的任务
+        """
+        with self._lock:
+            return self._flights.pop(digest, [])
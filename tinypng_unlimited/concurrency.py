@@ -0,0 +1,108 @@
+import time
+from threading import Condition
+
+from loguru import logger
+
+
+class ConcurrencyController:
+    """
+    AIMD并发控制：每个统计窗口内吞吐量仍在提升则并发数加一，
+    出现超时、429或延迟明显升高则并发数减半
+    """
+
+    def __init__(self, min_workers=2, max_workers=8, initial=None):
+        """
+        :param min_workers: 最小并发数
+        :param max_workers: 最大并发数（线程池大小）
+        :param initial: 初始并发数，默认为4并限制在上下限之间
+        """
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        initial = 4 if initial is None else initial
+        self.limit = min(max(initial, self.min_workers), self.max_workers)
+        self.history = []  # [(距开始的秒数, 并发数, 原因)]
+        self._active = 0
+        self._cond = Condition()
+        self._start = time.time()
+        self._last_throughput = 0.0
+        self._best_latency = None
+        self._reset_window()
+        self._record('初始值')
+
+    def _reset_window(self):
+        self._window_start = time.time()
+        self._window_bytes = 0
+        self._window_latency = 0.0
+        self._window_count = 0
+
+    def _record(self, reason):
+        self.history.append((round(time.time() - self._start, 2), self.limit, reason))
+
+    def _set_limit(self, limit, reason):
+        limit = min(max(limit, self.min_workers), self.max_workers)
+        if limit != self.limit:
+            logger.info('并发数调整: {} -> {} ({})', self.limit, limit, reason)
+            self.limit = limit
+            self._record(reason)
+            self._cond.notify_all()
+        self._reset_window()
+
+    def acquire(self):
+        """
+        等待空闲并发名额
+        """
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, size=0, latency=0.0):
+        """
+        归还并发名额并统计本次传输
+        :param size: 传输字节数
+        :param latency: 耗时(s)
+        """
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+            if not size:
+                return
+            self._window_bytes += size
+            self._window_latency += latency
+            self._window_count += 1
+            if self._window_count < self.limit:  # 每个窗口至少完成与并发数相同的文件数
+                return
+
+            throughput = self._window_bytes / max(time.time() - self._window_start, 1e-6)
+            latency = self._window_latency / self._window_bytes  # 每字节耗时，排除文件大小差异
+            if self._best_latency is None or latency < self._best_latency:
+                self._best_latency = latency
+
+            if latency > self._best_latency * 2 and throughput <= self._last_throughput:
+                self._set_limit(self.limit // 2, '延迟升高')
+            elif throughput > self._last_throughput * 1.05:
+                self._set_limit(self.limit + 1, '吞吐量提升')
+            else:
+                self._reset_window()
+            self._last_throughput = throughput
+
+    def congested(self, e: Exception):
+        """
+        遇到拥塞类错误时并发数减半
+        """
+        if not self.is_congestion(e):
+            return
+        with self._cond:
+            self._set_limit(self.limit // 2, '请求过多' if getattr(e, 'status', None) == 429 else '超时或连接错误')
+            self._last_throughput = 0.0
+
+    @staticmethod
+    def is_congestion(e: Exception) -> bool:
+        """
+        超时、连接错误以及429视为拥塞
+        """
+        import requests  # 载入较慢，用到时才导入（此时通常已由客户端载入）
+        import tinify
+        if isinstance(e, (requests.Timeout, requests.ConnectionError, tinify.ConnectionError)):
+            return True
+        return getattr(e, 'status', None) == 429
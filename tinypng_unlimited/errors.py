@@ -46,3 +46,12 @@ class CompressException(CustomException):
 
     def __init__(self, msg: str, detail: Any = None):
         super().__init__('压缩图片相关错误', msg, detail)
+
+
+class CircuitOpenException(CustomException):
+    """
+    api熔断期间请求直接失败
+    """
+
+    def __init__(self, msg: str, detail: Any = None):
+        super().__init__('api熔断', msg, detail)
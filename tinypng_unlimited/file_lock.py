@@ -0,0 +1,75 @@
+import os
+import time
+from threading import RLock
+
+
+class FileLock:
+    """
+    跨进程的建议性文件锁，多个进程（或共享文件系统上的多台机器）读写同一文件前加锁，
+    同一进程内可重入，线程之间互斥
+    """
+
+    def __init__(self, path):
+        """
+        :param path: 锁文件路径，不存在时自动创建
+        """
+        self.path = os.path.abspath(path)
+        self._lock = RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                self._file = open(self.path, 'a+b')
+                self._lock_file(self._file)
+            except BaseException:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._lock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            try:
+                self._unlock_file(self._file)
+            finally:
+                self._file.close()
+                self._file = None
+        self._lock.release()
+
+    @staticmethod
+    def _lock_file(f):
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)  # 约10s后仍未获得锁会抛出异常，继续等待
+                    return
+                except OSError:
+                    time.sleep(0.1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    @staticmethod
+    def _unlock_file(f):
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,168 @@
+import json
+import os
+import time
+from threading import RLock, Thread, Event
+
+from loguru import logger
+
+
+class Journal:
+    """
+    批量压缩任务日志，逐行追加记录每个文件的状态（待压缩、已上传、已写入、失败），
+    进程中途退出后可据此从中断处继续：已写入的文件直接跳过，已上传的文件直接使用图片链接下载。
+    每条记录立即写入文件，进程被杀死也不丢失；同步磁盘（防止断电丢失）按条数与时间批量进行
+    """
+    PENDING = 'pending'
+    UPLOADED = 'uploaded'
+    WRITTEN = 'written'
+    FAILED = 'failed'
+
+    _lock: RLock = RLock()
+    _states: dict = {}  # 源文件绝对路径 -> 最新一条记录
+    _file = None
+    _unsynced: int = 0  # 尚未同步到磁盘的记录数
+    _last_sync: float = 0.0
+    _stop: Event = None  # 停止后台定时同步
+    enabled: bool = False
+    path: str
+    sync_count: int = 256
+    sync_interval: float = 1.0
+
+    @classmethod
+    def init(cls, working_dir, resume=False, sync_count=256, sync_interval=1.0):
+        """
+        打开任务日志
+        :param working_dir: 工作目录，日志保存为其下的journal.jsonl
+        :param resume: 是否载入上次的日志继续压缩，否则清空日志
+        :param sync_count: 累计多少条记录同步一次磁盘
+        :param sync_interval: 距上次同步超过多少秒时同步磁盘，没有新记录时由后台线程按此间隔同步
+        """
+        with cls._lock:
+            cls.close()
+            cls.path = os.path.abspath(os.path.join(working_dir, 'journal.jsonl'))
+            cls.sync_count, cls.sync_interval = max(1, sync_count), sync_interval
+            cls._states = cls._load() if resume else {}
+            if resume:
+                cls._compact()
+                counts = {}
+                for entry in cls._states.values():
+                    counts[entry['state']] = counts.get(entry['state'], 0) + 1
+                logger.info('任务日志已载入: {}', counts or '无记录')
+            cls._file = open(cls.path, 'a' if resume else 'w', encoding='utf-8')
+            cls._unsynced, cls._last_sync = 0, time.time()
+            cls.enabled = True
+            cls._stop = Event()
+            Thread(target=cls._sync_loop, args=(cls._stop,), daemon=True).start()
+
+    @classmethod
+    def _sync_loop(cls, stop: Event):
+        while not stop.wait(cls.sync_interval):
+            cls.flush()
+
+    @classmethod
+    def _load(cls) -> dict:
+        states = {}
+        try:
+            with open(cls.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # 进程退出时未写完的最后一行
+                        continue
+                    states[entry['path']] = entry
+        except FileNotFoundError:
+            pass
+        return states
+
+    @classmethod
+    def _compact(cls):
+        """
+        每个文件只保留最新一条记录重写日志，避免多次中断后日志不断增长
+        """
+        tmp_path = cls.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in cls._states.values():
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, cls.path)
+
+    @classmethod
+    def record(cls, path, state, **extra):
+        """
+        追加一条文件状态记录并立即写入文件，按条数与时间批量同步磁盘
+        :param path: 源文件路径
+        :param state: 文件状态
+        :param extra: 附加信息，如图片链接、错误信息
+        """
+        if not cls.enabled:
+            return
+        entry = {'path': os.path.abspath(path), 'state': state, **extra}
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with cls._lock:
+            old = cls._states.get(entry['path'])
+            if state == cls.PENDING and old is not None and old['state'] == cls.UPLOADED:
+                return  # 保留上次的图片链接，继续时直接下载
+            cls._states[entry['path']] = entry
+            cls._file.write(line)
+            cls._file.flush()  # 写入操作系统，进程崩溃也不丢失
+            cls._unsynced += 1
+            if cls._unsynced >= cls.sync_count or time.time() - cls._last_sync >= cls.sync_interval:
+                cls._sync()
+
+    @classmethod
+    def _sync(cls):
+        os.fsync(cls._file.fileno())
+        cls._unsynced, cls._last_sync = 0, time.time()
+
+    @classmethod
+    def get(cls, path) -> dict:
+        """
+        文件的最新记录，无记录返回None
+        """
+        if not cls.enabled:
+            return None
+        return cls._states.get(os.path.abspath(path))
+
+    @classmethod
+    def uploaded_url(cls, path, size) -> str:
+        """
+        已上传未写入文件的图片链接，源文件大小已改变或无记录时返回None
+        """
+        entry = cls.get(path)
+        if entry is None or entry['state'] != cls.UPLOADED or entry.get('size') != size:
+            return None
+        return entry['url']
+
+    @classmethod
+    def skip_written(cls, file_list) -> tuple:
+        """
+        过滤日志中已写入的文件
+        :return: (剩余文件路径列表，跳过数量)
+        """
+        if not cls.enabled:
+            return file_list, 0
+        remaining = [path for path in file_list
+                     if (cls.get(path) or {}).get('state') != cls.WRITTEN]
+        return remaining, len(file_list) - len(remaining)
+
+    @classmethod
+    def flush(cls):
+        """
+        将未同步的记录同步到磁盘
+        """
+        with cls._lock:
+            if cls.enabled and cls._unsynced:
+                cls._sync()
+
+    @classmethod
+    def close(cls):
+        with cls._lock:
+            if cls._stop is not None:
+                cls._stop.set()
+                cls._stop = None
+            if cls._file is not None:
+                cls.flush()
+                cls._file.close()
+                cls._file = None
+            cls.enabled = False
@@ -1,27 +1,41 @@
 import json
 import os
 import re
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from threading import Lock
 
-import requests
 from loguru import logger
-from requests import Timeout
 
 from tinypng_unlimited.errors import SnapMailException, ApplyKeyException
+from tinypng_unlimited.file_lock import FileLock
+from tinypng_unlimited.retry import RetryPolicy
 from tinypng_unlimited.snapmail import SnapMail
+from tinypng_unlimited.tiny_client import TinyClient
 
 
 class KeyManager:
     working_dir: str
+    _file_lock: FileLock = None
+    _file_sig: tuple = None  # 上次读取或写入后keys.json的(inode, 大小, 修改时间)，未变化时不再重新读取
+    _apply_lock = Lock()  # 同一进程内只有一个线程申请新密钥
+    count_ttl: float = 600  # 记录的压缩次数的有效期(s)，有效期内载入密钥与重新排列时不再联网验证
+    probe_workers: int = 16  # 重新排列时并发请求压缩次数的线程数
+    API_ENDPOINT = 'https://api.tinify.com'
+    retry_policy = RetryPolicy(retries=3, base_delay=0.5, max_delay=5)  # 获取压缩次数与生成密钥的重试策略
 
     class Keys:
         available: list
         unavailable: list
+        counts: dict  # 密钥 -> [压缩次数（密钥无效为None）, 记录时间]
 
         @classmethod
         def load(cls, obj: dict):
             cls.available = obj['available'] if 'available' in obj else []
             cls.unavailable = obj['unavailable'] if 'unavailable' in obj else []
+            cls.counts = obj['counts'] if 'counts' in obj else {}
 
     @classmethod
     def init(cls, working_dir):
@@ -34,94 +48,250 @@ class KeyManager:
             logger.warning('当前可用密钥少于3条，优先申请新密钥')
             cls.apply_store_key()
 
+    @classmethod
+    def locked(cls) -> FileLock:
+        """
+        keys.json的跨进程锁，多个进程（或共享工作目录的多台机器）读取-修改-保存密钥时需持有
+        """
+        path = os.path.abspath(os.path.join(cls.working_dir, 'keys.json.lock'))
+        if cls._file_lock is None or cls._file_lock.path != path:
+            cls._file_lock = FileLock(path)
+        return cls._file_lock
+
+    @classmethod
+    def _path(cls) -> str:
+        return os.path.abspath(os.path.join(cls.working_dir, 'keys.json'))
+
+    @staticmethod
+    def _signature(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
     @classmethod
     def load_keys(cls):
         """
         加载本地存储的密钥
         """
-        path = os.path.abspath(os.path.join(cls.working_dir, 'keys.json'))
-        if not os.path.exists(path):
-            cls.Keys.load({})
-        else:
-            with open(path, 'r', encoding='utf-8') as f:
-                cls.Keys.load(json.load(f))
+        path = cls._path()
+        with cls.locked():
+            sig = cls._signature(path)
+            if sig is None:
+                cls.Keys.load({})
+            else:
+                with open(path, 'r', encoding='utf-8') as f:
+                    cls.Keys.load(json.load(f))
+            cls._file_sig = sig
 
     @classmethod
-    def store_key(cls):
+    def refresh_keys(cls):
         """
-        密钥保存到本地
+        keys.json被其他进程修改过时重新加载，否则沿用内存中的密钥
         """
-        path = os.path.abspath(os.path.join(cls.working_dir, 'keys.json'))
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump({
-                "available": cls.Keys.available,
-                "unavailable": cls.Keys.unavailable
-            }, f, ensure_ascii=False, indent=4, separators=(',', ':'))
+        with cls.locked():
+            if cls._file_sig is None or cls._signature(cls._path()) != cls._file_sig:
+                cls.load_keys()
 
-    @staticmethod
-    def get_api_count(s, key):
-        url = 'https://api.tinify.com/shrink'
-        retry = 0
-        logger.info('正在获取密钥可用性信息... : {}', key)
-        while True:
+    @classmethod
+    def store_key(cls):
+        """
+        密钥保存到本地：先写入临时文件再替换，写入中途崩溃不会损坏keys.json
+        """
+        path = cls._path()
+        with cls.locked():
+            fd, tmp_path = tempfile.mkstemp(prefix='keys.', suffix='.tmp', dir=os.path.dirname(path))
             try:
-                res = s.post(url, auth=('api', key))
-                return int(res.headers.get('compression-count'))
-            except Exception as e:
-                retry += 1
-                if retry > 3:  # 最多再重试3次（总共4次）
-                    raise e
-                time.sleep(1)
-
-    @classmethod
-    def rearrange_keys(cls):
-        path = os.path.abspath(os.path.join(cls.working_dir, 'keys.json'))
-        if not os.path.exists(path):
-            keys = {"available": [], "unavailable": []}
-        else:
-            with open(path, 'r', encoding='utf-8') as f:
-                keys = json.load(f)
-        out = {"available": [], "unavailable": []}
+                with open(fd, 'w', encoding='utf-8') as f:
+                    json.dump({
+                        "available": cls.Keys.available,
+                        "unavailable": cls.Keys.unavailable,
+                        "counts": cls.Keys.counts
+                    }, f, ensure_ascii=False, indent=4, separators=(',', ':'))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            cls._file_sig = cls._signature(path)
+
+    @classmethod
+    @contextmanager
+    def updating(cls):
+        """
+        修改密钥：持有跨进程锁，先合并其他进程的修改，正常退出时保存
+        """
+        with cls.locked():
+            cls.refresh_keys()
+            yield cls.Keys
+            cls.store_key()
+
+    @classmethod
+    def current_key(cls) -> str:
+        """
+        当前使用的密钥，只读取内存，不访问keys.json
+        """
+        return cls.Keys.available[0] if len(cls.Keys.available) else None
+
+    @classmethod
+    def cached_count(cls, key):
+        """
+        有效期内记录的压缩次数，无记录或已过期返回None
+        """
+        entry = cls.Keys.counts.get(key)
+        if entry is None or time.time() - entry[1] > cls.count_ttl:
+            return None
+        return entry[0]
+
+    @classmethod
+    def record_count(cls, key, count):
+        """
+        记录密钥的压缩次数并保存，保留其他进程较新的记录
+        """
+        if count is None:
+            return
+        entry = cls.Keys.counts.get(key)
+        if entry is not None and entry[0] == count:  # 未变化，不访问磁盘
+            return
+        with cls.updating() as keys:
+            entry = keys.counts.get(key)
+            if entry is None or entry[0] is None or entry[0] <= count or time.time() - entry[1] > cls.count_ttl:
+                keys.counts[key] = [count, time.time()]
+
+    @classmethod
+    def get_api_count(cls, s, key, timeout=10):
+        """
+        请求获取密钥的已用压缩次数
+        :return: 压缩次数，密钥无效时返回None
+        """
+        url = f'{cls.API_ENDPOINT}/shrink'
+        logger.debug('正在获取密钥可用性信息... : {}', key)
+
+        def probe():
+            res = s.post(url, auth=('api', key), timeout=timeout)
+            count = res.headers.get('compression-count')
+            if count is None and res.status_code == 401:  # 密钥无效，无需重试
+                return None
+            if count is None:
+                raise TinyClient._error(res)
+            return int(count)
 
-        with requests.Session() as s:
-            for type_name in ('available', 'unavailable'):
-                for index, key in enumerate(keys[type_name]):
-                    count = cls.get_api_count(s, key)
-                    out['available' if count < 490 else 'unavailable'].append((keys[type_name][index], count))
+        return cls.retry_policy.call(probe, url=url)
+
+    @classmethod
+    def probe_counts(cls, keys, force=False) -> dict:
+        """
+        并发获取多条密钥的压缩次数，有效期内已记录的密钥（包括无效的密钥）不再请求
+        :param keys: 密钥列表
+        :param force: 是否忽略已记录的次数全部重新请求
+        :return: 密钥 -> 压缩次数（密钥无效为None），请求失败的密钥不在其中
+        """
+        now = time.time()
+        result = {} if force else {k: e[0] for k, e in ((k, cls.Keys.counts.get(k)) for k in keys)
+                                   if e is not None and now - e[1] <= cls.count_ttl}
+        pending = [k for k in dict.fromkeys(keys) if k not in result]
+        logger.info('密钥共{}条，{}条使用记录的次数，{}条需要请求', len(keys), len(result), len(pending))
+        if not pending:
+            return result
+
+        import requests  # 载入较慢，用到时才导入
+        from requests.adapters import HTTPAdapter
+        workers = max(1, min(cls.probe_workers, len(pending)))
+        with requests.Session() as s, ThreadPoolExecutor(workers, 'probe') as pool:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+            s.mount('https://', adapter)
+            s.mount('http://', adapter)
+            futures = {pool.submit(cls.get_api_count, s, key): key for key in pending}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    result[key] = future.result()
+                except Exception as e:
+                    logger.error('密钥可用性信息获取失败: {} {}', key, e)
+
+        with cls.updating() as stored:
+            now = time.time()
+            for key in pending:
+                if key in result:
+                    stored.counts[key] = [result[key], now]
+        return result
+
+    @classmethod
+    def rearrange_keys(cls, force=False):
+        """
+        按压缩次数重新排列密钥，次数已用完或无效的密钥移至不可用
+        :param force: 是否忽略已记录的次数全部重新请求
+        """
+        cls.refresh_keys()
+        keys = {"available": list(cls.Keys.available), "unavailable": list(cls.Keys.unavailable)}
+        counts = cls.probe_counts(keys['available'] + keys['unavailable'], force)
+
+        out = {"available": [], "unavailable": []}
+        for type_name in ('available', 'unavailable'):
+            for key in keys[type_name]:
+                if key not in counts:  # 请求失败，保持原位置
+                    type_out = type_name
+                elif counts[key] is None:
+                    type_out = 'unavailable'
+                else:
+                    type_out = 'available' if counts[key] < TinyClient.LIMIT else 'unavailable'
+                out[type_out].append((key, counts.get(key)))
 
         for type_name in ('available', 'unavailable'):
-            out[type_name].sort(key=lambda item: item[1], reverse=True)
-            logger.info('统计信息:', type_name)
+            out[type_name].sort(key=lambda item: -1 if item[1] is None else item[1], reverse=True)
+            logger.info('统计信息: {}', type_name)
             logger.info(json.dumps(out[type_name], indent=2))
             out[type_name] = [x[0] for x in out[type_name]]
 
-        cls.Keys.load(out)
-        cls.store_key()
+        with cls.updating() as keys:  # 保留统计期间其他进程新申请的密钥
+            out['available'] += [key for key in keys.available + keys.unavailable
+                                 if key not in out['available'] and key not in out['unavailable']]
+            keys.available, keys.unavailable = out['available'], out['unavailable']
         logger.success('密钥已按统计信息重新排列')
 
     @classmethod
-    def next_key(cls) -> str:
+    def next_key(cls, current=None):
         """
-        删除当前密钥并返回下一条
+        删除当前密钥并返回下一条，不申请新密钥，可用密钥不足时由调用方在释放锁后调用replenish
+        :param current: 次数已用完的密钥，默认为第一条；多个进程同时切换时，已被其他进程移除则不再删除其他密钥
+        :return: 下一条密钥，无可用密钥时为None
         """
-        cls.load_keys()
-
-        if len(cls.Keys.available) < 3:
-            logger.warning('可用密钥少于3条，优先申请新密钥')
-            cls.apply_store_key()
-
+        with cls.updating() as keys:  # 持有锁直到切换完成，其他进程等待后读取到的是切换后的密钥
+            if current is None and len(keys.available):
+                current = keys.available[0]
+            # 当前密钥与记录中次数已用完的密钥一并移除，避免切换后再次验证失败
+            exhausted = [key for key in keys.available
+                         if key == current or (cls.cached_count(key) or 0) >= TinyClient.LIMIT]
+            keys.available = [key for key in keys.available if key not in exhausted]
+            keys.unavailable += [key for key in exhausted if key not in keys.unavailable]
         if not len(cls.Keys.available):
-            raise Exception('无可用密钥，请申请后重试')
-        cls.Keys.unavailable.append(cls.Keys.available.pop(0))
-        cls.store_key()
+            return None
         logger.debug('密钥已切换，等待载入')
         return cls.Keys.available[0]
 
+    @classmethod
+    def replenish(cls):
+        """
+        可用密钥少于3条时申请新密钥。申请需要联网并等待邮件，期间不持有keys.json的锁，
+        每条新密钥在updating()中合并保存；同一进程内其他线程等待申请完成，不重复申请
+        """
+        if len(cls.Keys.available) >= 3:
+            return
+        with cls._apply_lock:
+            cls.refresh_keys()
+            if len(cls.Keys.available) < 3:
+                logger.warning('可用密钥少于3条，优先申请新密钥')
+                cls.apply_store_key()
+
     @classmethod
     def _apply_api_key(cls) -> str:
         """
         申请新密钥
         """
+        import requests
         with requests.Session() as session:
             # 注册新账号（发送确认邮件）
             mail = SnapMail.create_new_mail()
@@ -149,25 +319,23 @@ class KeyManager:
             logger.info('注册链接提取成功')
 
             # 访问控制台，生成密钥
-            retry = 0
-            while True:
-                try:
-                    session.get(url)
-                    auth = (session.get('https://tinify.com/web/session')).json()['token']  # 获取鉴权
-                    headers = {
-                        'authorization': f"Bearer {auth}"
-                    }
-                    session.post('https://api.tinify.com/api/keys', headers=headers)  # 添加新密钥
-                    res = session.get('https://api.tinify.com/api', headers=headers)  # 获取密钥
-                    key = res.json()['keys'][-1]['key']
-                    break
-                except Exception as e:
-                    retry += 1
-                    if retry <= 3:
-                        logger.error('新密钥生成失败, 3s后进行第{}次重试 {}', retry, e)
-                        time.sleep(3)
-                    else:
-                        raise ApplyKeyException(f'超出重试次数, 新密钥生成失败: {url}', e)
+            def generate() -> str:
+                session.get(url)
+                auth = (session.get('https://tinify.com/web/session')).json()['token']  # 获取鉴权
+                headers = {
+                    'authorization': f"Bearer {auth}"
+                }
+                session.post('https://api.tinify.com/api/keys', headers=headers)  # 添加新密钥
+                res = session.get('https://api.tinify.com/api', headers=headers)  # 获取密钥
+                return res.json()['keys'][-1]['key']
+
+            def on_retry(attempt, e, delay):
+                logger.error('新密钥生成失败, 已等待{:.1f}s后进行第{}次重试 {}', delay, attempt, e)
+
+            try:
+                key = cls.retry_policy.call(generate, url='https://tinify.com', on_retry=on_retry)
+            except Exception as e:
+                raise ApplyKeyException(f'超出重试次数, 新密钥生成失败: {url}', e)
 
             logger.success('新密钥生成成功')
             return key
@@ -178,6 +346,8 @@ class KeyManager:
         申请并保存密钥
         """
 
+        from requests import Timeout  # 载入较慢，用到时才导入
+
         # 允许申请次数（包括失败重试）
         times = 4 - len(cls.Keys.available) if times is None else times
         while times > 0:
@@ -185,8 +355,8 @@ class KeyManager:
                 times -= 1
                 logger.info('正在申请新密钥，剩余次数: {}', times)
                 key = cls._apply_api_key()
-                cls.Keys.available.append(key)
-                cls.store_key()
+                with cls.updating() as keys:  # 合并其他进程的修改后再保存
+                    keys.available.append(key)
             except Timeout as e:
                 logger.error("请求超时: {} - {}({})", e.request.method, e.request.url, bytes.decode(e.request.content))
             except Exception as e:
@@ -0,0 +1,82 @@
+import json
+import os
+from threading import RLock
+
+from loguru import logger
+
+
+class Manifest:
+    """
+    已压缩文件索引，记录压缩输出文件的大小与修改时间，
+    仅凭目录扫描得到的stat信息即可判断文件是否已压缩，无需打开文件检查压缩标记
+    """
+    _lock: RLock = RLock()
+    _entries: dict = {}  # 绝对路径 -> [大小, 修改时间(ns)]
+    _dirty: bool = False
+    enabled: bool = False
+    path: str
+
+    @classmethod
+    def init(cls, working_dir):
+        """
+        载入索引文件
+        :param working_dir: 工作目录，索引保存为其下的manifest.json
+        """
+        with cls._lock:
+            cls.path = os.path.abspath(os.path.join(working_dir, 'manifest.json'))
+            try:
+                with open(cls.path, 'r', encoding='utf-8') as f:
+                    cls._entries = json.load(f)
+            except Exception:
+                cls._entries = {}
+            cls._dirty = False
+            cls.enabled = True
+            logger.info('已压缩文件索引已载入: {}条', len(cls._entries))
+
+    @classmethod
+    def is_compressed(cls, path, stat: os.stat_result) -> bool:
+        """
+        根据stat信息判断文件是否已被压缩且之后未被修改
+        :param path: 文件路径
+        :param stat: 文件stat信息（可直接使用os.scandir得到的DirEntry.stat()）
+        """
+        if not cls.enabled:
+            return False
+        entry = cls._entries.get(os.path.abspath(path))
+        return entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns
+
+    @classmethod
+    def record(cls, path):
+        """
+        记录已压缩文件
+        """
+        if not cls.enabled:
+            return
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with cls._lock:
+            cls._entries[path] = [stat.st_size, stat.st_mtime_ns]
+            cls._dirty = True
+
+    @classmethod
+    def discard(cls, path):
+        """
+        删除记录，用于不再存在的临时文件
+        """
+        with cls._lock:
+            if cls._entries.pop(os.path.abspath(path), None) is not None:
+                cls._dirty = True
+
+    @classmethod
+    def flush(cls):
+        """
+        存在新记录时保存索引文件
+        """
+        with cls._lock:
+            if not cls.enabled or not cls._dirty:
+                return
+            tmp_path = cls.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(cls._entries, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, cls.path)
+            cls._dirty = False
@@ -0,0 +1,342 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Thread, Lock
+
+from loguru import logger
+
+import tinypng_unlimited  # 不使用from import防止交叉引用
+from tinypng_unlimited.coalescer import Coalescer
+from tinypng_unlimited.concurrency import ConcurrencyController
+from tinypng_unlimited.errors import CompressException
+from tinypng_unlimited.journal import Journal
+from tinypng_unlimited.result_cache import ResultCache
+
+
+class CompressJob:
+    """
+    流水线中单个文件的压缩任务
+    """
+
+    def __init__(self, path, new_path, tag=None):
+        """
+        :param path: 文件路径
+        :param new_path: 新文件路径
+        :param tag: 调用方附加的信息，完成回调时原样返回
+        """
+        self.path = path
+        self.new_path = new_path
+        self.tag = tag
+        self.file_name = os.path.basename(path)
+        self.old_size = 0
+        self.digest = None  # 源文件哈希，启用结果缓存时才有值
+        self.url = None  # 云端压缩后图片链接
+        self.client = None  # 上传使用的客户端，下载时沿用
+        self.timing = None  # 分阶段计时，未开启时为None
+        self.same_size = False  # 批次内是否已出现过相同大小的文件
+        self.fingerprint = None  # 用于合并相同内容的哈希
+        self.leader = False  # 是否代表相同内容的文件上传
+        self.retries = 0  # 上传与下载的重试次数
+        self.reuploads_avoided = 0  # 沿用图片链接只重试下载的次数
+        self.variants = ()  # 需要生成的衍生图片
+        self.variant_count = 0  # 已生成的衍生图片数量
+
+
+class Pipeline:
+    """
+    上传、下载两级流水线：上传线程池得到图片链接后放入有界交接队列，由下载线程取出下载保存，
+    上传线程不必等待下载完成即可开始下一次上传
+    """
+
+    def __init__(self, controller: ConcurrencyController, download_workers=4, handoff_size=None,
+                 upload_timeout=None, download_timeout=None, on_done=None, client=None):
+        """
+        :param controller: 上传阶段的并发控制器，上传线程池按其上限创建
+        :param download_workers: 下载线程数
+        :param handoff_size: 交接队列容量，队列满时上传线程阻塞等待，默认为下载线程数的2倍
+        :param upload_timeout: 上传响应超时时间，默认60s
+        :param download_timeout: 下载响应超时时间，默认30s
+        :param on_done: 任务完成回调on_done(job, result)，result为压缩结果或异常，在工作线程中调用
+        :param client: 指定该流水线使用的客户端，同一进程中可运行多条互不影响的流水线，默认跟随当前密钥
+        """
+        self.controller = controller
+        self.download_workers = max(1, download_workers)
+        self.handoff_size = handoff_size or self.download_workers * 2
+        self.upload_timeout = upload_timeout
+        self.download_timeout = download_timeout
+        self.on_done = on_done
+        self.client = client
+        self.upload_pool = ThreadPoolExecutor(controller.max_workers)
+        self.coalescer = Coalescer()
+        self.handoff = Queue(self.handoff_size)
+
+        self._lock = Lock()
+        self._upload_pending = 0
+        self._max_upload_queue = 0
+        self._max_download_queue = 0
+
+        self._download_threads = [Thread(target=self._download_loop, daemon=True)
+                                  for _ in range(self.download_workers)]
+        for t in self._download_threads:
+            t.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def capacity(self) -> int:
+        """
+        流水线可同时容纳的任务数（正在上传、等待下载与正在下载）
+        """
+        return self.controller.max_workers + self.handoff_size + self.download_workers
+
+    def submit(self, job: CompressJob):
+        if job.fingerprint is None:
+            try:
+                # 只记录大小，哈希由持有该文件的上传线程计算，提交方不读取可能正被覆盖的文件
+                self.coalescer.check_size(os.path.getsize(job.path), job)
+            except OSError:  # 交由压缩时报错
+                pass
+        with self._lock:
+            self._upload_pending += 1
+            self._max_upload_queue = max(self._max_upload_queue, self._upload_pending)
+        try:
+            self.upload_pool.submit(self._upload_job, job)
+        except RuntimeError:
+            with self._lock:
+                self._upload_pending -= 1
+            raise
+
+    def close(self):
+        """
+        等待全部任务完成后关闭流水线
+        """
+        self.upload_pool.shutdown(wait=True)
+        for _ in self._download_threads:
+            self.handoff.put(None)
+        for t in self._download_threads:
+            t.join()
+
+    def stats(self) -> dict:
+        """
+        各阶段队列深度，用于调整线程数与队列容量
+        """
+        with self._lock:
+            return {
+                'upload_workers': self.controller.max_workers, 'download_workers': self.download_workers,
+                'handoff_size': self.handoff_size,
+                'upload_queue': self._upload_pending, 'download_queue': self.handoff.qsize(),
+                'max_upload_queue': self._max_upload_queue, 'max_download_queue': self._max_download_queue,
+            }
+
+    def _finish(self, job: CompressJob, result):
+        if self.on_done is not None:
+            self.on_done(job, result)
+        # 覆盖源文件时完成后无法再补算源文件哈希，不记录输出
+        output = None if isinstance(result, Exception) or job.new_path == job.path else job.new_path
+        leader, waiters = self.coalescer.settle(job, output)
+        if waiters:
+            self._release(job, waiters, output, result)
+        if not leader:
+            return
+        if isinstance(result, Exception):
+            for follower in self.coalescer.fail(job.fingerprint):
+                self._resubmit(follower, result)  # 其中第一个将代替失败的任务上传
+        else:
+            for follower in self.coalescer.finish(job.fingerprint, job.new_path):
+                self._reuse(follower, job.new_path)
+
+    def _resubmit(self, job: CompressJob, result=None):
+        """
+        重新提交等待中的任务，流水线已关闭时以result结束该任务，result不是异常时按流水线已关闭报错
+        """
+        try:
+            self.submit(job)
+        except RuntimeError:
+            if not isinstance(result, Exception):
+                result = CompressException('流水线已关闭', {'path': job.path})
+            self._finish(job, result)
+
+    def _release(self, job: CompressJob, waiters: list, output, result):
+        """
+        未计算哈希的任务完成时处理等待其补算哈希的任务：未覆盖源文件时由完成该任务的线程补算哈希，
+        相同内容直接复用其输出，其余重新提交
+        """
+        digest = None
+        if output is not None:
+            try:
+                digest = ResultCache.file_digest(job.path)
+            except OSError:
+                pass
+            self.coalescer.adopt(digest, job)
+        for waiter in waiters:
+            if digest is not None and waiter.fingerprint == digest:
+                self._reuse(waiter, output)
+            else:
+                self._resubmit(waiter, result)
+
+    def _coalesce(self, job: CompressJob) -> bool:
+        """
+        合并批次内相同内容的文件
+        :return: 是否无需上传（等待相同内容的上传结果或直接复用其输出）
+        """
+        if job.fingerprint is None:
+            if job.digest is not None:
+                job.fingerprint = job.digest
+            elif not self.coalescer.dispatch(job):  # 出现过相同大小才计算哈希
+                job.fingerprint = ResultCache.file_digest(job.path)
+            else:
+                return False
+        state = self.coalescer.join(job.fingerprint, job)
+        while state == Coalescer.CHECK:
+            # 相同大小的首个任务已完成且未覆盖源文件，补算其哈希后重新加入
+            first = self.coalescer.first(job.old_size)
+            try:
+                digest = ResultCache.file_digest(first.path)
+            except OSError:
+                digest = None
+            self.coalescer.adopt(digest, first)
+            state = self.coalescer.join(job.fingerprint, job)
+        if state == Coalescer.LEADER:
+            job.leader = True
+            return False
+        if state == Coalescer.DONE:
+            self._reuse(job, self.coalescer.result(job.fingerprint))
+        elif state == Coalescer.WAITING:
+            logger.info('批次内相同大小的图片正在上传，等待其计算哈希: {}', job.file_name)
+        else:
+            logger.info('批次内相同内容的图片正在上传，等待其结果: {}', job.file_name)
+        return True
+
+    def _reuse(self, job: CompressJob, output_path):
+        """
+        复用相同内容文件的压缩结果写入该任务的新路径
+        """
+        try:
+            new_size = tinypng_unlimited.TinyImg.reuse_output(output_path, job.new_path, job.path, job.variants)
+        except Exception as e:
+            self._finish(job, CompressException('复用压缩结果失败', {'path': job.path, 'err': e}))
+            return
+        if job.timing is not None:
+            job.timing.lap('coalesce')
+        logger.info('复用批次内相同内容图片的压缩结果，节省一次上传: {}', job.file_name)
+        self._finish(job, (job.file_name, job.old_size, new_size,
+                           f'{round(100 * new_size / job.old_size, 2)}%', 'dedup'))
+
+    def _upload_job(self, job: CompressJob):
+        with self._lock:
+            self._upload_pending -= 1
+        if job.timing is not None:
+            job.timing.lap('queue')
+        try:
+            info, job.digest = tinypng_unlimited.TinyImg.prepare(job.path, job.new_path, variants=job.variants)
+            if job.timing is not None:
+                job.timing.lap('prepare')
+            if info is not None:
+                self._finish(job, info)
+                return
+            job.old_size = os.path.getsize(job.path)
+            if self._coalesce(job):
+                return
+            job.url = Journal.uploaded_url(job.path, job.old_size)
+            if job.url is not None:  # 上次中断前已上传，直接下载
+                logger.info('任务日志中已有图片链接，跳过上传: {}', job.file_name)
+                job.client = self.client or tinypng_unlimited.TinyImg.get_client()
+            else:
+                self._upload_url(job)
+            self._adopt_collided(job)
+        except OSError as e:  # 上传与下载的错误已包装为压缩错误，此处只有读取本地文件的错误
+            self._finish(job, tinypng_unlimited.TinyImg.read_error(job.path, e))
+            return
+        except Exception as e:
+            self._finish(job, e)
+            return
+        self.handoff.put(job)  # 交接队列已满时阻塞，避免下载积压
+        with self._lock:
+            self._max_download_queue = max(self._max_download_queue, self.handoff.qsize())
+
+    def _adopt_collided(self, job: CompressJob):
+        """
+        未计算哈希的任务在上传或等待下载期间出现了相同大小的文件时，由持有该任务的线程在写入输出之前补算哈希
+        """
+        if job.fingerprint is None and self.coalescer.collided(job):
+            for waiter in self.coalescer.adopt(ResultCache.file_digest(job.path), job):
+                self._resubmit(waiter)
+
+    def _upload_url(self, job: CompressJob):
+        """
+        上传图片，得到云端压缩后的图片链接
+        """
+        endpoint = tinypng_unlimited.TinyImg.API_ENDPOINT if self.client is None else self.client.api_endpoint
+        job.url, job.client = self._retry(job, '上传', self._upload, f'{endpoint}/shrink')
+        Journal.record(job.path, Journal.UPLOADED, url=job.url, size=job.old_size)
+
+    def _upload(self, job: CompressJob) -> tuple:
+        self.controller.acquire()
+        start, size = time.time(), 0
+        try:
+            res = tinypng_unlimited.TinyImg.upload(job.path, self.upload_timeout, self.client, job.timing)
+            size = job.old_size
+            return res
+        except Exception as e:
+            self.controller.congested(e)
+            raise
+        finally:
+            self.controller.release(size, time.time() - start)
+
+    def _download(self, job: CompressJob) -> int:
+        return tinypng_unlimited.TinyImg.download(job.new_path, job.url, job.digest, self.download_timeout,
+                                                  job.client, job.path, job.timing)
+
+    def _download_loop(self):
+        while True:
+            job = self.handoff.get()
+            if job is None:
+                return
+            if job.timing is not None:
+                job.timing.lap('handoff')
+            try:
+                self._adopt_collided(job)
+                new_size = self._fetch(job)
+                job.variant_count = len(tinypng_unlimited.TinyImg.download_variants(
+                    job.variants, job.new_path, job.url, self.download_timeout, job.client, job.path))
+                self._finish(job, (job.file_name, job.old_size, new_size,
+                                   f'{round(100 * new_size / job.old_size, 2)}%', 'upload'))
+            except Exception as e:
+                self._finish(job, e)
+
+    def _fetch(self, job: CompressJob) -> int:
+        """
+        下载压缩后的图片，失败时沿用图片链接只重试下载，云端图片已过期时才在下载线程中重新上传一次
+        """
+        try:
+            return self._retry(job, '下载', self._download, job.url)
+        except CompressException as e:
+            if not tinypng_unlimited.TinyImg.is_expired(e.detail['err']):
+                raise
+        logger.warning('云端图片已过期，重新上传: {}', job.file_name)
+        self._upload_url(job)
+        return self._retry(job, '下载', self._download, job.url)
+
+    @staticmethod
+    def _retry(job: CompressJob, stage: str, func, url):
+        """
+        按TinyImg.retry_policy重试上传或下载
+        :param url: 请求地址，用于熔断
+        """
+        def on_retry(attempt, e, delay):
+            job.retries += 1
+            if stage == '下载':
+                job.reuploads_avoided += 1
+            if job.timing is not None:
+                job.timing.lap('retry')
+            logger.warning('重试{}图片(第{}次，已等待{:.1f}s): {}, 错误信息: {}', stage, attempt, delay, job.file_name, e)
+
+        try:
+            return tinypng_unlimited.TinyImg.retry_policy.call(func, job, url=url, on_retry=on_retry)
+        except Exception as e:
+            raise tinypng_unlimited.TinyImg.retry_error(job.path, e, job.retries)
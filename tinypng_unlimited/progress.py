@@ -0,0 +1,71 @@
+import time
+from threading import Thread, Event, Lock
+
+from loguru import logger
+
+
+class ProgressReporter:
+    """
+    无界面模式的汇总进度：后台线程按固定间隔输出一行进度与附加指标，取代逐文件进度条，
+    接口与本项目用到的tqdm部分一致（total、update、set_postfix、上下文管理）
+    """
+
+    def __init__(self, desc='[任务进度]', total=None, interval=5.0):
+        """
+        :param desc: 进度描述
+        :param total: 总数，可在运行中修改
+        :param interval: 输出间隔(s)
+        """
+        self.desc = desc
+        self.total = total
+        self.interval = interval
+        self.n = 0
+        self.postfix = ''
+        self._lock = Lock()
+        self._start = time.time()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, n=1):
+        with self._lock:
+            self.n += n
+
+    def set_postfix(self, ordered_dict=None, refresh=True, **kwargs):
+        items = {**(ordered_dict or {}), **kwargs}
+        self.postfix = ', '.join(f'{k}={v}' for k, v in items.items())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def report(self):
+        """
+        输出当前进度
+        """
+        with self._lock:
+            n, total = self.n, self.total
+        elapsed = time.time() - self._start
+        rate = n / elapsed if elapsed else 0
+        parts = [self.desc, f'{n}/{total}' if total else str(n)]
+        if total:
+            parts.append(f'({100 * n / total:.1f}%)')
+        parts.append(f'{rate:.2f} 份/s 已用时 {elapsed:.0f}s')
+        if total and rate:
+            parts.append(f'剩余 {(total - n) / rate:.0f}s')
+        if self.postfix:
+            parts.append(f'| {self.postfix}')
+        logger.info(' '.join(parts))
+
+    def close(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self.report()
@@ -0,0 +1,118 @@
+import time
+
+from tinypng_unlimited.result_cache import ResultCache
+from tinypng_unlimited.timing import Timing, FileTiming, StageHistogram
+
+
+def byte_converter(byte_num) -> str:
+    if byte_num < 1024:  # 比特
+        return '{:.2f} B'.format(byte_num)  # 字节
+    elif 1024 <= byte_num < 1024 * 1024:
+        return '{:.2f} KB'.format(byte_num / 1024)  # 千字节
+    else:
+        return '{:.2f} MB'.format(byte_num / 1024 / 1024)  # 兆字节
+
+
+class Report:
+    """
+    批量压缩统计，生成压缩情况报告
+    """
+
+    def __init__(self, file_num, new_dir=None, input_dir=None, skip_count=0):
+        """
+        :param file_num: 待压缩文件数量
+        :param new_dir: 输出文件夹
+        :param input_dir: 源文件夹，文件列表则为None
+        :param skip_count: 扫描时跳过的已压缩文件数量
+        """
+        self.file_num = file_num
+        self.new_dir = new_dir
+        self.input_dir = input_dir
+        self.skip_count = skip_count
+        self.old_size = self.new_size = 0  # python不用担心大数运算溢出问题
+        self.error_files, self.success_files = [], []
+        self.permanent_errors = []  # 错误不可重试的文件，再次压缩也会失败
+        self.retries = {}  # 文件路径 -> 重试次数，只记录重试过的文件
+        self.reuploads_avoided = 0  # 下载失败后沿用图片链接只重试下载而节省的上传次数
+        self.cache_hits = self.cache_misses = 0
+        self.uploads_saved = 0  # 复用批次内相同内容文件的结果而节省的上传次数
+        self.variant_count = 0  # 由已有图片链接生成的衍生图片数量，每个节省一次上传
+        self.timings = []  # 开启分阶段计时时每个文件的计时明细
+        self.histogram = StageHistogram() if Timing.enabled and Timing.histograms else None
+        self.extra = {}  # 附加到报告顶层的其他信息，如并发数调整记录、流水线队列深度
+        self.pending = 0  # 已提交未完成的文件数量
+        self.closed = False  # 是否已提交全部文件
+        self._start = time.time()
+
+    def add_success(self, info: tuple):
+        """
+        统计压缩成功的文件
+        :param info: compress_from_file的返回值
+        """
+        self.old_size += info[1]
+        self.new_size += info[2]
+        self.success_files.append((info[0], byte_converter(info[1]), byte_converter(info[2]), info[3]))
+        if info[4] == 'cache':
+            self.cache_hits += 1
+        elif info[4] == 'dedup':
+            self.uploads_saved += 1
+        elif info[4] == 'upload' and ResultCache.enabled:
+            self.cache_misses += 1
+
+    def add_error(self, path, permanent=False):
+        self.error_files.append(path)
+        if permanent:
+            self.permanent_errors.append(path)
+
+    def add_retries(self, path, count, reuploads_avoided=0):
+        """
+        :param count: 该文件的重试次数
+        :param reuploads_avoided: 其中只重试下载的次数
+        """
+        if count:
+            self.retries[path] = count
+        self.reuploads_avoided += reuploads_avoided
+
+    def add_timing(self, timing: FileTiming, success=True):
+        """
+        统计单个文件的分阶段计时，并交给计时回调
+        """
+        timing.finish()
+        if self.histogram is not None:
+            self.histogram.add(timing)
+        res = timing.to_dict()
+        res['success'] = success
+        if Timing.files:
+            self.timings.append(res)
+        Timing.emit(res)
+
+    def to_dict(self) -> dict:
+        elapsed = time.time() - self._start
+        speed = len(self.success_files) / elapsed if elapsed else 0
+        compression = f'{round(100 * self.new_size / self.old_size, 2)}%' if self.old_size else '100%'
+        res = {
+            'basic': {
+                'file_num': self.file_num, 'success_count': len(self.success_files),
+                'error_count': len(self.error_files),
+                'time': '{:.2f} s'.format(elapsed), 'speed': '{:.2f} 份/s'.format(speed),
+                'output_size': byte_converter(self.new_size), 'input_size': byte_converter(self.old_size),
+                'compression': compression, 'output_dir': '覆盖原文件' if self.new_dir is None else self.new_dir,
+                'cache_hits': self.cache_hits, 'cache_misses': self.cache_misses, 'skip_count': self.skip_count,
+                'uploads_saved': self.uploads_saved, 'retry_count': sum(self.retries.values()),
+                'reuploads_avoided': self.reuploads_avoided, 'variant_count': self.variant_count,
+            },
+            'error_files': self.error_files,
+            'success_files': self.success_files,
+        }
+        if self.input_dir is not None:
+            res['input_dir'] = self.input_dir
+        if self.permanent_errors:
+            res['permanent_error_files'] = self.permanent_errors
+        if self.retries:
+            res['retries'] = self.retries
+        if self.timings:
+            res['timings'] = self.timings
+        if self.histogram is not None:
+            res['histograms'] = self.histogram.to_dict()
+        res.update(self.extra)
+        return res
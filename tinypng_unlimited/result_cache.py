@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from shutil import copyfile
+from threading import RLock
+
+from loguru import logger
+
+
+class ResultCache:
+    """
+    压缩结果缓存，以源文件内容哈希为键保存压缩后的文件，超出容量时按LRU淘汰
+    """
+    _lock: RLock = RLock()
+    _index: OrderedDict = OrderedDict()  # 哈希 -> 文件大小，按最近使用排序
+    _dirty: bool = False
+    enabled: bool = False
+    cache_dir: str
+    max_size: int = 0
+    total_size: int = 0
+    hits: int = 0
+    misses: int = 0
+
+    @classmethod
+    def init(cls, working_dir, max_size=512 * 1024 * 1024):
+        """
+        缓存初始化
+        :param working_dir: 工作目录，缓存保存在其下的cache文件夹
+        :param max_size: 缓存容量上限(字节)，为0则不启用缓存
+        """
+        with cls._lock:
+            cls.cache_dir = os.path.abspath(os.path.join(working_dir, 'cache'))
+            cls.max_size = max_size
+            cls.enabled = max_size > 0
+            cls._index = OrderedDict()
+            cls.total_size = 0
+            cls._dirty = False
+            if not cls.enabled:
+                return
+
+            if not os.path.exists(cls.cache_dir):
+                os.makedirs(cls.cache_dir)
+            try:
+                with open(cls._index_path(), 'r', encoding='utf-8') as f:
+                    items = json.load(f)
+            except Exception:
+                items = []
+            for digest, size in items:
+                if os.path.exists(cls._entry_path(digest)):
+                    cls._index[digest] = size
+                    cls.total_size += size
+            cls._evict()
+            logger.info('压缩结果缓存已载入: {}条', len(cls._index))
+
+    @classmethod
+    def _index_path(cls) -> str:
+        return os.path.join(cls.cache_dir, 'index.json')
+
+    @classmethod
+    def _entry_path(cls, digest) -> str:
+        return os.path.join(cls.cache_dir, digest)
+
+    @staticmethod
+    def file_digest(path) -> str:
+        """
+        计算文件内容哈希
+        """
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    @classmethod
+    def get(cls, digest, new_path, tmp_path) -> bool:
+        """
+        命中缓存则将压缩结果写入新路径
+        :param digest: 源文件哈希
+        :param new_path: 新文件路径
+        :param tmp_path: 临时文件路径，写入完成后移动至新路径
+        :return: 是否命中
+        """
+        with cls._lock:
+            if digest not in cls._index:
+                cls.misses += 1
+                return False
+            cls._index.move_to_end(digest)
+            cls._dirty = True
+            cls.hits += 1
+            copyfile(cls._entry_path(digest), tmp_path)
+        os.replace(tmp_path, new_path)
+        return True
+
+    @classmethod
+    def put(cls, digest, path):
+        """
+        保存压缩结果至缓存，索引在flush时才保存
+        :param digest: 源文件哈希
+        :param path: 压缩后的文件路径
+        """
+        size = os.path.getsize(path)
+        if size > cls.max_size:
+            return
+        with cls._lock:
+            if digest not in cls._index:
+                copyfile(path, cls._entry_path(digest))
+                cls._index[digest] = size
+                cls.total_size += size
+                cls._evict()
+            else:
+                cls._index.move_to_end(digest)
+            cls._dirty = True
+
+    @classmethod
+    def _evict(cls):
+        """
+        淘汰最久未使用的缓存直至不超过容量上限
+        """
+        while cls.total_size > cls.max_size and cls._index:
+            digest, size = cls._index.popitem(last=False)
+            cls.total_size -= size
+            cls._dirty = True
+            try:
+                os.remove(cls._entry_path(digest))
+            except OSError:
+                pass
+
+    @classmethod
+    def flush(cls):
+        """
+        存在变化时保存缓存索引（包括使用顺序），在每批压缩结束时调用，先写入临时文件再替换，中途退出不会损坏索引
+        """
+        with cls._lock:
+            if not cls.enabled or not cls._dirty:
+                return
+            tmp_path = cls._index_path() + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(list(cls._index.items()), f)
+            os.replace(tmp_path, cls._index_path())
+            cls._dirty = False
+
+    @classmethod
+    def stats(cls) -> tuple:
+        with cls._lock:
+            return cls.hits, cls.misses
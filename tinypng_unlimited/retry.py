@@ -0,0 +1,326 @@
+import random
+import time
+from threading import Lock
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+from tinypng_unlimited.errors import CustomException, CircuitOpenException
+
+
+class CircuitBreaker:
+    """
+    单个api地址的熔断器：连续失败达到阈值后断开，冷却期内的请求直接失败不再发出，
+    冷却结束后只放行一个试探请求，成功则恢复，失败则再次断开。
+    阈值随同时进行的请求数增加，多个并发请求零星的失败不会触发熔断
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, endpoint, threshold=5, cooldown=15.0):
+        """
+        :param endpoint: api地址（域名与端口，及路径的第一段）
+        :param threshold: 只有一个请求时连续失败多少次后断开，每多一个同时进行的请求阈值加一
+        :param cooldown: 断开后的冷却时间(s)
+        """
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0  # 连续失败次数
+        self.trips = 0  # 断开次数
+        self.reopens = 0  # 试探连续失败的次数，恢复后清零
+        self.in_flight = 0  # 已放行尚未结束的请求数
+        self._opened_at = 0.0
+        self._lock = Lock()
+
+    def remaining(self) -> float:
+        """
+        距冷却结束的时间(s)，未断开时为0
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            return max(self._opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    def before(self):
+        """
+        请求前检查，断开或正在试探时抛出CircuitOpenException，放行后须以success、failure或done结束
+        """
+        with self._lock:
+            if self.state != self.CLOSED:
+                remaining = self._opened_at + self.cooldown - time.monotonic()
+                if self.state == self.HALF_OPEN or remaining > 0:
+                    raise CircuitOpenException(f'请求已熔断: {self.endpoint}', max(remaining, 1.0))
+                self.state = self.HALF_OPEN  # 当前请求作为试探
+            self.in_flight += 1
+
+    def done(self):
+        """
+        请求结束但不能说明服务器是否正常，如429、本地错误
+        """
+        with self._lock:
+            self.in_flight = max(self.in_flight - 1, 0)
+            if self.state == self.HALF_OPEN:  # 试探没有结果，允许下一个请求试探
+                self.state = self.OPEN
+
+    def success(self):
+        with self._lock:
+            self.in_flight = max(self.in_flight - 1, 0)
+            if self.state != self.CLOSED:
+                logger.info('api已恢复，结束熔断: {}', self.endpoint)
+            self.state = self.CLOSED
+            self.failures = self.reopens = 0
+
+    def failure(self):
+        with self._lock:
+            threshold = self.threshold + max(self.in_flight - 1, 0)
+            self.in_flight = max(self.in_flight - 1, 0)
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.reopens += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= threshold):
+                if self.state == self.CLOSED:
+                    logger.warning('api连续失败{}次，熔断{}s: {}', self.failures, self.cooldown, self.endpoint)
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self.trips += 1
+
+
+class RetryBudget:
+    """
+    全局重试预算（令牌桶）：每次新的请求存入ratio个令牌，令牌也随时间缓慢恢复，每次重试取出一个，
+    大量请求同时失败时重试次数被限制在请求数的一定比例内，避免重试风暴
+    """
+
+    def __init__(self, ratio=0.5, refill_rate=1.0, max_tokens=50.0):
+        """
+        :param ratio: 每次新的请求存入的令牌数
+        :param refill_rate: 每秒恢复的令牌数
+        :param max_tokens: 令牌上限，也是初始令牌数
+        """
+        self.ratio = ratio
+        self.refill_rate = refill_rate
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.exhausted = 0  # 因预算不足放弃的重试次数
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self._last) * self.refill_rate, self.max_tokens)
+        self._last = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self) -> bool:
+        """
+        :return: 是否还有预算重试
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                self.exhausted += 1
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy:
+    """
+    统一的重试策略：区分可重试与不可重试的错误，指数退避加随机抖动，
+    同一api地址的请求共用熔断器，所有请求共用全局重试预算
+    """
+    PERMANENT = 'permanent'  # 不可重试，如文件不存在、不支持的格式等4xx错误
+    RETRYABLE = 'retryable'  # 可重试，如超时、连接错误、5xx错误
+    THROTTLED = 'throttled'  # 请求过多（429），退避时间更长
+
+    budget = RetryBudget()
+    breaker_threshold: int = 5
+    breaker_cooldown: float = 15.0
+    max_open_waits: int = 4  # 熔断时最多等待几次冷却，等待不计入重试次数
+    max_reopens: int = 2  # 试探连续失败几次后视为api持续不可用，熔断的请求不再等待
+    _breakers: dict = {}  # api地址 -> CircuitBreaker
+    _breakers_lock = Lock()
+
+    def __init__(self, retries=3, base_delay=0.5, max_delay=30.0, throttle_delay=2.0, classify=None):
+        """
+        :param retries: 最多重试次数（不包括首次）
+        :param base_delay: 首次重试前的基础等待时间(s)，之后每次翻倍
+        :param max_delay: 单次等待时间上限(s)
+        :param throttle_delay: 请求过多时的基础等待时间(s)
+        :param classify: 自定义错误分类classify(e) -> 分类，默认为classify_error
+        """
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttle_delay = throttle_delay
+        self._classify = classify or self.classify_error
+
+    @classmethod
+    def breaker(cls, url) -> CircuitBreaker:
+        """
+        url所属api地址的熔断器，按域名与路径的第一段区分，上传(/shrink)与下载(/output)互不影响
+        """
+        parts = urlsplit(url)
+        endpoint = parts.netloc + '/' + parts.path.strip('/').split('/')[0] if parts.netloc else url
+        with cls._breakers_lock:
+            if endpoint not in cls._breakers:
+                cls._breakers[endpoint] = CircuitBreaker(endpoint, cls.breaker_threshold, cls.breaker_cooldown)
+            return cls._breakers[endpoint]
+
+    @staticmethod
+    def status_of(e: Exception):
+        """
+        错误对应的http状态码，没有则返回None
+        """
+        status = getattr(e, 'status', None)
+        if status is None and isinstance(e, CustomException) and isinstance(e.detail, dict):
+            status = e.detail.get('status')
+        if status is None and getattr(e, 'response', None) is not None:  # requests.HTTPError
+            status = getattr(e.response, 'status_code', None)
+        return status if isinstance(status, int) else None
+
+    @staticmethod
+    def classify_error(e: Exception) -> str:
+        """
+        按响应状态码与异常类型分类，无法判断的错误视为可重试
+        """
+        if isinstance(e, CircuitOpenException):
+            return RetryPolicy.RETRYABLE
+        status = RetryPolicy.status_of(e)
+        if status is not None:
+            if status == 429:
+                return RetryPolicy.THROTTLED
+            if status >= 500 or status in (408, 409):
+                return RetryPolicy.RETRYABLE
+            if 400 <= status < 500:
+                return RetryPolicy.PERMANENT
+        if isinstance(e, (ConnectionError, TimeoutError)):
+            return RetryPolicy.RETRYABLE
+        if type(e).__module__.split('.')[0] in ('requests', 'urllib3', 'tinify', 'aiohttp'):  # 网络错误
+            return RetryPolicy.RETRYABLE
+        if isinstance(e, (FileNotFoundError, IsADirectoryError, PermissionError)):  # 本地文件错误
+            return RetryPolicy.PERMANENT
+        return RetryPolicy.RETRYABLE
+
+    def classify(self, e: Exception) -> str:
+        return self._classify(e)
+
+    @staticmethod
+    def is_server_failure(e: Exception) -> bool:
+        """
+        是否说明服务器出现故障，只有这类错误计入熔断：5xx、408与网络错误，
+        429与本地错误（如密钥次数不足、文件错误）不计入
+        """
+        status = RetryPolicy.status_of(e)
+        if status is not None:
+            return status >= 500 or status == 408
+        if isinstance(e, (ConnectionError, TimeoutError)):
+            return True
+        return type(e).__module__.split('.')[0] in ('requests', 'urllib3', 'aiohttp')
+
+    def backoff(self, attempt, kind=RETRYABLE) -> float:
+        """
+        第attempt次重试前的等待时间(s)：指数退避，在上限的一半到上限之间随机，避免同时重试
+        """
+        base = self.throttle_delay if kind == self.THROTTLED else self.base_delay
+        delay = min(base * 2 ** (attempt - 1), self.max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def before(self, url=None, first=True):
+        """
+        每次请求前调用：新的请求存入重试预算，熔断时抛出CircuitOpenException，
+        放行后须以success或next_delay结束
+        """
+        if first:
+            self.budget.deposit()
+        if url:
+            self.breaker(url).before()
+
+    def success(self, url=None):
+        if url:
+            self.breaker(url).success()
+
+    @staticmethod
+    def counts(e: Exception) -> bool:
+        """
+        该错误是否计入重试次数，熔断时请求未发出，只计入等待次数
+        """
+        return not isinstance(e, CircuitOpenException)
+
+    def next_delay(self, e: Exception, attempt, url=None, waits=0):
+        """
+        请求失败后决定是否重试
+        :param e: 本次的错误
+        :param attempt: 已失败的次数（不包括熔断等待），从1开始
+        :param url: 请求地址，用于记录熔断器状态
+        :param waits: 已熔断等待的次数（包括本次）
+        :return: 重试前的等待时间(s)，None表示不再重试
+        """
+        if isinstance(e, CircuitOpenException):  # 请求未发出，不消耗重试次数与预算，等到冷却结束
+            if waits > self.max_open_waits or (url and self.breaker(url).reopens >= self.max_reopens):
+                return None
+            return e.detail + random.uniform(0, 1)
+        kind = self.classify(e)
+        if url:
+            breaker = self.breaker(url)
+            if kind == self.PERMANENT and self.status_of(e) is not None:  # 服务器正常响应，只是请求本身有误
+                breaker.success()
+            elif self.is_server_failure(e):
+                breaker.failure()
+            else:
+                breaker.done()
+        if kind == self.PERMANENT or attempt > self.retries:
+            return None
+        if not self.budget.withdraw():
+            logger.warning('重试预算已用完，不再重试: {}', e)
+            return None
+        return self.backoff(attempt, kind)
+
+    def call(self, func, *args, url=None, on_retry=None, **kwargs):
+        """
+        按策略调用func，不再重试时抛出最后一次的错误
+        :param url: 请求地址，用于熔断，也可以是每次请求前调用的函数，返回本次的请求地址（如按阶段区分上传与下载）
+        :param on_retry: 每次重试前（等待之后）的回调on_retry(第几次重试，上次的错误，等待的时间)，熔断等待时不调用
+        """
+        attempt = waits = 0
+        while True:
+            endpoint = url() if callable(url) else url
+            try:
+                self.before(endpoint, attempt == waits == 0)
+                res = func(*args, **kwargs)
+            except Exception as e:
+                if self.counts(e):
+                    attempt += 1
+                else:
+                    waits += 1
+                delay = self.next_delay(e, attempt, endpoint, waits)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                if not self.counts(e):
+                    logger.debug('api熔断中，已等待{:.1f}s: {}', delay, endpoint)
+                elif on_retry is not None:
+                    on_retry(attempt, e, delay)
+                continue
+            self.success(endpoint)
+            return res
+
+    def is_permanent(self, e: Exception) -> bool:
+        return self.classify(e) == self.PERMANENT
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        熔断器与重试预算的状态
+        """
+        with cls._breakers_lock:
+            breakers = {k: {'state': b.state, 'trips': b.trips} for k, b in cls._breakers.items()}
+        return {'breakers': breakers, 'budget_tokens': round(cls.budget.tokens, 1),
+                'budget_exhausted': cls.budget.exhausted}
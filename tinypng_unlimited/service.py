@@ -0,0 +1,433 @@
+import hmac
+import ipaddress
+import json
+import os
+import secrets
+import time
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from threading import Thread, Condition, Lock
+from uuid import uuid4
+
+from loguru import logger
+
+import tinypng_unlimited  # 不使用from import防止交叉引用
+from tinypng_unlimited.errors import CompressException
+from tinypng_unlimited.manifest import Manifest
+from tinypng_unlimited.result_cache import ResultCache
+
+
+class ServiceJob:
+    """
+    服务中的一次批量压缩请求，逐个记录文件结果供查询或流式读取
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, paths, new_dir=None, recursive=False):
+        self.id = uuid4().hex[:12]
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.new_dir = new_dir
+        self.recursive = recursive
+        self.state = self.QUEUED
+        self.results = []  # 每个文件的结果，按完成顺序
+        self.reports = []
+        self.error = None
+        self.created = time.time()
+        self._cond = Condition()
+
+    def groups(self):
+        """
+        展开为compress_stream的分组，文件夹边扫描边产出
+        """
+        files = [p for p in self.paths if not os.path.isdir(p)]
+        if files:
+            yield None, files, 0
+        for path in self.paths:
+            if os.path.isdir(path):
+                yield from tinypng_unlimited.TinyImg.walk_dir(path, self.recursive)
+
+    def add_result(self, path, result):
+        if isinstance(result, Exception):
+            entry = {'path': path, 'success': False, 'error': str(result)}
+        elif result is None:  # async引擎只知道成功与否
+            entry = {'path': path, 'success': True}
+        else:
+            entry = {'path': path, 'success': True, 'old_size': result[1], 'new_size': result[2],
+                     'ratio': result[3], 'source': result[4]}
+        with self._cond:
+            self.results.append(entry)
+            self._cond.notify_all()
+
+    def set_state(self, state, error=None):
+        with self._cond:
+            self.state, self.error = state, error
+            self._cond.notify_all()
+
+    def wait(self, start, timeout=None) -> tuple:
+        """
+        等待新的文件结果
+        :param start: 已读取的结果数量
+        :return: (新的结果列表，任务是否已结束)
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.results) > start or self.finished, timeout)
+            return self.results[start:], self.finished
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (self.DONE, self.FAILED)
+
+    def summary(self) -> dict:
+        with self._cond:
+            success = sum(1 for r in self.results if r['success'])
+            return {'id': self.id, 'state': self.state, 'error': self.error, 'success_count': success,
+                    'error_count': len(self.results) - success, 'created': round(self.created, 3)}
+
+    def to_dict(self) -> dict:
+        res = self.summary()
+        with self._cond:
+            res['results'] = list(self.results)
+            res['reports'] = list(self.reports)
+        return res
+
+
+class CompressService:
+    """
+    常驻的本地压缩服务：进程只初始化一次，密钥状态与连接池在多次请求之间复用，
+    省去每次运行命令行时载入、验证密钥与建立连接的开销。批量任务按提交顺序依次压缩，
+    单张图片字节流的请求在各自的请求线程中直接压缩。
+    服务会覆盖写入请求中的任意路径，因此每个请求须携带启动时生成并写入工作目录的令牌，
+    并校验Host请求头，避免网页通过跨域请求或DNS重绑定调用
+    """
+    MAX_JOBS = 200  # 保留的已结束任务数量上限
+
+    def __init__(self, host='127.0.0.1', port=8565, engine='thread', working_dir=None):
+        """
+        :param host: 监听地址，默认只接受本机连接
+        :param port: 监听端口，0则自动选择
+        :param engine: 批量任务的压缩引擎
+        :param working_dir: 令牌文件所在的工作目录，默认与密钥相同
+        """
+        self.engine = engine
+        self.jobs = OrderedDict()  # id -> ServiceJob
+        self._lock = Lock()
+        self._queue = Queue()
+        self._start = time.time()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._worker = Thread(target=self._run_jobs, daemon=True)
+        self.token = secrets.token_urlsafe(32)
+        self.token_path = self.token_file(working_dir or tinypng_unlimited.KeyManager.working_dir,
+                                          self.server.server_address[1])
+
+    @staticmethod
+    def token_file(working_dir, port) -> str:
+        """
+        令牌文件路径，按端口区分同一工作目录下的多个服务
+        """
+        return os.path.abspath(os.path.join(working_dir, f'service-{port}.token'))
+
+    def _write_token(self):
+        """
+        保存令牌，只有当前用户可读
+        """
+        fd = os.open(self.token_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(self.token)
+
+    def authorized(self, header) -> bool:
+        """
+        校验Authorization请求头中的令牌
+        """
+        scheme, _, token = (header or '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(token.strip().encode(), self.token.encode())
+
+    def host_allowed(self, header) -> bool:
+        """
+        校验Host请求头：须为监听地址（回环地址还可为localhost）与端口；监听所有地址时须为IP或localhost，
+        DNS重绑定使用的域名均被拒绝
+        """
+        host, port = self.server.server_address[:2]
+        try:
+            url = urllib.parse.urlsplit(f'//{header}')
+            name, req_port = url.hostname, url.port or 80
+        except ValueError:
+            return False
+        if not name or req_port != port:
+            return False
+        if name == 'localhost':
+            return host in ('', '0.0.0.0', '::') or ipaddress.ip_address(host).is_loopback
+        try:
+            ip = ipaddress.ip_address(name)
+        except ValueError:
+            return False
+        return host in ('', '0.0.0.0', '::') or ip == ipaddress.ip_address(host)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def serve_forever(self):
+        self._write_token()
+        self._worker.start()
+        logger.success('压缩服务已启动: {}，令牌文件: {}', self.url, self.token_path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            self._queue.put(None)
+            try:
+                os.remove(self.token_path)
+            except OSError:
+                pass
+            logger.info('压缩服务已停止')
+
+    def shutdown(self):
+        Thread(target=self.server.shutdown, daemon=True).start()  # 不能在请求线程中直接等待服务停止
+
+    def submit(self, paths, new_dir=None, recursive=False) -> ServiceJob:
+        job = ServiceJob(paths, new_dir, recursive)
+        with self._lock:
+            self.jobs[job.id] = job
+            finished = [k for k, j in self.jobs.items() if j.finished]
+            for k in finished[:max(len(finished) - self.MAX_JOBS, 0)]:
+                del self.jobs[k]
+        self._queue.put(job)
+        logger.info('收到压缩任务: {} ({}个路径)', job.id, len(job.paths))
+        return job
+
+    def _run_jobs(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.set_state(ServiceJob.RUNNING)
+            try:
+                for _, res in tinypng_unlimited.TinyImg.compress_stream(job.groups(), job.new_dir, engine=self.engine,
+                                                                        on_file=job.add_result):
+                    job.reports.append(res)
+                job.set_state(ServiceJob.DONE)
+                logger.success('压缩任务完成: {}', job.id)
+            except Exception as e:
+                job.set_state(ServiceJob.FAILED, str(e))
+                logger.error('压缩任务失败: {} {}', job.id, e)
+
+    @staticmethod
+    def compress_bytes(data: bytes, name='image.png') -> tuple:
+        """
+        压缩图片字节流
+        :param name: 文件名，仅用于日志与临时文件后缀
+        :return: (压缩后的字节流，compress_from_file的返回值)
+        """
+        tmp_dir = tinypng_unlimited.TinyImg.tmp_dir
+        os.makedirs(tmp_dir, exist_ok=True)
+        path = os.path.join(tmp_dir, f'{uuid4().hex[:8]}-{os.path.basename(name)}')
+        try:
+            with open(path, 'wb') as f:
+                f.write(data)
+            info = tinypng_unlimited.TinyImg.compress_from_file(path, path)
+            with open(path, 'rb') as f:
+                return f.read(), info
+        finally:
+            ResultCache.flush()  # 单个图片不经过批量压缩，须自行保存缓存索引
+            Manifest.discard(path)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def status(self) -> dict:
+        with self._lock:
+            states = {}
+            for job in self.jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+        client = tinypng_unlimited.TinyImg.get_client()
+        return {'uptime': round(time.time() - self._start, 1), 'jobs': states, 'queued': self._queue.qsize(),
+                'key_remaining': client.remaining() if client is not None else 0}
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b'', content_type='application/json', headers=None):
+                if isinstance(body, (dict, list)):
+                    body = json.dumps(body, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header('content-type', content_type)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, str(v))
+                self.send_header('content-length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self) -> bytes:
+                length = int(self.headers.get('content-length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def _job(self, job_id):
+                with service._lock:
+                    job = service.jobs.get(job_id)
+                if job is None:
+                    self._send(404, {'error': '任务不存在', 'id': job_id})
+                return job
+
+            def _check(self) -> bool:
+                """
+                校验Host请求头与令牌，不通过时直接响应
+                """
+                if not service.host_allowed(self.headers.get('host')):
+                    self._send(403, {'error': 'Host请求头与服务地址不符'})
+                    return False
+                if not service.authorized(self.headers.get('authorization')):
+                    self._send(401, {'error': '令牌错误，请使用服务启动时写入工作目录的令牌'})
+                    return False
+                return True
+
+            def do_GET(self):
+                if not self._check():
+                    return
+                url = urllib.parse.urlsplit(self.path)
+                parts = url.path.strip('/').split('/')
+                if parts == ['status']:
+                    return self._send(200, service.status())
+                if len(parts) == 2 and parts[0] == 'jobs':
+                    job = self._job(parts[1])
+                    return job and self._send(200, job.to_dict())
+                if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+                    job = self._job(parts[1])
+                    return job and self._stream(job, int(urllib.parse.parse_qs(url.query).get('from', ['0'])[0]))
+                self._send(404, {'error': '未知路径', 'path': self.path})
+
+            def _stream(self, job: ServiceJob, start):
+                """
+                逐行输出文件结果（json lines），任务结束时输出汇总后关闭连接
+                """
+                self.send_response(200)
+                self.send_header('content-type', 'application/x-ndjson')
+                self.end_headers()
+                finished = False
+                while not finished:
+                    results, finished = job.wait(start, 30)
+                    start += len(results)
+                    lines = [json.dumps({'event': 'result', **r}, ensure_ascii=False) for r in results]
+                    if finished:
+                        lines.append(json.dumps({'event': 'done', **job.summary()}, ensure_ascii=False))
+                    elif not lines:  # 保持连接，避免客户端读取超时
+                        lines.append(json.dumps({'event': 'ping'}))
+                    self.wfile.write(('\n'.join(lines) + '\n').encode())
+                    self.wfile.flush()
+
+            def do_POST(self):
+                body = self._read_body()  # 拒绝前也读取请求体，保持连接可用
+                if not self._check():
+                    return
+                url = urllib.parse.urlsplit(self.path)
+                path = url.path.rstrip('/')
+                if path == '/jobs':
+                    if self.headers.get_content_type() != 'application/json':
+                        return self._send(415, {'error': '请求体须为application/json'})
+                    try:
+                        req = json.loads(body or b'{}')
+                        paths = req['paths']
+                    except (ValueError, KeyError) as e:
+                        return self._send(400, {'error': '请求格式错误', 'detail': str(e)})
+                    job = service.submit(paths, req.get('new_dir'), req.get('recursive', False))
+                    return self._send(202, {'id': job.id})
+                if path == '/compress':
+                    name = urllib.parse.parse_qs(url.query).get('name', ['image.png'])[0]
+                    try:
+                        data, info = service.compress_bytes(body, name)
+                    except CompressException as e:
+                        return self._send(500, {'error': str(e), 'detail': str(e.detail)})
+                    except Exception as e:
+                        return self._send(500, {'error': str(e)})
+                    return self._send(200, data, 'application/octet-stream',
+                                      {'x-old-size': info[1], 'x-new-size': info[2], 'x-source': info[4]})
+                if path == '/shutdown':
+                    self._send(200, {'state': 'stopping'})
+                    return service.shutdown()
+                self._send(404, {'error': '未知路径', 'path': self.path})
+
+        return Handler
+
+
+class ServiceClient:
+    """
+    压缩服务的客户端，只使用标准库，供构建工具等频繁调用的场景
+    """
+
+    def __init__(self, url='http://127.0.0.1:8565', timeout=30, token=None, working_dir=None):
+        """
+        :param url: 服务地址
+        :param timeout: 请求超时时间(s)
+        :param token: 服务令牌，默认从服务工作目录中的令牌文件读取
+        :param working_dir: 服务的工作目录，未指定令牌时使用
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        if token is None and working_dir is not None:
+            port = urllib.parse.urlsplit(self.url).port or 80
+            path = CompressService.token_file(working_dir, port)
+            try:
+                with open(path, encoding='utf-8') as f:
+                    token = f.read().strip()
+            except OSError as e:
+                raise CompressException('读取服务令牌失败，请确认服务已启动', {'path': path, 'err': e})
+        self.token = token
+
+    def _request(self, method, path, body=None, content_type='application/json', timeout=None):
+        if isinstance(body, dict):
+            body = json.dumps(body, ensure_ascii=False).encode()
+        headers = {'content-type': content_type} if body is not None else {}
+        if self.token is not None:
+            headers['authorization'] = f'Bearer {self.token}'
+        req = urllib.request.Request(self.url + path, data=body, method=method, headers=headers)
+        return urllib.request.urlopen(req, timeout=self.timeout if timeout is None else timeout)
+
+    def status(self) -> dict:
+        with self._request('GET', '/status') as res:
+            return json.load(res)
+
+    def submit(self, paths, new_dir=None, recursive=False) -> str:
+        """
+        提交批量压缩任务
+        :return: 任务id
+        """
+        body = {'paths': [os.path.abspath(p) for p in paths], 'new_dir': new_dir and os.path.abspath(new_dir),
+                'recursive': recursive}
+        with self._request('POST', '/jobs', body) as res:
+            return json.load(res)['id']
+
+    def job(self, job_id) -> dict:
+        with self._request('GET', f'/jobs/{job_id}') as res:
+            return json.load(res)
+
+    def events(self, job_id, start=0):
+        """
+        流式读取任务的文件结果
+        :return: 生成器，产出每个文件的结果，最后产出任务汇总（event为done）
+        """
+        with self._request('GET', f'/jobs/{job_id}/events?from={start}', timeout=max(self.timeout, 60)) as res:
+            for line in res:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if event['event'] != 'ping':
+                    yield event
+
+    def compress_bytes(self, data: bytes, name='image.png') -> bytes:
+        with self._request('POST', f'/compress?name={urllib.parse.quote(name)}', data,
+                           'application/octet-stream', timeout=max(self.timeout, 300)) as res:
+            return res.read()
+
+    def shutdown(self):
+        with self._request('POST', '/shutdown', b''):
+            pass
@@ -1,14 +1,19 @@
-import time
 from random import sample
+from typing import TYPE_CHECKING
+
 from loguru import logger
-from requests import Session
 
 from tinypng_unlimited.errors import SnapMailException
+from tinypng_unlimited.retry import RetryPolicy
+
+if TYPE_CHECKING:
+    from requests import Session
 
 
 class SnapMail:
     BASE_URL = 'https://www.snapmail.cc/'
     mail: str = None
+    retry_policy = RetryPolicy(retries=3, base_delay=5, max_delay=20)  # 邮件可能尚未送达，间隔较长
 
     @classmethod
     def create_new_mail(cls) -> str:
@@ -16,41 +21,34 @@ class SnapMail:
         return cls.mail
 
     @classmethod
-    def session_get(cls, session: Session, url: str, params: dict = None) -> dict:
+    def session_get(cls, session: 'Session', url: str, params: dict = None) -> dict:
         if cls.mail is None:
             cls.create_new_mail()
 
-        retry = 0
-        while True:
+        def get() -> dict:
             res = session.get(cls.BASE_URL + url.strip('/'), params=params)
-            if res.status_code != 200:
-                try:
-                    err = res.json()['error']
-                    if err.find('Email was not found') > -1:
-                        raise SnapMailException('邮箱内无任何邮件', err)
-                    elif err.find('Please try again') > -1:
-                        raise SnapMailException('邮箱请求过频繁', err)
-                    # 其他错误
-                    logger.error(err)
-                except SnapMailException as e:
-                    # 明确错误
-                    err = e
-                    logger.error(err)
-                except Exception:
-                    # 未知错误
-                    err = res.text
-                    logger.error('未知邮箱请求错误 {}', err)
-
-                retry += 1
-                if retry <= 3:
-                    logger.info(f'等待10s后进行第{retry}次重试')
-                    time.sleep(10)
-                else:
-                    raise SnapMailException('超过重试次数', 3)
-            else:
-                # 状态码200则返回
+            if res.status_code == 200:
                 return res.json()
+            # 邮件尚未送达等错误均不带状态码，视为可重试
+            try:
+                err = res.json()['error']
+            except Exception:
+                raise SnapMailException('未知邮箱请求错误', res.text)
+            if err.find('Email was not found') > -1:
+                raise SnapMailException('邮箱内无任何邮件', err)
+            elif err.find('Please try again') > -1:
+                raise SnapMailException('邮箱请求过频繁', err)
+            raise SnapMailException('邮箱请求错误', err)
+
+        def on_retry(attempt, e, delay):
+            logger.warning('邮箱请求失败: {}，已等待{:.1f}s后进行第{}次重试', e, delay, attempt)
+
+        try:
+            return cls.retry_policy.call(get, url=cls.BASE_URL, on_retry=on_retry)
+        except Exception as e:
+            logger.error(e)
+            raise SnapMailException('超过重试次数', e)
 
     @classmethod
-    def get_email_list(cls, session: Session, count: int = None):
+    def get_email_list(cls, session: 'Session', count: int = None):
         return cls.session_get(session, f'emailList/{cls.mail}', count if count is None else {'count': count})
@@ -0,0 +1,139 @@
+import time
+from bisect import bisect_left
+
+from loguru import logger
+
+
+class FileTiming:
+    """
+    单个文件各阶段的耗时与传输字节数。阶段按顺序以lap划分，
+    lap之间用add记录的嵌套阶段（如上传中的云端压缩）会从所在lap中扣除
+    """
+    __slots__ = ('path', 'start', 'last', 'total', 'stages', 'bytes', '_t0', '_nested')
+
+    def __init__(self, path):
+        self.path = path
+        self.start = time.time()
+        self.total = None
+        self.stages = {}  # 阶段 -> [首次开始距文件开始的秒数, 累计耗时(s)]
+        self.bytes = {}  # 阶段 -> 传输字节数
+        self._t0 = self.last = time.perf_counter()
+        self._nested = 0.0  # 当前lap内已由add记录的耗时
+
+    def add(self, stage, duration, nbytes=None):
+        """
+        记录当前lap内的嵌套阶段，重试时累加
+        """
+        self._record(stage, time.perf_counter() - duration, duration, nbytes)
+        self._nested += duration
+
+    def lap(self, stage, nbytes=None, until=None):
+        """
+        记录从上一个lap结束到现在（或until）的阶段
+        :param until: 阶段结束时的perf_counter，默认为当前
+        """
+        until = time.perf_counter() if until is None else until
+        self._record(stage, self.last, max(until - self.last - self._nested, 0.0), nbytes)
+        self.last, self._nested = until, 0.0
+
+    def _record(self, stage, begin, duration, nbytes):
+        entry = self.stages.get(stage)
+        if entry is None:
+            self.stages[stage] = [begin - self._t0, duration]
+        else:
+            entry[1] += duration
+        if nbytes:
+            self.bytes[stage] = self.bytes.get(stage, 0) + nbytes
+
+    def finish(self):
+        if self.total is None:
+            self.total = time.perf_counter() - self._t0
+
+    def to_dict(self) -> dict:
+        self.finish()
+        return {
+            'path': self.path, 'start': round(self.start, 3), 'total': round(self.total, 4),
+            'stages': {k: [round(v[0], 4), round(v[1], 4)] for k, v in self.stages.items()},
+            'bytes': self.bytes,
+        }
+
+
+class StageHistogram:
+    """
+    各阶段耗时的分布统计
+    """
+    BOUNDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # 桶上界(s)
+
+    def __init__(self):
+        self._stages = {}  # 阶段 -> [次数, 总耗时, 各桶计数]
+
+    def add(self, timing: FileTiming):
+        for stage, (_, duration) in timing.stages.items():
+            self._add(stage, duration)
+        self._add('total', timing.total)
+
+    def _add(self, stage, duration):
+        entry = self._stages.get(stage)
+        if entry is None:
+            entry = self._stages[stage] = [0, 0.0, [0] * (len(self.BOUNDS) + 1)]
+        entry[0] += 1
+        entry[1] += duration
+        entry[2][bisect_left(self.BOUNDS, duration)] += 1
+
+    def to_dict(self) -> dict:
+        labels = [f'<={b}s' for b in self.BOUNDS] + [f'>{self.BOUNDS[-1]}s']
+        return {stage: {'count': count, 'sum': round(total, 4), 'mean': round(total / count, 4),
+                        'buckets': {label: n for label, n in zip(labels, buckets) if n}}
+                for stage, (count, total, buckets) in self._stages.items()}
+
+
+class Timing:
+    """
+    分阶段计时开关与回调，关闭时不创建任何计时对象，对压缩过程几乎没有影响
+    阶段: queue 排队, prepare 检查标记与缓存, wait 等待并发名额与压缩次数, upload 上传,
+    shrink 云端压缩, handoff 等待下载线程, download 下载, write 写入磁盘, finalize 记录缓存与索引, retry 失败重试,
+    coalesce 复用批次内相同内容文件的结果
+    """
+    enabled: bool = False
+    histograms: bool = False  # 报告中是否附带各阶段耗时分布
+    files: bool = True  # 报告中是否附带每个文件的计时明细
+    _callbacks: list = []
+
+    @classmethod
+    def enable(cls, histograms=False, files=True, callback=None):
+        """
+        开启分阶段计时
+        :param histograms: 报告中是否附带各阶段耗时分布
+        :param files: 报告中是否附带每个文件的计时明细
+        :param callback: 每个文件完成时的回调callback(timing: dict)，在统计结果的线程中调用
+        """
+        cls.enabled, cls.histograms, cls.files = True, histograms, files
+        if callback is not None:
+            cls.add_callback(callback)
+
+    @classmethod
+    def disable(cls):
+        cls.enabled = False
+
+    @classmethod
+    def add_callback(cls, callback):
+        cls._callbacks.append(callback)
+
+    @classmethod
+    def remove_callback(cls, callback):
+        cls._callbacks.remove(callback)
+
+    @classmethod
+    def new(cls, path) -> FileTiming:
+        """
+        开启时返回新的计时对象，否则返回None
+        """
+        return FileTiming(path) if cls.enabled else None
+
+    @classmethod
+    def emit(cls, timing: dict):
+        for callback in cls._callbacks:
+            try:
+                callback(timing)
+            except Exception as e:
+                logger.warning('计时回调出错: {}', e)
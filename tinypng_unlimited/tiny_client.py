@@ -0,0 +1,153 @@
+from threading import Lock
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from requests import Response
+
+
+class TinyClient:
+    """
+    绑定单个密钥的客户端，拥有独立的连接池与压缩次数，
+    切换密钥时新建客户端，已在旧客户端上进行的请求不受影响
+    """
+    LIMIT = 500  # 每个密钥每月的免费压缩次数
+
+    def __init__(self, key, proxy=None, pool_size=8, api_endpoint='https://api.tinify.com'):
+        """
+        :param key: api密钥
+        :param proxy: 代理地址
+        :param pool_size: 连接池大小，应不小于并发数
+        :param api_endpoint: api地址
+        """
+        self.key = key
+        self.api_endpoint = api_endpoint.rstrip('/')
+        self.compression_count = None  # 服务器返回的已用次数，None表示未知
+        self.reserved = 0  # 已预留但尚未得到服务器响应的次数
+        self._lock = Lock()
+        self._validate_lock = Lock()
+
+        from requests import Session  # 载入较慢，创建客户端时才导入
+        from requests.adapters import HTTPAdapter
+
+        self.session = Session()
+        self.session.auth = ('api', key)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(1, pool_size))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.set_proxy(proxy)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def set_proxy(self, proxy):
+        self.session.proxies = {'https': proxy, 'http': proxy} if proxy else {}
+
+    def update_count(self, count):
+        """
+        根据响应头compression-count更新压缩次数，并发响应可能乱序到达，只取较大值
+        """
+        if count is not None:
+            with self._lock:
+                self.compression_count = max(int(count), self.compression_count or 0)
+
+    def remaining(self) -> int:
+        """
+        剩余可预留的压缩次数，次数未知时联网验证
+        """
+        if self.compression_count is None:
+            with self._validate_lock:  # 避免多个线程同时验证
+                if self.compression_count is None:
+                    self.validate()
+        with self._lock:
+            return self.LIMIT - self.compression_count - self.reserved
+
+    def reserve(self) -> bool:
+        """
+        上传前预留一次压缩次数，次数不足时返回False
+        """
+        if self.compression_count is None:
+            self.remaining()
+        with self._lock:
+            if self.compression_count + self.reserved >= self.LIMIT:
+                return False
+            self.reserved += 1
+            return True
+
+    def release(self):
+        """
+        上传结束（无论成功与否）后归还预留，实际次数以响应头为准
+        """
+        with self._lock:
+            self.reserved -= 1
+
+    def too_many_requests(self, headers):
+        """
+        处理429响应：带Retry-After的是临时限流，按重试策略退避后重试即可；
+        否则为本月次数已用完（如被其他进程用尽），之后的预留均失败以触发切换密钥
+        """
+        if headers.get('retry-after') is None:
+            self.update_count(self.LIMIT)
+
+    @staticmethod
+    def _error(res: 'Response') -> Exception:
+        import tinify  # 只用于构造与原库一致的异常
+        try:
+            details = res.json()
+        except Exception:
+            details = {'message': res.text, 'error': 'ParseError'}
+        return tinify.Error.create(details.get('message'), details.get('error'), res.status_code)
+
+    def validate(self, timeout=30) -> int:
+        """
+        验证密钥并获取压缩次数
+        """
+        res = self.session.post(f'{self.api_endpoint}/shrink', timeout=timeout)
+        self.update_count(res.headers.get('compression-count'))
+        # 不带图片上传时返回400说明密钥可用，429（不带Retry-After）说明密钥本月次数已用完
+        if res.status_code not in (400, 429) or (res.status_code == 429 and 'retry-after' in res.headers):
+            raise self._error(res)
+        self.update_count(self.LIMIT if res.status_code == 429 else 0)
+        return self.compression_count
+
+    def shrink(self, f, timeout=60) -> str:
+        """
+        上传图片，返回云端压缩后图片链接
+        :param f: 文件对象或bytes
+        :param timeout: 服务器响应超时时间，注意此时间在每次服务器做出任何响应时重置，所以不是整个请求和响应的时间
+        """
+        res = self.session.post(f'{self.api_endpoint}/shrink', data=f, timeout=timeout)
+        self.update_count(res.headers.get('compression-count'))
+        if res.status_code == 429:
+            self.too_many_requests(res.headers)
+        if res.status_code != 201:
+            raise self._error(res)
+        return res.headers.get('location')
+
+    def get(self, url, timeout=30, stream=True) -> 'Response':
+        """
+        下载压缩后的图片
+        """
+        res = self.session.get(url, stream=stream, timeout=timeout)
+        if res.status_code != 200:
+            raise self._error(res)
+        return res
+
+    def output(self, url, options: dict, timeout=30, stream=True) -> 'Response':
+        """
+        对云端压缩后的图片调整尺寸或转换格式并下载，不需要重新上传，但每次消耗一次压缩次数
+        :param url: 上传得到的图片链接
+        :param options: json参数，如{'resize': {'method': 'fit', 'width': 800, 'height': 600}}
+        """
+        res = self.session.post(url, json=options, stream=stream, timeout=timeout)
+        self.update_count(res.headers.get('compression-count'))
+        if res.status_code == 429:
+            self.too_many_requests(res.headers)
+        if res.status_code != 200:
+            raise self._error(res)
+        return res
@@ -2,87 +2,438 @@ import os
 import re
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from shutil import move
-from threading import RLock
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from shutil import copyfile
+from threading import RLock, Thread, local
+from uuid import uuid4
 
-import tinify
 from loguru import logger
-from requests import Session
 from tqdm import tqdm
-from tqdm.utils import CallbackIOWrapper
 
 import tinypng_unlimited  # 不使用from import防止交叉引用
+from tinypng_unlimited.concurrency import ConcurrencyController
 from tinypng_unlimited.errors import CompressException
+from tinypng_unlimited.journal import Journal
+from tinypng_unlimited.manifest import Manifest
+from tinypng_unlimited.pipeline import Pipeline, CompressJob
+from tinypng_unlimited.progress import ProgressReporter
+from tinypng_unlimited.report import Report, byte_converter
+from tinypng_unlimited.result_cache import ResultCache
+from tinypng_unlimited.retry import RetryPolicy
+from tinypng_unlimited.tiny_client import TinyClient
+from tinypng_unlimited.timing import Timing, FileTiming
+from tinypng_unlimited.upload_body import UploadBody
+from tinypng_unlimited.variant import Variant
+from tinypng_unlimited.work_queue import WorkQueue
 
 
 class TinyImg:
+    API_ENDPOINT = 'https://api.tinify.com'
     _lock: RLock = RLock()
-    _session: Session = Session()
+    _client: TinyClient = None  # 当前密钥的客户端
     tmp_dir: str
+    proxy: str = None
+    upload_block_size: int = 256 * 1024  # 上传时每次发送的字节数
+    download_buffer_size: int = 1024 * 1024  # 下载时每次读取的字节数
+    preserve_stat: bool = False  # 压缩后的文件是否保留原文件的权限与修改时间
+    headless: bool = False  # 无界面模式
+    progress_interval: float = 5.0  # 无界面模式下汇总进度的输出间隔(s)
+    _local = local()  # 各线程复用的下载缓冲区
+    min_workers: int = 2
+    max_workers: int = 8
+    download_workers: int = 4
+    ORDERS = ('largest', 'smallest', 'fifo')
+    order: str = 'largest'  # 分组内文件的提交顺序
+    retry_policy: RetryPolicy = RetryPolicy()  # 上传、下载失败时的重试策略
+    variants: tuple = ()  # 每个文件默认生成的衍生图片
+    variant_workers: int = 8  # 同时请求衍生图片的线程数
+    TMP_NAME = re.compile(r'^\..+\.[0-9a-f]{8}\.tmp$')  # _tmp_path生成的临时文件名
+    tmp_max_age: float = 3600  # 目标文件旁的临时文件超过该时间(s)未修改视为异常退出时遗留
+    _variant_pool: ThreadPoolExecutor = None
 
     @classmethod
     def set_key(cls, key):
         """
-        设置新密钥并进行验证
+        设置新密钥，有效期内记录过压缩次数则直接使用，否则在后台线程验证，
+        与扫描文件夹等准备工作同时进行，首次上传时若仍未验证完成则等待
         """
 
         with cls._lock:  # 加锁避免多个线程尝试切换密钥
             cls.tmp_dir = os.path.abspath(os.path.join(tinypng_unlimited.KeyManager.working_dir, 'tmp'))
             logger.debug('正在载入密钥: {}', key)
-            tinify.key = key
-            tinify.validate()
-            logger.success('密钥已载入，当前密钥可用性: [{}/500]', cls.compression_count())
-            cls.check_compression_count()
+            client = TinyClient(key, cls.proxy, cls.max_workers + cls.download_workers, cls.API_ENDPOINT)
+            count = tinypng_unlimited.KeyManager.cached_count(key)
+            # 仅替换当前客户端，旧客户端上进行中的上传下载不受影响，结束后由其持有者释放
+            cls._client = client
+            if count is not None:
+                client.update_count(count)
+                logger.success('密钥已载入，当前密钥可用性(本地记录): [{}/{}]', count, client.LIMIT)
+            else:
+                Thread(target=cls._validate, args=(client,), daemon=True).start()
+
+    @classmethod
+    def _validate(cls, client: TinyClient):
+        try:
+            client.remaining()  # 与上传共用验证锁，上传线程会等待其完成
+        except Exception as e:
+            logger.warning('密钥验证失败，上传时重试: {}', e)
+            return
+        logger.success('密钥已验证，当前密钥可用性: [{}/{}]', client.compression_count, client.LIMIT)
+        cls.save_count(client)
+
+    @classmethod
+    def save_count(cls, client: TinyClient = None):
+        """
+        保存密钥的压缩次数，有效期内再次载入该密钥时不必联网验证
+        :param client: 默认为当前客户端
+        """
+        client = client or cls._client
+        if client is None or client.compression_count is None:
+            return
+        try:
+            tinypng_unlimited.KeyManager.record_count(client.key, client.compression_count)
+        except (OSError, AttributeError) as e:  # 未初始化密钥管理时不保存
+            logger.warning('密钥压缩次数保存失败: {}', e)
+
+    @classmethod
+    def clean_tmp(cls, max_age=3600):
+        """
+        删除临时文件夹中超过max_age秒未修改的文件，即之前异常退出时遗留的文件，
+        其他进程（如常驻服务）正在使用的临时文件不受影响
+        """
+        try:
+            with os.scandir(cls.tmp_dir) as it:
+                entries = list(it)
+        except (OSError, AttributeError):  # 不存在或尚未设置密钥
+            return
+        count, now = 0, time.time()
+        for entry in entries:
+            try:
+                if entry.is_file() and now - entry.stat().st_mtime > max_age:
+                    os.remove(entry.path)
+                    count += 1
+            except OSError:
+                continue
+        if count:
+            logger.debug('已清理遗留的临时文件: {}', count)
+
+    @classmethod
+    def _remove_stale_tmp(cls, entry: os.DirEntry, now) -> bool:
+        """
+        删除目标文件旁超过tmp_max_age未修改的临时文件，正在写入的临时文件不受影响
+        :return: 是否已删除
+        """
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > cls.tmp_max_age:
+                os.remove(entry.path)
+                return True
+        except OSError:
+            pass
+        return False
+
+    @classmethod
+    def clean_dir_tmp(cls, dir_path):
+        """
+        清理文件夹内异常退出时遗留的临时文件，扫描源文件夹时已一并清理，输出文件夹在批量压缩开始时清理
+        """
+        try:
+            with os.scandir(dir_path) as it:
+                entries = [entry for entry in it if cls.TMP_NAME.match(entry.name)]
+        except OSError:  # 不存在
+            return
+        now = time.time()
+        count = sum(cls._remove_stale_tmp(entry, now) for entry in entries)
+        if count:
+            logger.debug('已清理遗留的临时文件: {} ({})', count, dir_path)
 
     @classmethod
     def set_proxy(cls, proxy):
-        tinify.proxy = proxy
+        cls.proxy = proxy
+        if cls._client is not None:
+            cls._client.set_proxy(proxy)
+
+    @classmethod
+    def get_client(cls) -> TinyClient:
+        """
+        当前密钥的客户端
+        """
+        return cls._client  # 切换密钥只是替换引用，读取无需加锁
+
+    @classmethod
+    def set_concurrency(cls, min_workers=None, max_workers=None, download_workers=None):
+        """
+        设置批量压缩的上传并发数上下限（实际并发数在其间自适应调整）与下载线程数
+        """
+        if min_workers is not None:
+            cls.min_workers = min_workers
+        if max_workers is not None:
+            cls.max_workers = max_workers
+        if download_workers is not None:
+            cls.download_workers = download_workers
+
+    @classmethod
+    def set_order(cls, order):
+        """
+        设置分组内文件的提交顺序
+        :param order: largest 大文件优先，避免最后只剩一个线程在上传大文件，缩短总耗时（默认）；
+                      smallest 小文件优先，尽快完成更多文件；fifo 保持扫描顺序
+        """
+        if order not in cls.ORDERS:
+            raise CompressException('未知提交顺序', order)
+        cls.order = order
+
+    @classmethod
+    def sort_files(cls, file_list, order=None) -> list:
+        """
+        按提交顺序排列文件
+        :param file_list: 文件路径列表
+        :param order: 提交顺序，默认使用set_order的设置
+        """
+        order = cls.order if order is None else order
+        if order == 'fifo':
+            return list(file_list)
+
+        def size(path):
+            try:
+                return os.path.getsize(path)
+            except OSError:  # 交由压缩时报错
+                return 0
+
+        return sorted(file_list, key=size, reverse=order == 'largest')
+
+    @classmethod
+    def set_variants(cls, variants):
+        """
+        设置每个文件默认生成的衍生图片
+        :param variants: Variant或其描述（见Variant.parse）的列表
+        """
+        cls.variants = cls._variants(variants)
+
+    @classmethod
+    def _variants(cls, variants=None) -> tuple:
+        if variants is None:
+            return cls.variants
+        return tuple(v if isinstance(v, Variant) else Variant.parse(v) for v in variants)
+
+    @classmethod
+    def set_api_endpoint(cls, endpoint):
+        """
+        设置api地址，可指向本地的模拟服务器进行测试
+        """
+        cls.API_ENDPOINT = endpoint.rstrip('/')
+        if cls._client is not None:
+            cls._client.api_endpoint = cls.API_ENDPOINT
+
+    @classmethod
+    def set_block_size(cls, upload_block_size=None, download_buffer_size=None):
+        """
+        设置上传每次发送与下载每次读取的字节数，块越大Python层的调用越少
+        """
+        if upload_block_size is not None:
+            cls.upload_block_size = max(4096, upload_block_size)
+        if download_buffer_size is not None:
+            cls.download_buffer_size = max(4096, download_buffer_size)
+
+    @classmethod
+    def set_headless(cls, headless=True, interval=5.0):
+        """
+        设置无界面模式：不显示进度条，改为按固定间隔输出汇总进度，日志交由后台线程写入stdout，
+        适用于CI、定时任务等没有终端的场景
+        :param headless: 是否开启
+        :param interval: 汇总进度的输出间隔(s)
+        """
+        cls.headless, cls.progress_interval = headless, interval
+        logger.remove()
+        if headless:
+            logger.add(sys.stdout, colorize=False, enqueue=True, format=tinypng_unlimited.LOG_FORMAT)
+        else:
+            logger.add(lambda msg: tqdm.write(msg, end=''), colorize=True, format=tinypng_unlimited.LOG_FORMAT)
+
+    @classmethod
+    def file_bars(cls) -> bool:
+        """
+        是否显示逐文件的上传下载进度条，仅在交互终端中显示
+        """
+        return not cls.headless and sys.stdout.isatty()
+
+    @classmethod
+    def task_bar(cls, **kwargs):
+        """
+        总体任务进度条，无界面模式下为定时输出的汇总进度
+        :param kwargs: tqdm参数
+        """
+        if cls.headless:
+            return ProgressReporter(kwargs.get('desc', '[任务进度]'), kwargs.get('total'), cls.progress_interval)
+        return tqdm(**kwargs)
+
+    @classmethod
+    def set_preserve_stat(cls, preserve_stat: bool):
+        """
+        设置压缩后的文件是否保留原文件的权限与修改时间
+        """
+        cls.preserve_stat = preserve_stat
 
     @classmethod
-    def to_file_save(cls, path, url, timeout=30):
+    def _buffer(cls) -> memoryview:
         """
-        安全的下载文件并保存到指定路径
+        当前线程复用的下载缓冲区
+        """
+        buf = getattr(cls._local, 'buffer', None)
+        if buf is None or len(buf) != cls.download_buffer_size:
+            buf = cls._local.buffer = memoryview(bytearray(cls.download_buffer_size))
+        return buf
+
+    @classmethod
+    def to_file_save(cls, path, url, timeout=30, client: TinyClient = None, src=None, timing: FileTiming = None,
+                     options: dict = None):
+        """
+        安全的下载文件并保存到指定路径：大块读入复用的缓冲区写入目标旁的临时文件，完成后原子替换
         :param path: 路径
         :param url: 图片下载链接
         :param timeout: 下载超时
+        :param client: 下载使用的客户端，默认为当前客户端
+        :param src: 源文件路径，开启preserve_stat时从该文件复制权限与修改时间
+        :param timing: 分阶段计时，写入磁盘的耗时记为write，其余为download
+        :param options: 调整尺寸、转换格式的参数，不为None时请求衍生图片
         """
         file_name = os.path.basename(path)
-        if not os.path.exists(cls.tmp_dir):
-            os.mkdir(cls.tmp_dir)
-        tmp_path = os.path.abspath(os.path.join(cls.tmp_dir, f'{file_name}_{round(time.time())}'))
-        res = cls._session.get(url, stream=True, timeout=timeout)
+        tmp_path = cls._tmp_path(path)
+        client = client or cls.get_client()
+        res = client.get(url, timeout=timeout) if options is None else client.output(url, options, timeout)
+        res.raw.decode_content = True  # 直接读取底层响应，由其处理可能的压缩编码
         file_size = int(res.headers.get('content-length', 0))
-        with tqdm(file=sys.stdout, desc=f'[下载进度]: {file_name}', colour='red', ncols=120, leave=False,
-                  ascii=' ▇', total=file_size, unit="B", unit_scale=True, unit_divisor=1024) as bar:
-            with open(tmp_path, 'wb') as f:
-                wrapped_file = CallbackIOWrapper(bar.update, f, 'write')
-                for data in res.iter_content(2048):
-                    wrapped_file.write(data)
-                f.write(b'tiny')
-                logger.info('已为图片添加压缩标记tiny: {}', file_name)
-            move(tmp_path, path)
+        buf = cls._buffer()
+        received = write_time = 0
+        try:
+            with tqdm(file=sys.stdout, desc=f'[下载进度]: {file_name}', colour='red', ncols=120, leave=False,
+                      ascii=' ▇', total=file_size, unit="B", unit_scale=True, unit_divisor=1024,
+                      disable=not cls.file_bars()) as bar:
+                with open(tmp_path, 'wb', buffering=0) as f:  # 已按大块写入，不再经过文件缓冲
+                    while True:
+                        n = res.raw.readinto(buf)
+                        if not n:
+                            break
+                        if timing is None:
+                            f.write(buf[:n])
+                        else:
+                            start = time.perf_counter()
+                            f.write(buf[:n])
+                            write_time += time.perf_counter() - start
+                            received += n
+                        bar.update(n)
+                    f.write(b'tiny')
+                    logger.info('已为图片添加压缩标记tiny: {}', file_name)
+                start = time.perf_counter()
+            cls._finish_file(tmp_path, path, src)
+            if timing is not None:
+                timing.add('write', write_time + time.perf_counter() - start)
+                timing.lap('download', received)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            res.close()
+
+    @classmethod
+    def _finish_file(cls, tmp_path, path, src=None):
+        """
+        按需复制源文件的权限与修改时间后，将临时文件原子替换为目标文件
+        """
+        src = src or path
+        if cls.preserve_stat and os.path.exists(src):
+            stat = os.stat(src)
+            os.chmod(tmp_path, stat.st_mode)
+            os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def reuse_output(cls, output_path, new_path, src, variants=()) -> int:
+        """
+        复用相同内容文件的压缩结果，衍生图片一同复用
+        :param output_path: 相同内容文件的输出文件路径
+        :param new_path: 新文件路径
+        :param src: 源文件路径
+        :return: 新文件大小
+        """
+        pairs = [(output_path, new_path)] + [(v.path(output_path), v.path(new_path)) for v in variants]
+        for path, dst in pairs:
+            if os.path.abspath(path) != os.path.abspath(dst):
+                tmp_path = cls._tmp_path(dst)
+                copyfile(path, tmp_path)
+                cls._finish_file(tmp_path, dst, src)
+            Manifest.record(dst)
+        return os.path.getsize(new_path)
+
+    @classmethod
+    def _tmp_path(cls, path) -> str:
+        """
+        临时下载文件路径，与目标文件位于同一文件夹，保证最后的替换不会跨文件系统复制
+        :param path: 目标文件路径
+        """
+        dir_path, file_name = os.path.split(os.path.abspath(path))
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+        # 同一文件可能同时被多个任务写入，加入随机串避免冲突
+        return os.path.join(dir_path, f'.{file_name}.{uuid4().hex[:8]}.tmp')
 
     @classmethod
     def compression_count(cls) -> int:
         """
-        api调用次数
+        api调用次数，仅在本地未知时联网验证
         """
-        with cls._lock:
-            if tinify.compression_count is None:
-                tinify.validate()
-            return tinify.compression_count
+        client = cls._client
+        client.remaining()
+        return client.compression_count
 
     @classmethod
     def check_compression_count(cls):
         """
         检测密钥是否限额，限额则替换为下一条
         """
-        count = cls.compression_count()
-        # logger.debug('当前密钥可用性: [{}/500]', count)
-        if count >= 490:  # 即将达到限额，更换新密钥（多线程，提前留好余量）
-            logger.warning('当前密钥即将达到限额: [{}/500], 正在切换新密钥', count)
-            cls.set_key(tinypng_unlimited.KeyManager.next_key())
+        client = cls._client
+        if client.remaining() <= 0:
+            cls.rotate_key(client)
+
+    @classmethod
+    def rotate_key(cls, exhausted: TinyClient):
+        """
+        当前密钥次数用完时切换为下一条
+        :param exhausted: 发现次数用完的客户端，若当前客户端已不是它说明其他线程已完成切换
+        """
+        key_manager = tinypng_unlimited.KeyManager
+        with cls._lock:  # 加锁避免多个线程同时切换密钥，只在切换时才会阻塞
+            if cls._client is not exhausted:
+                return
+            logger.warning('当前密钥已达到限额: [{}/{}], 正在切换新密钥', exhausted.compression_count, exhausted.LIMIT)
+            cls.save_count(exhausted)
+            key = key_manager.next_key(exhausted.key)
+            if key is not None:
+                cls.set_key(key)
+        # 申请新密钥需要联网，在锁外进行，其他线程继续使用切换后的密钥
+        key_manager.replenish()
+        if key is not None:
+            return
+        with cls._lock:
+            if cls._client is not exhausted:  # 其他线程已完成切换
+                return
+            key = key_manager.next_key(exhausted.key)
+            if key is None:
+                raise Exception('无可用密钥，请申请后重试')
+            cls.set_key(key)
+
+    @classmethod
+    def reserve_client(cls) -> TinyClient:
+        """
+        在当前客户端上预留一次压缩次数，次数不足时切换密钥后重试
+        :return: 已预留次数的客户端，上传结束后需调用其release()
+        """
+        while True:
+            client = cls._client
+            if client.reserve():
+                return client
+            cls.rotate_key(client)
 
     @classmethod
     def check_if_compressed(cls, path) -> bool:
@@ -90,169 +441,567 @@ class TinyImg:
         检验图片是否被本程序标记为压缩
         """
         with open(path, 'rb') as f:
+            if f.seek(0, 2) < 4:
+                return False
             f.seek(-4, 2)
             return f.read(4) == b'tiny'
 
     @classmethod
-    def upload_from_file(cls, f, timeout=60) -> str:
+    def check_file(cls, path, check_compressed=True) -> tuple:
+        """
+        上传前读取文件大小与压缩标记，读取失败或文件为空时抛出压缩错误，文件不存在等错误不可重试
+        :return: (文件大小，是否带有压缩标记)
+        """
+        try:
+            old_size = os.path.getsize(path)
+            if old_size == 0:
+                raise CompressException('图片文件为空', {'path': path, 'permanent': True})
+            return old_size, check_compressed and cls.check_if_compressed(path)
+        except OSError as e:
+            raise cls.read_error(path, e)
+
+    @classmethod
+    def read_error(cls, path, e: Exception) -> CompressException:
+        """
+        读取本地文件失败时的压缩错误
+        """
+        return CompressException('读取图片失败', {'path': path, 'err': e, 'permanent': cls.retry_policy.is_permanent(e)})
+
+    @classmethod
+    def upload_from_file(cls, f, timeout=60, client: TinyClient = None) -> str:
         """
-        重写库方法添加超时参数，上传图片，返回云端压缩后图片链接
+        上传图片，返回云端压缩后图片链接
         :param timeout: 服务器响应超时时间，注意此时间在每次服务器做出任何响应时重置，所以不是整个请求和响应的时间
-        :param f: 文件对象
+        :param f: 文件对象、bytes或UploadBody（内存映射，按块发送）
+        :param client: 上传使用的客户端，默认为当前客户端
         """
-        s: Session = tinify.get_client().session
-        res = s.post('https://api.tinify.com/shrink', data=f, timeout=timeout)
-        count = res.headers.get('compression-count')
-        tinify.compression_count = int(count)
-        return res.headers.get('location')
+        return (client or cls.get_client()).shrink(f, timeout=timeout)
 
     @classmethod
-    def compress_from_file(cls, path, new_path, check_compressed=True,
-                           upload_timeout=None, download_timeout=None) -> tuple:
+    def prepare(cls, path, new_path, check_compressed=True, variants=()) -> tuple:
         """
-        压缩图片文件
+        上传前检查压缩标记与结果缓存
         :param path: 文件路径
         :param new_path: 新文件路径
         :param check_compressed: 是否检查压缩标记
-        :param upload_timeout: 上传响应超时时间，默认60s
-        :param download_timeout: 下载响应超时时间，默认30s
-        :return: (旧大小，新大小，压缩到原来的百分比)
+        :param variants: 需要生成的衍生图片，有衍生图片尚未生成时不使用结果缓存，
+            已带有压缩标记的文件（包括衍生图片本身）不再生成衍生图片
+        :return: (无需上传时的压缩结果或None，源文件哈希或None)
         """
-        old_size = os.path.getsize(path)
+        old_size, compressed = cls.check_file(path, check_compressed)
         file_name = os.path.basename(path)
-        if check_compressed and cls.check_if_compressed(path):
+        if compressed:
             logger.info('图片已带有压缩标记，不做压缩处理: {}', file_name)
+            Manifest.record(path)  # 旧版本压缩的文件，记录后下次扫描无需再打开检查
             time.sleep(0.5)  # 似乎返回值太快会对多线程任务造成影响
-            return file_name, old_size, old_size, '100.0%'
+            return (file_name, old_size, old_size, '100.0%', 'marked'), None
 
-        retry = 0
-        while True:
+        digest = None
+        if ResultCache.enabled:
             try:
-                # 加锁保证只有一个线程能进行检查（避免多线程同时检查，同时切换api）
-                # 但是切换密钥会中断其他请求，因为tinify库中是共享同一个client
-                with cls._lock:
-                    cls.check_compression_count()  # 检验压缩次数是否足够
-                    old_key = tinify.key
-                with tqdm(file=sys.stdout, desc=f'[上传进度]: {file_name}', colour='green', ncols=120, leave=False,
-                          ascii=' ▇', total=old_size, unit="B", unit_scale=True, unit_divisor=1024) as bar:
-                    logger.info('正在上传图片至云端压缩[{}]: {}', cls._byte_converter(old_size), file_name)
-                    with open(path, "rb") as f:
-                        wrapped_file = CallbackIOWrapper(bar.update, f, "read")
-                        url = cls.upload_from_file(wrapped_file, timeout=upload_timeout)
-                    # 上传完成得到图片链接，并更新了api调用次数
-                    with cls._lock:
-                        # 新旧密钥切换时，使用旧密钥上传图片的响应会覆盖新密钥的值，所以需要刷新一下
-                        if tinify.key != old_key:
-                            tinify.validate()
-                        logger.success('云端压缩成功，正在下载: {}', file_name)
-                        logger.info('当前密钥可用性: [{}/500]', cls.compression_count())
-                cls.to_file_save(new_path, url, timeout=download_timeout)
+                digest = ResultCache.file_digest(path)
+            except OSError as e:
+                raise cls.read_error(path, e)
+            fresh = all(os.path.exists(v.path(new_path)) for v in variants)
+            if fresh and ResultCache.get(digest, new_path, cls._tmp_path(new_path)):
+                logger.info('命中压缩结果缓存，跳过上传: {}', file_name)
+                Manifest.record(new_path)
                 new_size = os.path.getsize(new_path)
-                return file_name, old_size, new_size, f'{round(100 * new_size / old_size, 2)}%'
+                return (file_name, old_size, new_size, f'{round(100 * new_size / old_size, 2)}%', 'cache'), None
+        return None, digest
+
+    @classmethod
+    def upload(cls, path, upload_timeout=None, client: TinyClient = None, timing: FileTiming = None) -> tuple:
+        """
+        检验压缩次数后上传图片文件（带上传进度条）
+        :param path: 文件路径
+        :param upload_timeout: 上传响应超时时间，默认60s
+        :param client: 指定上传使用的客户端（由调用方管理其密钥），默认为当前客户端并在次数不足时切换密钥
+        :param timing: 分阶段计时，记录wait、upload与shrink阶段
+        :return: (云端压缩后图片链接，上传使用的客户端)
+        """
+        old_size = os.path.getsize(path)
+        file_name = os.path.basename(path)
+        # 上传前在本地预留压缩次数，不再每次加锁检查，次数不足才切换密钥
+        if client is None:
+            client = cls.reserve_client()
+        elif not client.reserve():
+            raise CompressException('指定密钥的压缩次数已用完', {'path': path, 'key': client.key})
+        if timing is not None:
+            timing.lap('wait')
+        # 请求绑定在开始时的客户端上，切换密钥不会中断，压缩次数也只更新到该客户端
+        try:
+            with tqdm(file=sys.stdout, desc=f'[上传进度]: {file_name}', colour='green', ncols=120, leave=False,
+                      ascii=' ▇', total=old_size, unit="B", unit_scale=True, unit_divisor=1024,
+                      disable=not cls.file_bars()) as bar:
+                logger.info('正在上传图片至云端压缩[{}]: {}', cls._byte_converter(old_size), file_name)
+                with UploadBody(path, cls.upload_block_size, None if bar.disable else bar.update) as body:
+                    url = cls.upload_from_file(body, timeout=upload_timeout, client=client)
+            if timing is not None:  # 请求体发送完成到收到响应为云端压缩耗时
+                timing.add('shrink', time.perf_counter() - (body.sent_at or time.perf_counter()))
+                timing.lap('upload', old_size)
+        finally:
+            client.release()
+        # 上传完成得到图片链接，并更新了api调用次数
+        logger.success('云端压缩成功，正在下载: {}', file_name)
+        logger.info('当前密钥可用性: [{}/{}]', client.compression_count, client.LIMIT)
+        return url, client
+
+    @classmethod
+    def download(cls, new_path, url, digest=None, download_timeout=None, client: TinyClient = None,
+                 src=None, timing: FileTiming = None) -> int:
+        """
+        下载压缩后的图片并记录结果
+        :param new_path: 新文件路径
+        :param url: 云端压缩后图片链接
+        :param digest: 源文件哈希，不为None则保存至结果缓存
+        :param download_timeout: 下载响应超时时间，默认30s
+        :param client: 下载使用的客户端，应与上传时相同
+        :param src: 源文件路径
+        :param timing: 分阶段计时，记录download、write与finalize阶段
+        :return: 新文件大小
+        """
+        cls.to_file_save(new_path, url, timeout=download_timeout, client=client, src=src, timing=timing)
+        if digest is not None:
+            ResultCache.put(digest, new_path)
+        Manifest.record(new_path)
+        if timing is not None:
+            timing.lap('finalize')
+        return os.path.getsize(new_path)
+
+    @classmethod
+    def download_variant(cls, variant: Variant, new_path, url, download_timeout=None, client: TinyClient = None,
+                         src=None) -> int:
+        """
+        对云端压缩后的图片请求一个衍生图片并保存
+        :param variant: 衍生图片
+        :param new_path: 压缩后的图片路径，衍生图片保存在其旁边
+        :param url: 上传得到的图片链接
+        :param client: 请求使用的客户端，应与上传时相同
+        :return: 衍生图片大小
+        """
+        path = variant.path(new_path)
+        client = client or cls.get_client()
+        if not client.reserve():  # 图片链接只能由上传的密钥请求，次数不足时不能切换密钥
+            raise CompressException('指定密钥的压缩次数已用完', {'path': src, 'key': client.key})
+        try:
+            cls.to_file_save(path, url, timeout=download_timeout, client=client, src=src, options=variant.options())
+        finally:
+            client.release()
+        Manifest.record(path)
+        logger.success('衍生图片已生成[{}]: {}', variant.name, os.path.basename(path))
+        return os.path.getsize(path)
+
+    @classmethod
+    def download_variants(cls, variants, new_path, url, download_timeout=None, client: TinyClient = None,
+                          src=None) -> list:
+        """
+        由同一个图片链接并行请求多个衍生图片，各自按retry_policy重试
+        :return: 各衍生图片大小
+        """
+        if not variants:
+            return []
+        with cls._lock:
+            if cls._variant_pool is None:
+                cls._variant_pool = ThreadPoolExecutor(cls.variant_workers, thread_name_prefix='variant')
+
+        def fetch(variant: Variant) -> int:
+            def on_retry(n, e, delay):
+                logger.warning('重试衍生图片[{}](第{}次，已等待{:.1f}s): {}, 错误信息: {}',
+                               variant.name, n, delay, os.path.basename(new_path), e)
+
+            return cls.retry_policy.call(cls.download_variant, variant, new_path, url, download_timeout, client, src,
+                                         url=url, on_retry=on_retry)
+
+        futures = [cls._variant_pool.submit(fetch, v) for v in variants]
+        sizes, error = [], None
+        for variant, future in zip(variants, futures):  # 等待全部完成后再报告错误
+            try:
+                sizes.append(future.result())
             except Exception as e:
-                retry += 1
-                if retry <= 3:
-                    logger.warning('重试压缩图片(第{}次): {}, 错误信息: {}', retry, file_name, e)
-                else:
-                    raise CompressException('超出压缩重试次数', {'path': path, 'err': e})
+                error = error or cls.variant_error(src or new_path, variant, e)
+        if error is not None:
+            raise error
+        return sizes
+
+    @classmethod
+    def variant_error(cls, path, variant: Variant, e: Exception) -> CompressException:
+        """
+        衍生图片不再重试时的压缩错误，压缩后的图片已保存，再次压缩时只需补全衍生图片
+        """
+        return CompressException('衍生图片压缩失败', {'path': path, 'variant': variant.name, 'err': e,
+                                                'permanent': cls.retry_policy.is_permanent(e)})
+
+    @staticmethod
+    def is_expired(e: Exception) -> bool:
+        """
+        下载失败是否因为云端压缩后的图片已过期（或链接无效），此时只能重新上传
+        """
+        return RetryPolicy.status_of(e) in (404, 410)
 
     @classmethod
-    def compress_from_file_list(cls, file_list, new_dir=None, upload_timeout=None, download_timeout=None) -> dict:
+    def retry_error(cls, path, e: Exception, retries) -> CompressException:
+        """
+        不再重试时的压缩错误，记录重试次数与错误是否可重试
+        """
+        if cls.retry_policy.is_permanent(e):
+            return CompressException('压缩失败，错误不可重试',
+                                     {'path': path, 'err': e, 'retries': retries, 'permanent': True})
+        return CompressException('超出压缩重试次数', {'path': path, 'err': e, 'retries': retries})
+
+    @classmethod
+    def compress_from_file(cls, path, new_path, check_compressed=True,
+                           upload_timeout=None, download_timeout=None, controller=None,
+                           timing: FileTiming = None, on_retry=None, variants=None) -> tuple:
+        """
+        压缩图片文件
+        :param path: 文件路径
+        :param new_path: 新文件路径
+        :param check_compressed: 是否检查压缩标记
+        :param upload_timeout: 上传响应超时时间，默认60s
+        :param download_timeout: 下载响应超时时间，默认30s
+        :param controller: 并发控制器，出错时通知其是否需要降低并发
+        :param timing: 分阶段计时
+        :param on_retry: 每次重试时的回调on_retry(第几次重试，上次的错误，等待的时间，重试的阶段)，
+            阶段为download时沿用已得到的图片链接只重试下载，为upload时重新上传
+        :param variants: 需要生成的衍生图片，压缩后的图片下载完成后由同一个图片链接并行请求，默认使用set_variants的设置
+        :return: (文件名，旧大小，新大小，压缩到原来的百分比，结果来源: marked/cache/upload/dedup)
+        """
+        variants = cls._variants(variants)
+        info, digest = cls.prepare(path, new_path, check_compressed, variants)
+        if timing is not None:
+            timing.lap('prepare')
+        if info is not None:
+            Journal.record(path, Journal.WRITTEN)
+            return info
+
+        old_size = os.path.getsize(path)
+        file_name = os.path.basename(path)
+        url, client = Journal.uploaded_url(path, old_size), cls.get_client()  # 上次中断前已上传则直接下载
+        retries, reuploaded = 0, False
+
+        def attempt() -> int:
+            nonlocal url, client, reuploaded
+            while True:
+                try:
+                    if url is None:
+                        url, client = cls.upload(path, upload_timeout, timing=timing)
+                        Journal.record(path, Journal.UPLOADED, url=url, size=old_size)
+                    # 下载失败时保留图片链接，重试时只重新下载
+                    return cls.download(new_path, url, digest, download_timeout, client, path, timing)
+                except Exception as e:
+                    if controller is not None:
+                        controller.congested(e)
+                    if url is None or reuploaded or not cls.is_expired(e):
+                        raise
+                    logger.warning('云端图片已过期，重新上传: {}', file_name)
+                    url, reuploaded = None, True
+
+        def retried(n, e, delay):
+            nonlocal retries
+            retries = n
+            stage = 'upload' if url is None else 'download'
+            if timing is not None:
+                timing.lap('retry')
+            logger.warning('重试{}图片(第{}次，已等待{:.1f}s): {}, 错误信息: {}',
+                           '上传' if stage == 'upload' else '下载', n, delay, file_name, e)
+            if on_retry is not None:
+                on_retry(n, e, delay, stage)
+
+        try:
+            # 上传与下载分别使用各自的熔断器
+            new_size = cls.retry_policy.call(attempt, url=lambda: f'{cls.API_ENDPOINT}/shrink' if url is None else url,
+                                             on_retry=retried)
+        except Exception as e:
+            Journal.record(path, Journal.FAILED, err=str(e))
+            raise cls.retry_error(path, e, retries)
+        try:
+            cls.download_variants(variants, new_path, url, download_timeout, client, path)
+        except CompressException as e:
+            Journal.record(path, Journal.FAILED, err=str(e))
+            raise
+        Journal.record(path, Journal.WRITTEN)
+        return file_name, old_size, new_size, f'{round(100 * new_size / old_size, 2)}%', 'upload'
+
+    @classmethod
+    def compress_from_file_list(cls, file_list, new_dir=None, upload_timeout=None, download_timeout=None,
+                                engine='thread', min_workers=None, max_workers=None, order=None, variants=None) -> dict:
         """
         批量压缩多个文件
         :param file_list: 文件路径列表
         :param new_dir: 输出文件夹
         :param upload_timeout: 上传响应超时时间，默认60s
         :param download_timeout: 下载响应超时时间，默认30s
+        :param engine: 压缩引擎，thread为线程池，async为asyncio单线程并发（需要aiohttp）
+        :param min_workers: 最小并发数，默认使用set_concurrency的设置
+        :param max_workers: 最大并发数，默认使用set_concurrency的设置
+        :param order: 提交顺序，默认使用set_order的设置
+        :param variants: 每个文件需要生成的衍生图片，默认使用set_variants的设置
         :return: 压缩情况报告
         """
+        for _, res in cls.compress_stream([(None, file_list, 0)], new_dir, upload_timeout, download_timeout,
+                                          engine, min_workers, max_workers, order=order, variants=variants):
+            return res
+
+    @classmethod
+    def compress_stream(cls, groups, new_dir=None, upload_timeout=None, download_timeout=None,
+                        engine='thread', min_workers=None, max_workers=None, client: TinyClient = None, order=None,
+                        on_file=None, variants=None):
+        """
+        流式批量压缩，所有分组共用同一个线程池和有界任务队列，分组之间不再等待线程池清空
+        :param groups: 分组的可迭代对象（可以是边扫描边产出的生成器），元素为(文件夹路径或None，文件路径列表，跳过数量)
+        :param new_dir: 输出文件夹
+        :param upload_timeout: 上传响应超时时间，默认60s
+        :param download_timeout: 下载响应超时时间，默认30s
+        :param engine: 压缩引擎，async引擎按分组依次压缩
+        :param min_workers: 最小并发数，默认使用set_concurrency的设置
+        :param max_workers: 最大并发数，默认使用set_concurrency的设置
+        :param client: 指定使用的客户端（不自动切换密钥，仅thread引擎），默认跟随当前密钥
+        :param order: 分组内文件的提交顺序，默认使用set_order的设置
+        :param on_file: 每个文件完成时的回调on_file(path, result)，result为压缩结果或异常（async引擎成功时为None），
+            thread引擎在工作线程中调用
+        :param variants: 每个文件需要生成的衍生图片，由上传得到的同一个图片链接并行请求，默认使用set_variants的设置
+        :return: 生成器，每个分组全部完成时产出(文件夹路径或None，该分组的压缩情况报告)
+        """
+        variants = cls._variants(variants)
+        if new_dir:
+            cls.clean_dir_tmp(new_dir)
+        if engine == 'async':
+            try:
+                from tinypng_unlimited.async_tiny_img import AsyncTinyImg  # aiohttp为可选依赖
+            except ImportError as e:
+                raise CompressException('async压缩引擎需要aiohttp，请执行: pip install -r requirements-async.txt', e)
+            for input_dir, file_list, skip_count in groups:
+                file_list, written = Journal.skip_written(file_list)
+                skip_count += written
+                res = AsyncTinyImg.compress_from_file_list(cls.sort_files(file_list, order), new_dir,
+                                                           upload_timeout, download_timeout, variants=variants)
+                res['basic']['skip_count'] = skip_count
+                res['order'] = order or cls.order
+                if on_file is not None:
+                    error_files = set(res['error_files'])
+                    for path in file_list:
+                        on_file(path, CompressException('压缩失败', path) if path in error_files else None)
+                if input_dir is not None:
+                    res['input_dir'] = input_dir
+                yield input_dir, res
+            return
+        elif engine != 'thread':
+            raise CompressException('未知压缩引擎', engine)
 
         if new_dir and not os.path.exists(new_dir):
             os.makedirs(new_dir)
 
-        success_count = 0
-        old_size = new_size = 0  # python不用担心大数运算溢出问题
-        error_files, success_files = [], []
-        file_num = len(file_list)
-
-        logger.info('待压缩图片数量: {}', file_num)
-
-        thread_num = 4
-        # 4核心理论可以8线程，但是上传速度才是决速步
-        with ThreadPoolExecutor(thread_num) as pool:
-            with tqdm(desc='[任务进度]', unit='份', total=file_num, file=sys.stdout, ascii=' ▇',
-                      colour='yellow', leave=False, ncols=120, position=thread_num) as bar:
-                future_list = []
-                for old_path in file_list:
-                    file_name = os.path.basename(old_path)
-                    # 默认下覆盖原文件
-                    new_path = os.path.abspath(os.path.join(new_dir, file_name)) if new_dir else old_path
-                    future_list.append(pool.submit(cls.compress_from_file, old_path, new_path, True,
-                                                   upload_timeout, download_timeout))
-
-                for future in as_completed(future_list):
-                    try:
-                        info = future.result()
-                        # 压缩成功则统计信息
-                        old_size += info[1]
-                        new_size += info[2]
-                        success_count += 1
-                        success_files.append(
-                            (info[0], cls._byte_converter(info[1]), cls._byte_converter(info[2]), info[3])
-                        )
-                        logger.success('图片压缩完成: {}', info[0])
-                    except CompressException as e:
-                        error_files.append(e.detail['path'])
-                        logger.error('压缩图片失败: {} {}', os.path.basename(e.detail['path']), e)
-                    except Exception as e:
-                        logger.error('压缩图片未知错误 {}', e)
-                    bar.update()
-                bar_info = bar.format_dict
-
-        compression = f'{round(100 * new_size / old_size, 2)}%' if old_size else '100%'
-        return {
-            'basic': {
-                'file_num': file_num, 'success_count': success_count,
-                'error_count': len(error_files),
-                'time': '{:.2f} s'.format(bar_info['elapsed']), 'speed': '{:.2f} 份/s'.format(bar_info['rate']),
-                'output_size': cls._byte_converter(new_size), 'input_size': cls._byte_converter(old_size),
-                'compression': compression, 'output_dir': '覆盖原文件' if new_dir is None else new_dir,
-            },
-            'error_files': error_files,
-            'success_files': success_files,
-        }
-
-    @classmethod
-    def compress_from_dir(cls, dir_path, new_dir=None, reg=r'.*\.(jpe?g|png|svga)$') -> dict:
+        # 上传速度才是决速步，上传线程池按上限创建，实际并发数由控制器根据吞吐量调整
+        controller = ConcurrencyController(cls.min_workers if min_workers is None else min_workers,
+                                           cls.max_workers if max_workers is None else max_workers)
+        results = Queue()
+
+        def on_done(job, res):
+            if on_file is not None:
+                on_file(job.path, res)
+            results.put((job, res))
+
+        pipeline = Pipeline(controller, cls.download_workers, upload_timeout=upload_timeout,
+                            download_timeout=download_timeout, on_done=on_done, client=client)
+        # 已提交未完成的任务上限，避免一次性提交整棵目录树
+        queue_size = pipeline.capacity + controller.max_workers
+        open_reports = []  # 尚未完成的分组
+        in_flight = success_count = error_count = 0
+
+        def collect(block):
+            """
+            统计已完成的任务，返回已全部完成的分组
+            """
+            nonlocal in_flight, success_count, error_count
+            while in_flight:
+                try:
+                    job, info = results.get(block=block)
+                except Empty:
+                    break
+                block = False
+                in_flight -= 1
+                report = job.tag
+                report.pending -= 1
+                bar.update()
+                if job.timing is not None:
+                    report.add_timing(job.timing, not isinstance(info, Exception))
+                report.add_retries(job.path, job.retries, job.reuploads_avoided)
+                if isinstance(info, Exception):
+                    error_count += 1
+                    Journal.record(job.path, Journal.FAILED, err=str(info))
+                if isinstance(info, CompressException):
+                    report.add_error(info.detail['path'], info.detail.get('permanent', False))
+                    logger.error('压缩图片失败: {} {}', os.path.basename(info.detail['path']), info)
+                elif isinstance(info, Exception):
+                    report.add_error(job.path)
+                    logger.error('压缩图片未知错误: {} {}', job.file_name, info)
+                else:
+                    # 压缩成功则统计信息
+                    success_count += 1
+                    Journal.record(job.path, Journal.WRITTEN)
+                    report.add_success(info)
+                    report.variant_count += job.variant_count
+                    logger.success('图片压缩完成: {}', info[0])
+
+            bar.set_postfix(成功=success_count, 失败=error_count, refresh=False)
+            finished = [r for r in open_reports if r.closed and not r.pending]
+            for r in finished:
+                open_reports.remove(r)
+                r.extra['concurrency'] = controller.history
+                r.extra['pipeline'] = pipeline.stats()
+                r.extra['retry'] = RetryPolicy.stats()
+            return finished
+
+        try:
+            with pipeline:
+                with cls.task_bar(desc='[任务进度]', unit='份', file=sys.stdout, ascii=' ▇', colour='yellow',
+                                  leave=False, ncols=120, position=controller.max_workers) as bar:
+                    for input_dir, file_list, skip_count in groups:
+                        file_list, written = Journal.skip_written(file_list)
+                        file_list = cls.sort_files(file_list, order)
+                        report = Report(len(file_list), new_dir, input_dir, skip_count + written)
+                        report.extra['order'] = order or cls.order
+                        open_reports.append(report)
+                        logger.info('待压缩图片数量: {}{}', len(file_list), f' ({input_dir})' if input_dir else '')
+                        for old_path in file_list:
+                            while in_flight >= queue_size:
+                                for r in collect(True):
+                                    yield r.input_dir, r.to_dict()
+                            # 默认下覆盖原文件
+                            new_path = (os.path.abspath(os.path.join(new_dir, os.path.basename(old_path)))
+                                        if new_dir else old_path)
+                            Journal.record(old_path, Journal.PENDING)
+                            job = CompressJob(old_path, new_path, report)
+                            job.variants = variants
+                            job.timing = Timing.new(old_path)
+                            pipeline.submit(job)
+                            report.pending += 1
+                            in_flight += 1
+                            bar.total = (bar.total or 0) + 1
+                        report.closed = True
+                        for r in collect(False):
+                            yield r.input_dir, r.to_dict()
+
+                    while open_reports:
+                        for r in collect(True):
+                            yield r.input_dir, r.to_dict()
+        finally:
+            ResultCache.flush()
+            Manifest.flush()
+            Journal.flush()
+            cls.save_count()
+
+    @classmethod
+    def compress_from_queue(cls, queue: WorkQueue, new_dir=None, batch_size=16, engine='thread', poll_interval=5.0):
         """
-        压缩文件夹内图片
+        worker模式：从多个进程共享的任务队列按批领取文件压缩，直到队列中没有可领取的文件且其他worker均已完成
+        :param queue: 共享任务队列
+        :param new_dir: 输出文件夹
+        :param batch_size: 每次领取的文件数量
+        :param engine: 压缩引擎
+        :param poll_interval: 其他worker仍持有租约时，再次尝试领取的间隔(s)
+        :return: 生成器，每批完成时产出该批的压缩情况报告
+        """
+
+        def batches():
+            while True:
+                file_list = queue.claim(batch_size)
+                if file_list:
+                    yield None, file_list, 0
+                elif queue.others_active():  # 其他worker崩溃后租约过期，其文件将重新可领取
+                    time.sleep(poll_interval)
+                else:
+                    return
+
+        for _, res in cls.compress_stream(batches(), new_dir, engine=engine, on_file=queue.complete):
+            yield res
+
+    @classmethod
+    def _scan(cls, dir_path, reg) -> tuple:
+        """
+        扫描单个文件夹，仅使用目录扫描得到的stat信息跳过索引中已压缩的文件
+        :return: (待压缩文件路径列表，跳过数量，子文件夹路径列表)
+        """
+        file_list, skip_count, sub_dirs = [], 0, []
+        stale, now = 0, time.time()
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    sub_dirs.append(entry.path)
+                    continue
+                if cls.TMP_NAME.match(entry.name):  # 覆盖原文件时异常退出遗留的临时文件
+                    stale += cls._remove_stale_tmp(entry, now)
+                    continue
+                if not entry.is_file() or not re.match(reg, entry.name, re.IGNORECASE):
+                    continue
+                if Manifest.is_compressed(entry.path, entry.stat()):
+                    skip_count += 1
+                    continue
+                file_list.append(os.path.abspath(entry.path))
+        if stale:
+            logger.debug('已清理遗留的临时文件: {} ({})', stale, dir_path)
+        return file_list, skip_count, sub_dirs
+
+    @classmethod
+    def scan_dir(cls, dir_path, reg=r'.*\.(jpe?g|png|svga)$') -> tuple:
+        """
+        扫描文件夹内待压缩图片
         :param dir_path: 文件夹路径
-        :param new_dir: 输出路径(None则覆盖原文件)
         :param reg: 文件名正则匹配
-        :return: 压缩情况报告
+        :return: (待压缩文件路径列表，跳过数量)
         """
         if not os.path.exists(dir_path):
             raise CompressException('源文件夹不存在', dir_path)
 
-        # 默认覆盖原文件
-        if new_dir and not os.path.exists(new_dir):
-            os.makedirs(new_dir)
+        file_list, skip_count, _ = cls._scan(dir_path, reg)
+        if not len(file_list) and not skip_count:
+            raise CompressException('文件夹内无任何匹配文件', dir_path)
+        if skip_count:
+            logger.info('索引中已压缩的图片数量: {}, 跳过', skip_count)
+        return file_list, skip_count
 
-        file_list = [os.path.abspath(os.path.join(dir_path, f)) for f in os.listdir(dir_path) if
-                     re.match(reg, f, re.IGNORECASE)]
+    @classmethod
+    def walk_dir(cls, dir_path, recursive=False, reg=r'.*\.(jpe?g|png|svga)$'):
+        """
+        逐个扫描文件夹，作为compress_stream的分组来源
+        :param dir_path: 文件夹路径
+        :param recursive: 是否递归子文件夹
+        :param reg: 文件名正则匹配
+        :return: 生成器，产出(文件夹路径，待压缩文件路径列表，跳过数量)，无任何匹配文件的文件夹不产出
+        """
+        if not os.path.exists(dir_path):
+            raise CompressException('源文件夹不存在', dir_path)
 
-        if not len(file_list):
-            raise CompressException('文件夹内无任何匹配文件', dir_path)
+        stack = [dir_path]
+        while stack:
+            cur_dir = stack.pop()
+            try:
+                file_list, skip_count, sub_dirs = cls._scan(cur_dir, reg)
+            except OSError as e:
+                logger.error('文件夹扫描失败: {} {}', cur_dir, e)
+                continue
+            if recursive:
+                stack.extend(reversed(sub_dirs))
+            if len(file_list) or skip_count:
+                if skip_count:
+                    logger.info('索引中已压缩的图片数量: {}, 跳过 ({})', skip_count, cur_dir)
+                yield cur_dir, file_list, skip_count
 
-        res = cls.compress_from_file_list(file_list, new_dir)
-        res['input_dir'] = dir_path
-        return res
+    @classmethod
+    def compress_from_dir(cls, dir_path, new_dir=None, reg=r'.*\.(jpe?g|png|svga)$', engine='thread') -> dict:
+        """
+        压缩文件夹内图片
+        :param dir_path: 文件夹路径
+        :param new_dir: 输出路径(None则覆盖原文件)
+        :param reg: 文件名正则匹配
+        :param engine: 压缩引擎，thread或async
+        :return: 压缩情况报告
+        """
+        file_list, skip_count = cls.scan_dir(dir_path, reg)
+        for _, res in cls.compress_stream([(dir_path, file_list, skip_count)], new_dir, engine=engine):
+            return res
 
     @staticmethod
     def _byte_converter(byte_num) -> str:
-        if byte_num < 1024:  # 比特
-            return '{:.2f} B'.format(byte_num)  # 字节
-        elif 1024 <= byte_num < 1024 * 1024:
-            return '{:.2f} KB'.format(byte_num / 1024)  # 千字节
-        else:
-            return '{:.2f} MB'.format(byte_num / 1024 / 1024)  # 兆字节
+        return byte_converter(byte_num)
@@ -0,0 +1,76 @@
+import mmap
+import os
+import time
+
+
+class UploadBody:
+    """
+    上传请求体：文件映射到内存后按块产出memoryview，直接交给socket发送，
+    不再逐次read复制数据，进度回调按时间间隔合并后调用
+    """
+
+    def __init__(self, path, block_size=256 * 1024, callback=None, interval=0.1):
+        """
+        :param path: 文件路径
+        :param block_size: 每次发送的字节数
+        :param callback: 进度回调callback(n)，n为距上次回调新发送的字节数
+        :param interval: 进度回调的最小间隔(s)
+        """
+        self.block_size = max(1, block_size)
+        self.callback = callback
+        self.interval = interval
+        self.sent_at = None  # 全部发送完成时的perf_counter
+        self._iters = []  # 已创建的分块生成器，关闭映射前须先关闭以释放其memoryview
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            # 空文件无法映射
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        # requests据此设置content-length，不使用分块传输
+        return self.size
+
+    def __iter__(self):
+        blocks = self._blocks()
+        self._iters.append(blocks)
+        return blocks
+
+    def _blocks(self):
+        view = memoryview(self._buffer)
+        chunk = None
+        pending, last = 0, time.time()
+        try:
+            for i in range(0, self.size, self.block_size):
+                chunk = view[i:i + self.block_size]
+                yield chunk
+                chunk.release()  # 请求下一块时上一块已发送完成
+                if self.callback is None:
+                    continue
+                pending += min(self.block_size, self.size - i)
+                if time.time() - last >= self.interval:
+                    self.callback(pending)
+                    pending, last = 0, time.time()
+            if self.callback is not None and pending:
+                self.callback(pending)
+            self.sent_at = time.perf_counter()
+        finally:
+            if chunk is not None:
+                chunk.release()
+            view.release()
+
+    def close(self):
+        """
+        关闭分块生成器，释放上传中断时仍被引用的memoryview后关闭映射，
+        映射未关闭时Windows上无法替换源文件
+        """
+        for blocks in self._iters:
+            blocks.close()
+        self._iters.clear()
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
@@ -0,0 +1,99 @@
+import os
+import re
+
+from tinypng_unlimited.errors import CompressException
+
+
+class Variant:
+    """
+    衍生图片：对同一次上传的云端压缩结果再请求调整尺寸或转换格式，
+    N个衍生图片只需上传一次，每个衍生图片消耗一次压缩次数
+    """
+    METHODS = ('scale', 'fit', 'cover', 'thumb')
+    FORMATS = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp',
+               'avif': 'image/avif'}
+
+    def __init__(self, width: int = None, height: int = None, method: str = None, convert: str = None,
+                 suffix: str = None):
+        """
+        :param width: 目标宽度
+        :param height: 目标高度
+        :param method: 调整尺寸方式，scale只能指定宽高之一，fit/cover/thumb须同时指定宽高，默认按指定的宽高选择scale或fit
+        :param convert: 转换格式，如webp，不转换则为None
+        :param suffix: 输出文件名后缀（扩展名之前），默认由宽高与调整方式生成，如-800x600、-800x600-cover、-800w
+        """
+        if width is None and height is None and convert is None:
+            raise CompressException('衍生图片须调整尺寸或转换格式', None)
+        if convert is not None:
+            convert = convert.lower().lstrip('.')
+            if convert not in self.FORMATS:
+                raise CompressException('不支持转换的格式', convert)
+        if width is not None or height is not None:
+            method = method or ('fit' if width and height else 'scale')
+            if method not in self.METHODS:
+                raise CompressException('未知调整尺寸方式', method)
+            if (method == 'scale') == (width is not None and height is not None):
+                raise CompressException('scale须只指定宽高之一，fit/cover/thumb须同时指定宽高', (width, height, method))
+        elif method is not None:
+            raise CompressException('未指定宽高时不能指定调整尺寸方式', method)
+        self.width, self.height, self.method, self.convert = width, height, method, convert
+        if suffix is None:
+            if width and height:
+                suffix = f'-{width}x{height}' + ('' if method == 'fit' else f'-{method}')
+            elif width or height:
+                suffix = f'-{width}w' if width else f'-{height}h'
+            else:
+                suffix = ''
+        self.suffix = suffix
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Variant':
+        """
+        解析命令行中的衍生图片描述，以冒号分隔尺寸、调整方式与格式，顺序不限，如
+        800x600、800x、x600、800x600:cover、400x:webp、webp
+        """
+        width = height = method = convert = None
+        for part in filter(None, spec.lower().split(':')):
+            size = re.fullmatch(r'(\d*)x(\d*)', part)
+            if size and any(size.groups()):
+                width, height = (int(v) if v else None for v in size.groups())
+            elif part in cls.METHODS:
+                method = part
+            elif part.lstrip('.') in cls.FORMATS:
+                convert = part
+            else:
+                raise CompressException('无法解析衍生图片描述', spec)
+        return cls(width, height, method, convert)
+
+    @property
+    def name(self) -> str:
+        return (self.suffix.lstrip('-') or 'original') + (f'.{self.convert}' if self.convert else '')
+
+    def options(self) -> dict:
+        """
+        请求图片链接时的json参数
+        """
+        options = {}
+        if self.method is not None:
+            resize = {'method': self.method}
+            if self.width:
+                resize['width'] = self.width
+            if self.height:
+                resize['height'] = self.height
+            options['resize'] = resize
+        if self.convert is not None:
+            options['convert'] = {'type': self.FORMATS[self.convert]}
+        return options
+
+    def path(self, new_path) -> str:
+        """
+        衍生图片的输出路径，与压缩后的图片位于同一文件夹
+        """
+        root, ext = os.path.splitext(new_path)
+        path = f'{root}{self.suffix}{"." + self.convert if self.convert else ext}'
+        if os.path.normcase(path) == os.path.normcase(new_path):
+            raise CompressException('衍生图片与压缩后的图片路径相同', {'path': new_path, 'variant': self.name})
+        return path
+
+    def __repr__(self):
+        return f'Variant({self.name})'
@@ -0,0 +1,245 @@
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import time
+
+from loguru import logger
+
+import tinypng_unlimited  # 不使用from import防止交叉引用
+from tinypng_unlimited.manifest import Manifest
+
+
+class _Inotify:
+    """
+    Linux inotify（通过ctypes调用libc），无事件时阻塞在select上不占用CPU
+    """
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._dirs = {}  # wd -> 文件夹路径
+
+    def add(self, dir_path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), self.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dir_path)
+        self._dirs[wd] = dir_path
+
+    def read(self, timeout) -> list:
+        """
+        等待事件
+        :param timeout: 最长等待时间(s)，None则一直等待
+        :return: [(路径，是否为文件夹)]，事件队列溢出时路径为None
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, i = [], 0
+        while i + self.EVENT.size <= len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, i)
+            name = data[i + self.EVENT.size:i + self.EVENT.size + length].rstrip(b'\0')
+            i += self.EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, True))
+            elif mask & self.IN_IGNORED:  # 文件夹已删除
+                self._dirs.pop(wd, None)
+            elif name and wd in self._dirs:
+                events.append((os.path.join(self._dirs[wd], os.fsdecode(name)), bool(mask & self.IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _Polling:
+    """
+    定时扫描文件夹，对比文件大小与修改时间，用于不支持inotify的系统
+    """
+
+    def __init__(self, dir_path, recursive, interval):
+        self.dir_path = dir_path
+        self.recursive = recursive
+        self.interval = interval
+        self._snapshot = self._scan()
+        self._next = time.monotonic() + interval
+
+    def _scan(self) -> dict:
+        snapshot, stack = {}, [self.dir_path]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            if self.recursive:
+                                stack.append(entry.path)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:  # 扫描期间被删除
+                continue
+        return snapshot
+
+    def add(self, dir_path):
+        pass
+
+    def read(self, timeout) -> list:
+        wait = self._next - time.monotonic()
+        if timeout is not None and timeout < wait:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(wait, 0))
+        self._next = time.monotonic() + self.interval
+        snapshot = self._scan()
+        changed = [(path, False) for path, sig in snapshot.items() if self._snapshot.get(path) != sig]
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class DirWatcher:
+    """
+    监听文件夹内新增或修改的图片，等待文件写入完成（一段时间内无变化）后按批产出，
+    优先使用inotify，不可用时定时扫描
+    """
+
+    def __init__(self, dir_path, recursive=False, reg=r'.*\.(jpe?g|png|svga)$', debounce=2.0,
+                 poll_interval=2.0, polling=False):
+        """
+        :param dir_path: 文件夹路径
+        :param recursive: 是否监听子文件夹（包括之后新建的）
+        :param reg: 文件名正则匹配
+        :param debounce: 文件最后一次变化后等待的时间(s)，期间大小与修改时间不变才视为写入完成
+        :param poll_interval: 定时扫描的间隔(s)
+        :param polling: 是否强制使用定时扫描（如网络文件系统上inotify收不到其他机器的修改）
+        """
+        self.dir_path = os.path.abspath(dir_path)
+        self.recursive = recursive
+        self.reg = reg
+        self.debounce = debounce
+        self._pending = {}  # 路径 -> (最后一次变化的时间，当时的大小与修改时间)
+        self._backend = None
+        if not polling:
+            try:
+                self._backend = _Inotify()
+                self._add_dir(self.dir_path)
+            except (OSError, AttributeError) as e:  # 非Linux系统或监听数量超出限制
+                logger.warning('inotify不可用，改为定时扫描: {}', e)
+                if self._backend is not None:
+                    self._backend.close()
+                self._backend = None
+        if self._backend is None:
+            self._backend = _Polling(self.dir_path, recursive, poll_interval)
+        logger.info('文件夹监听方式: {}', 'inotify' if isinstance(self._backend, _Inotify) else '定时扫描')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _add_dir(self, dir_path, touch=False):
+        """
+        监听文件夹（递归时包括子文件夹）
+        :param touch: 是否将其中已有的文件视为新文件（新建的文件夹在开始监听前可能已写入文件）
+        """
+        stack = [dir_path]
+        while stack:
+            cur_dir = stack.pop()
+            try:
+                self._backend.add(cur_dir)
+                with os.scandir(cur_dir) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            if self.recursive:
+                                stack.append(entry.path)
+                        elif touch:
+                            self._touch(entry.path)
+            except FileNotFoundError:
+                continue
+
+    def _touch(self, path):
+        if not re.match(self.reg, os.path.basename(path), re.IGNORECASE):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._pending.pop(path, None)
+            return
+        self._pending[path] = (time.monotonic(), (stat.st_size, stat.st_mtime_ns))
+
+    def _ready(self) -> list:
+        """
+        取出已写入完成的文件，跳过已压缩的文件（包括本程序压缩后覆盖原文件产生的事件）
+        """
+        ready, now = [], time.monotonic()
+        for path, (last, sig) in list(self._pending.items()):
+            if now - last < self.debounce:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:  # 已删除或移走
+                del self._pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != sig:  # 仍在写入
+                self._pending[path] = (now, (stat.st_size, stat.st_mtime_ns))
+                continue
+            del self._pending[path]
+            try:
+                if Manifest.is_compressed(path, stat) or tinypng_unlimited.TinyImg.check_if_compressed(path):
+                    continue
+            except OSError:
+                continue
+            ready.append(path)
+        return ready
+
+    def batches(self, existing=False):
+        """
+        持续监听
+        :param existing: 是否先产出文件夹内已有的未压缩图片
+        :return: 生成器，产出写入完成的待压缩文件路径列表
+        """
+        if existing:
+            for _, file_list, _ in tinypng_unlimited.TinyImg.walk_dir(self.dir_path, self.recursive, self.reg):
+                if file_list:
+                    yield file_list
+        while True:
+            if self._pending:  # 等到最早的文件到期
+                timeout = max(min(last for last, _ in self._pending.values()) + self.debounce - time.monotonic(), 0)
+            else:
+                timeout = None
+            for path, is_dir in self._backend.read(timeout):
+                if path is None:
+                    logger.warning('监听事件过多已溢出，重新扫描文件夹')
+                    self._add_dir(self.dir_path, touch=True)
+                elif is_dir:
+                    if self.recursive:
+                        self._add_dir(path, touch=True)
+                else:
+                    self._touch(path)
+            ready = self._ready()
+            if ready:
+                yield ready
+
+    def close(self):
+        self._backend.close()
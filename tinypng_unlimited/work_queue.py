@@ -0,0 +1,182 @@
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from threading import Thread, Event, Lock
+
+from loguru import logger
+
+
+class WorkQueue:
+    """
+    多进程、多机共享的任务队列（SQLite），worker按批领取文件并持有租约，后台线程定期续约，
+    worker崩溃后租约过期，文件由其他worker重新领取。多机使用时数据库须位于各机共享的文件系统上，
+    且各机时钟误差应远小于租约时长
+    """
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path, lease_time=300.0, max_attempts=3, worker_id=None):
+        """
+        :param path: 数据库文件路径，不存在时自动创建
+        :param lease_time: 租约时长(s)，超过该时长未续约的文件可被其他worker领取
+        :param max_attempts: 单个文件最多被领取的次数，租约多次过期（如导致进程崩溃的文件）后标记为失败
+        :param worker_id: worker标识，默认为主机名-进程号-随机串
+        """
+        self.path = os.path.abspath(path)
+        self.lease_time = lease_time
+        self.max_attempts = max(1, max_attempts)
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        self._lock = Lock()  # 连接在领取、回报与续约线程之间共用
+        self._stop = Event()
+        self._heartbeat = None
+        # 自行管理事务；不使用WAL模式，因其依赖共享内存，不支持网络文件系统
+        self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS tasks (path TEXT PRIMARY KEY, size INTEGER NOT NULL DEFAULT 0, '
+                         'state TEXT NOT NULL, owner TEXT, lease_until REAL, '
+                         'attempts INTEGER NOT NULL DEFAULT 0, error TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_until)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        写事务，开始时即获得数据库写锁，保证多个worker的领取互不重叠
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def add(self, paths) -> int:
+        """
+        添加待压缩文件，已在队列中的文件忽略
+        :param paths: 文件路径的可迭代对象
+        :return: 新添加的文件数量
+        """
+        rows = []
+        for path in paths:
+            try:
+                rows.append((os.path.abspath(path), os.path.getsize(path), self.PENDING))
+            except OSError as e:
+                logger.error('文件无法加入任务队列: {} {}', path, e)
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO tasks (path, size, state) VALUES (?, ?, ?)', rows)
+            return conn.total_changes - before
+
+    def claim(self, limit) -> list:
+        """
+        领取最多limit个待压缩或租约已过期的文件，较大的文件优先
+        :return: 文件路径列表
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('UPDATE tasks SET state = ?, owner = NULL, error = ? '
+                         'WHERE state = ? AND lease_until < ? AND attempts >= ?',
+                         (self.FAILED, '租约多次过期', self.LEASED, now, self.max_attempts))
+            paths = [row[0] for row in conn.execute(
+                'SELECT path FROM tasks WHERE state = ? OR (state = ? AND lease_until < ?) '
+                'ORDER BY size DESC LIMIT ?', (self.PENDING, self.LEASED, now, limit))]
+            conn.executemany('UPDATE tasks SET state = ?, owner = ?, lease_until = ?, attempts = attempts + 1 '
+                             'WHERE path = ?', [(self.LEASED, self.worker_id, now + self.lease_time, p) for p in paths])
+        if paths:
+            self._start_heartbeat()
+        return paths
+
+    def complete(self, path, result=None):
+        """
+        回报文件压缩结果，可直接作为compress_stream的on_file回调
+        :param path: 文件路径
+        :param result: 压缩结果，为异常时标记为失败
+        """
+        failed = isinstance(result, Exception)
+        with self._transaction() as conn:
+            cur = conn.execute('UPDATE tasks SET state = ?, owner = NULL, lease_until = NULL, error = ? '
+                               'WHERE path = ? AND owner = ? AND state = ?',
+                               (self.FAILED if failed else self.DONE, str(result) if failed else None,
+                                os.path.abspath(path), self.worker_id, self.LEASED))
+        if not cur.rowcount:
+            logger.warning('文件租约已过期并被其他worker领取: {}', path)
+
+    def renew(self) -> int:
+        """
+        续约当前worker持有的全部文件
+        :return: 续约的文件数量
+        """
+        with self._transaction() as conn:
+            return conn.execute('UPDATE tasks SET lease_until = ? WHERE owner = ? AND state = ?',
+                                (time.time() + self.lease_time, self.worker_id, self.LEASED)).rowcount
+
+    def others_active(self) -> bool:
+        """
+        其他worker是否仍持有未过期的租约，是则其文件可能在其崩溃后重新变为可领取
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM tasks WHERE state = ? AND owner != ? AND lease_until >= ? '
+                                     'LIMIT 1', (self.LEASED, self.worker_id, time.time())).fetchone()
+        return row is not None
+
+    def retry_failed(self) -> int:
+        """
+        将失败的文件重新标记为待压缩
+        :return: 重新标记的文件数量
+        """
+        with self._transaction() as conn:
+            return conn.execute('UPDATE tasks SET state = ?, attempts = 0, error = NULL WHERE state = ?',
+                                (self.PENDING, self.FAILED)).rowcount
+
+    def counts(self) -> dict:
+        """
+        各状态的文件数量
+        """
+        with self._lock:
+            return dict(self._conn.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state'))
+
+    def failed_files(self) -> list:
+        with self._lock:
+            return [row[0] for row in self._conn.execute('SELECT path FROM tasks WHERE state = ?', (self.FAILED,))]
+
+    def _start_heartbeat(self):
+        if self._heartbeat is None:
+            self._heartbeat = Thread(target=self._renew_loop, daemon=True)
+            self._heartbeat.start()
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.lease_time / 3):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logger.warning('任务队列续约失败: {}', e)
+
+    def close(self):
+        """
+        停止续约，归还尚未完成的文件后关闭数据库
+        """
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        try:
+            with self._transaction() as conn:
+                n = conn.execute('UPDATE tasks SET state = ?, owner = NULL, lease_until = NULL, '
+                                 'attempts = attempts - 1 WHERE owner = ? AND state = ?',
+                                 (self.PENDING, self.worker_id, self.LEASED)).rowcount
+            if n:
+                logger.info('已归还未完成的文件: {}', n)
+        finally:
+            self._conn.close()